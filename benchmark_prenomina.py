@@ -0,0 +1,321 @@
+"""Benchmark por etapa del proceso de pre-nómina con datos SAP sintéticos.
+
+Genera Lista PI y Tesorería con una mezcla realista de proveedores, clases
+AB/SA/EC/ED, anticipos que compensan facturas y referencias FACTORING; mide
+cada etapa por separado y guarda los tiempos en un JSON comparable entre
+commits.
+
+    python benchmark_prenomina.py --sizes 10000 100000 --output base.json
+    python benchmark_prenomina.py --sizes 10000 100000 --compare base.json
+"""
+
+import argparse
+import importlib.util
+import json
+import os
+from pathlib import Path
+import platform
+import statistics
+import subprocess
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+
+MODULE_PATH = Path(__file__).with_name("prenomina streamlit.py")
+SPEC = importlib.util.spec_from_file_location("prenomina_streamlit", MODULE_PATH)
+if SPEC.name in sys.modules:  # ya cargado, p. ej. por las pruebas
+    MODULE = sys.modules[SPEC.name]
+else:
+    MODULE = importlib.util.module_from_spec(SPEC)
+    assert SPEC.loader is not None
+    sys.modules[SPEC.name] = MODULE
+    SPEC.loader.exec_module(MODULE)
+
+DEFAULT_SIZES = (10_000, 100_000, 1_000_000)
+PAYROLL_DATE = pd.Timestamp("2026-07-17")  # viernes de nómina
+DOCUMENT_CLASS_MIX = {"KR": 0.62, "RE": 0.15, "AB": 0.08, "SA": 0.05, "EC": 0.06, "ED": 0.04}
+# Fracción de AB/SA en positivo que replica el importe de una factura abierta.
+MATCHING_ADVANCE_RATIO = 0.5
+FACTORING_RATIO = 0.03
+PAYMENT_BLOCK_RATIO = 0.02
+PAYMENT_METHOD_C_RATIO = 0.03
+TESORERIA_SUPPLIER_RATIO = 0.6
+
+
+# --- Generador de datos sintéticos ---
+def generate_lista_pi(rows: int, seed: int = 0) -> pd.DataFrame:
+    """Genera una Lista PI con los encabezados del reporte SAP.
+
+    Los proveedores siguen una distribución tipo Zipf: pocos acreedores
+    concentran miles de partidas y la mayoría tiene pocas.
+    """
+    rng = np.random.default_rng(seed)
+    supplier_count = max(20, rows // 200)
+    weights = 1 / np.arange(1, supplier_count + 1) ** 1.1
+    supplier_positions = rng.choice(supplier_count, size=rows, p=weights / weights.sum())
+    accounts = 1_000_000 + supplier_positions
+    names = np.array(
+        [
+            f"PROVEEDOR {position} SPA" if position % 7 else f"SERVICIOS {position}/LTDA"
+            for position in range(supplier_count)
+        ]
+    )
+
+    classes = rng.choice(
+        list(DOCUMENT_CLASS_MIX), size=rows, p=list(DOCUMENT_CLASS_MIX.values())
+    )
+    amounts = -np.round(rng.lognormal(mean=14.5, sigma=1.3, size=rows))
+    note_mask = np.isin(classes, ["EC", "ED"])
+    amounts[note_mask] = np.round(amounts[note_mask] * rng.uniform(-0.3, 0.3, note_mask.sum()))
+    advance_mask = np.isin(classes, ["AB", "SA"])
+    positive_advance = advance_mask & (rng.random(rows) < 0.6)
+    amounts[positive_advance] = -amounts[positive_advance]
+
+    # Parte de los anticipos positivos replica proveedor e importe de una factura.
+    invoice_rows = np.flatnonzero(np.isin(classes, ["KR", "RE"]))
+    matching_rows = np.flatnonzero(positive_advance & (rng.random(rows) < MATCHING_ADVANCE_RATIO))
+    if len(invoice_rows) and len(matching_rows):
+        matched_invoices = rng.choice(invoice_rows, size=len(matching_rows))
+        accounts[matching_rows] = accounts[matched_invoices]
+        supplier_positions[matching_rows] = supplier_positions[matched_invoices]
+        amounts[matching_rows] = np.abs(amounts[matched_invoices])
+
+    document_dates = PAYROLL_DATE - pd.to_timedelta(rng.integers(0, 120, rows), unit="D")
+    due_dates = document_dates + pd.to_timedelta(rng.choice([0, 30, 60, 90], rows), unit="D")
+    posting_dates = document_dates + pd.to_timedelta(rng.integers(0, 6, rows), unit="D")
+    references = np.where(
+        rng.random(rows) < FACTORING_RATIO,
+        "FACTORING BANCO SUR",
+        np.char.add("F-", rng.integers(1, 999_999, rows).astype(str)),
+    )
+    payment_method = np.where(
+        rng.random(rows) < PAYMENT_METHOD_C_RATIO, "C", rng.choice(["T", ""], rows)
+    )
+
+    return pd.DataFrame(
+        {
+            "Icono part.abiertas/comp.": "",
+            "Cuenta": accounts,
+            "Nombre 1": names[supplier_positions],
+            "Clase de documento": classes,
+            "Nº documento": 5_100_000_000 + np.arange(rows, dtype="int64"),
+            "Referencia": references,
+            "Asignación": "",
+            "Fe.contabilización": posting_dates,
+            "Fecha de documento": document_dates,
+            "Vencimiento neto": due_dates,
+            "Símbolo vencimiento neto": "",
+            "Importe en moneda doc.": amounts,
+            "Moneda del documento": "CLP",
+            "Cta.contrapartida": "",
+            "Bloqueo de pago": np.where(rng.random(rows) < PAYMENT_BLOCK_RATIO, "A", ""),
+            "Vía de pago": payment_method,
+            "Doc.compensación": "",
+            "Nombre del usuario": "SAPBATCH",
+        }
+    )
+
+
+def generate_tesoreria(lista_pi: pd.DataFrame, seed: int = 0) -> pd.DataFrame:
+    """Genera la nómina de Tesorería con una parte de los proveedores de la Lista PI."""
+    rng = np.random.default_rng(seed + 1)
+    suppliers = lista_pi["Cuenta"].unique()
+    selected = rng.choice(
+        suppliers, size=max(1, int(len(suppliers) * TESORERIA_SUPPLIER_RATIO)), replace=False
+    )
+    return pd.DataFrame(
+        {
+            "Proveedor": selected,
+            "Nº documento de pago": 2_000_000_000 + np.arange(len(selected)),
+            "Importe pagado en ML": -np.round(rng.lognormal(16, 1.5, len(selected))),
+            "Fecha de pago": PAYROLL_DATE,
+            "Banco": "BANCO SUR",
+        }
+    )
+
+
+def write_sap_excel(df: pd.DataFrame, path: Path) -> None:
+    """Escribe un xlsx fila a fila, con memoria constante, como el reporte SAP."""
+    workbook = MODULE.new_export_workbook(str(path))
+    MODULE.write_creditor_sheet(workbook, "Sheet1", df, list(df.columns))
+    workbook.close()
+
+
+def ensure_benchmark_files(rows: int, data_dir: Path, seed: int) -> tuple[Path, Path]:
+    """Genera (una sola vez) los xlsx de Lista PI y Tesorería para un tamaño."""
+    data_dir.mkdir(parents=True, exist_ok=True)
+    lista_pi_path = data_dir / f"lista_pi_{rows}_{seed}.xlsx"
+    tesoreria_path = data_dir / f"tesoreria_{rows}_{seed}.xlsx"
+    if not lista_pi_path.exists() or not tesoreria_path.exists():
+        lista_pi = generate_lista_pi(rows, seed)
+        write_sap_excel(lista_pi, lista_pi_path)
+        write_sap_excel(generate_tesoreria(lista_pi, seed), tesoreria_path)
+    return lista_pi_path, tesoreria_path
+
+
+# --- Medición por etapa ---
+def time_stage(function, repeat: int):
+    """Ejecuta una etapa `repeat` veces; devuelve la mediana y el último resultado."""
+    timings = []
+    result = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = function()
+        timings.append(time.perf_counter() - started)
+    return statistics.median(timings), result
+
+
+def benchmark_size(rows: int, data_dir: Path, seed: int, repeat: int) -> dict:
+    """Mide cada etapa del proceso sobre los archivos sintéticos de un tamaño."""
+    lista_pi_path, tesoreria_path = ensure_benchmark_files(rows, data_dir, seed)
+    results = {}
+
+    def record(stage, function, rows_in):
+        seconds, result = time_stage(function, repeat)
+        rows_out = len(result[0] if isinstance(result, tuple) else result)
+        results[stage] = {"segundos": round(seconds, 4), "filas_entrada": rows_in, "filas_salida": rows_out}
+        return result
+
+    def load_without_cache():
+        MODULE.load_nomina_df.clear()
+        return MODULE.load_nomina_df(str(lista_pi_path))
+
+    record("load_nomina_df", load_without_cache, rows)
+    df_tesoreria = MODULE.load_tesoreria_df(str(tesoreria_path))
+    raw = MODULE.clean_names(generate_lista_pi(rows, seed))
+    raw = raw.astype({"cuenta": "Int64"}).drop(
+        columns=MODULE.COLUMNS_TO_DROP_NOMINA, errors="ignore"
+    )
+    raw = MODULE.apply_lista_pi_schema(raw)
+
+    eligible = record(
+        "filter_eligible_payment_documents",
+        lambda: MODULE.filter_eligible_payment_documents(raw),
+        len(raw),
+    )
+    df_nomina_base = MODULE.mark_factoring_references(eligible).drop(
+        columns=MODULE.COLUMNS_TO_DROP_NOMINA_POST_FILTER, errors="ignore"
+    )
+    propuesta = df_nomina_base[df_nomina_base["cuenta"].isin(df_tesoreria["cuenta"].unique())]
+    documentos_fecha = propuesta[propuesta["vencimiento_neto"].le(PAYROLL_DATE)]
+
+    payable, _, _ = record(
+        "validate_payment_risk",
+        lambda: MODULE.validate_payment_risk(documentos_fecha, advance_source=propuesta),
+        len(documentos_fecha),
+    )
+    con_calculos = record(
+        "process_nomina_data_dates",
+        lambda: MODULE.process_nomina_data_dates(payable, PAYROLL_DATE),
+        len(payable),
+    )
+    exportables = record(
+        "get_exportable_creditors",
+        lambda: MODULE.get_exportable_creditors(con_calculos),
+        len(con_calculos),
+    )
+    seconds, excel_bytes = time_stage(
+        lambda: MODULE.generate_excel_bytes(con_calculos, exportables), repeat
+    )
+    results["generate_excel_bytes"] = {
+        "segundos": round(seconds, 4),
+        "filas_entrada": len(con_calculos),
+        "filas_salida": len(excel_bytes),
+    }
+    seconds, csv_bytes = time_stage(
+        lambda: MODULE.generate_csv_gzip_bytes(con_calculos, exportables), repeat
+    )
+    results["generate_csv_gzip_bytes"] = {
+        "segundos": round(seconds, 4),
+        "filas_entrada": len(con_calculos),
+        "filas_salida": len(csv_bytes),
+    }
+    return results
+
+
+def get_commit() -> str:
+    """Commit actual del repositorio, si está disponible."""
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=MODULE_PATH.parent,
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "desconocido"
+
+
+def compare_results(current: dict, baseline: dict, tolerance: float) -> list[str]:
+    """Lista las etapas más lentas que la línea base por sobre la tolerancia."""
+    regressions = []
+    for size, stages in current["resultados"].items():
+        for stage, measurement in stages.items():
+            reference = baseline.get("resultados", {}).get(size, {}).get(stage)
+            if not reference or not reference["segundos"]:
+                continue
+            ratio = measurement["segundos"] / reference["segundos"]
+            print(
+                f"{size:>9} {stage:<36} {reference['segundos']:>9.3f} s "
+                f"-> {measurement['segundos']:>9.3f} s  x{ratio:.2f}"
+            )
+            if ratio > 1 + tolerance:
+                regressions.append(f"{size} {stage} x{ratio:.2f}")
+    return regressions
+
+
+def parse_args(argv: list[str] | None = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sizes", type=int, nargs="+", default=list(DEFAULT_SIZES))
+    parser.add_argument("--repeat", type=int, default=3, help="Repeticiones por etapa (mediana).")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--data-dir", type=Path, default=Path(".benchmark_data"))
+    parser.add_argument("--output", type=Path, help="JSON donde guardar los resultados.")
+    parser.add_argument("--compare", type=Path, help="JSON de línea base a comparar.")
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.2,
+        help="Aumento relativo de tiempo tolerado antes de informar una regresión.",
+    )
+    return parser.parse_args(argv)
+
+
+def main(argv: list[str] | None = None) -> int:
+    args = parse_args(argv)
+    # Se mide el trabajo real: sin caché en disco ni instantáneas.
+    os.environ[MODULE.DISK_CACHE_DIR_ENV_VAR] = ""
+    os.environ[MODULE.SNAPSHOT_DIR_ENV_VAR] = ""
+    current = {
+        "commit": get_commit(),
+        "python": platform.python_version(),
+        "pandas": pd.__version__,
+        "repeticiones": args.repeat,
+        "semilla": args.seed,
+        "resultados": {},
+    }
+    for rows in args.sizes:
+        current["resultados"][str(rows)] = benchmark_size(
+            rows, args.data_dir, args.seed, args.repeat
+        )
+        for stage, measurement in current["resultados"][str(rows)].items():
+            print(f"{rows:>9} {stage:<36} {measurement['segundos']:>9.3f} s")
+
+    if args.output:
+        args.output.write_text(json.dumps(current, indent=2, ensure_ascii=False) + "\n")
+    if args.compare:
+        regressions = compare_results(
+            current, json.loads(args.compare.read_text()), args.tolerance
+        )
+        if regressions:
+            print("Regresiones: " + "; ".join(regressions), file=sys.stderr)
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
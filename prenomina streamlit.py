@@ -2,24 +2,103 @@
 # coding: utf-8
 
 import streamlit as st
+import numpy as np
 import pandas as pd
+import argparse
+import bisect
+import concurrent.futures
+import contextlib
+import contextvars
+import cProfile
+import functools
+import gzip
+import hashlib
+import importlib.util
+import inspect
+import itertools
+import json
+import logging
+import multiprocessing
+import os
 import re
 import io
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+import zipfile
+from dataclasses import dataclass, field
 from datetime import date
 
+# Escritura de libros por acreedor; los procesos de la exportación ZIP la
+# importan por nombre. `streamlit run` no siempre agrega la carpeta del
+# script a sys.path, así que se agrega aquí para encontrar el módulo.
+_SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+if _SCRIPT_DIR not in sys.path:
+    sys.path.insert(0, _SCRIPT_DIR)
+
+from prenomina_export import (
+    EXCEL_DATE_FORMAT,
+    build_creditor_workbook,
+    get_creditor_workbook_name,
+    new_export_workbook,
+    write_creditor_sheet,
+)
+
+try:  # Sólo disponible en sistemas Unix.
+    import resource
+except ImportError:  # pragma: no cover - Windows
+    resource = None
+
+try:  # Motor de validación opcional; ver PRENOMINA_BACKEND.
+    import polars as pl
+except ImportError:  # pragma: no cover - depende de la instalación
+    pl = None
+
+
+def clean_column_name(column) -> str:
+    """Limpia un nombre de columna con las reglas de `clean_names`."""
+    column = str(column).strip().lower()
+    column = re.sub(r"[^0-9a-zA-Z]+", "_", column)
+    return re.sub(r"_+", "_", column).strip("_")
+
 
 def clean_names(df: pd.DataFrame) -> pd.DataFrame:
     """Limpia nombres de columnas sin depender de pyjanitor."""
-    df = df.copy()
-    df.columns = df.columns.str.strip().str.lower()
-    df.columns = [re.sub(r"[^0-9a-zA-Z]+", "_", col) for col in df.columns]
-    df.columns = [re.sub(r"_+", "_", col).strip("_") for col in df.columns]
-    return df
+    return df.set_axis([clean_column_name(col) for col in df.columns], axis=1)
 
 
 # --- Constantes ---
+# Mensajes de carga, caché, controles y resultados. La aplicación y la
+# ejecución por lotes los muestran en la consola.
+LOGGER = logging.getLogger("prenomina")
 EXCEL_FILENAME = "total_acreedores.xlsx"
+BLOCKED_REPORT_FILENAME = "facturas_bloqueadas.xlsx"
+RETAINED_REPORT_FILENAME = "documentos_retenidos.xlsx"
+DUPLICATE_REPORT_FILENAME = "posibles_duplicados.xlsx"
 EXCEL_MIME_TYPE = "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+ZIP_FILENAME = "acreedores_por_proveedor.zip"
+ZIP_MIME_TYPE = "application/zip"
+# Formatos para sistemas de pago: CSV gzip y Parquet particionado por acreedor.
+CSV_FILENAME = "total_acreedores.csv.gz"
+CSV_MIME_TYPE = "application/gzip"
+CSV_DATE_FORMAT = "%Y-%m-%d"
+PARQUET_DATASET_DIRNAME = "acreedores_parquet"
+PARQUET_DATASET_ZIP_FILENAME = "acreedores_parquet.zip"
+PARQUET_DATASET_MANIFEST = "_acreedores.json"
+EXPORT_CHUNK_ROWS = 50_000
+# Número de procesos para el ZIP por acreedor; por defecto, uno por núcleo.
+EXPORT_WORKERS_ENV_VAR = "PRENOMINA_EXPORT_WORKERS"
+# Lista PI de varias sociedades: una exportación SAP por sociedad, cargadas y
+# unidas. La sociedad sale de la columna SAP o del nombre del archivo.
+COMPANY_CODE_COLUMN = "sociedad"
+# Atributo (`DataFrame.attrs`) con las sociedades tomadas del nombre del archivo.
+# No identifican a la sociedad de una semana a otra: el registro de pagos las ignora.
+COMPANY_FROM_FILE_NAME_ATTR = "sociedades_por_nombre_de_archivo"
+# Hilos para cargar varias Listas PI; por defecto, uno (ver `get_load_workers`).
+LOAD_WORKERS_ENV_VAR = "PRENOMINA_LOAD_WORKERS"
 
 COLUMNS_TO_DROP_NOMINA = [
     "icono_part_abiertas_comp",
@@ -31,6 +110,126 @@ COLUMNS_TO_DROP_NOMINA = [
     "nombre_del_usuario",
 ]
 COLUMNS_TO_DROP_NOMINA_POST_FILTER = ["bloqueo_de_pago", "v_a_de_pago"]
+DATE_COLUMNS_NOMINA = ("fe_contabilizaci_n", "fecha_de_documento", "vencimiento_neto")
+# Esquema compacto de la Lista PI: texto de baja cardinalidad como categoría y
+# enteros del menor tamaño que contiene los valores.
+CATEGORY_COLUMNS_NOMINA = (
+    "clase_de_documento",
+    "tipo_de_documento",
+    "clase_documento",
+    "tipo_documento",
+    "nombre_1",
+    "referencia",
+    "bloqueo_de_pago",
+    "v_a_de_pago",
+    "sociedad",
+)
+# Una columna sólo pasa a categoría si sus valores distintos no superan esta
+# fracción de las filas; si no, la categoría ocupa más que el texto.
+CATEGORY_MAX_UNIQUE_RATIO = 0.5
+INTEGER_COLUMNS_NOMINA = ("cuenta", "n_documento")
+# Tesorería sólo aporta proveedor, documento de pago e importe pagado.
+TESORERIA_SOURCE_COLUMNS = frozenset(
+    {"proveedor", "cuenta", "n_documento_de_pago", "importe_pagado_en_ml"}
+)
+# Motor de lectura forzado por variable de entorno (p. ej. "openpyxl").
+EXCEL_ENGINE_ENV_VAR = "PRENOMINA_EXCEL_ENGINE"
+# Motor de las reglas de validación: pandas por defecto o polars (multihilo).
+VALIDATION_BACKEND_ENV_VAR = "PRENOMINA_BACKEND"
+DEFAULT_VALIDATION_BACKEND = "pandas"
+
+# Presupuesto de memoria del proceso en MB; sin valor no se controla. Una
+# lectura xlsx ocupa cerca de 20 veces el tamaño del archivo (benchmark).
+MEMORY_BUDGET_ENV_VAR = "PRENOMINA_MEMORY_BUDGET_MB"
+XLSX_MEMORY_EXPANSION = 20
+
+# Modo por particiones: la Lista PI se lee en bloques de filas y se reparte en
+# Parquet por cuenta % particiones, para validar archivos mayores que la RAM.
+STREAMING_CHUNK_ROWS = 200_000
+STREAMING_PARTITIONS = 64
+STREAMING_ROW_GROUP_ROWS = 20_000
+STREAMING_ROW_COLUMN = "fila_lista_pi"
+
+# Instantánea de la última Lista PI validada para la revalidación incremental.
+# Un directorio vacío en la variable de entorno la desactiva.
+SNAPSHOT_DIR_ENV_VAR = "PRENOMINA_SNAPSHOT_DIR"
+SNAPSHOT_DEFAULT_DIR = ".prenomina_snapshot"
+SNAPSHOT_KEY_COLUMNS = ["cuenta", "n_documento", "origen", "huella", "ocurrencia"]
+
+# Registro SQLite de los documentos ya pagados, para bloquear que un documento
+# se pague en otra nómina. Un valor vacío en la variable de entorno lo desactiva.
+PAID_LEDGER_ENV_VAR = "PRENOMINA_PAID_LEDGER"
+PAID_LEDGER_DEFAULT_PATH = ".prenomina_pagos.sqlite"
+PAID_LEDGER_BATCH_ROWS = 50_000
+PAID_LEDGER_STATUS = "PAGADO_EN_NOMINA_ANTERIOR"
+VALIDATION_PIPELINE_FUNCTIONS = (
+    "get_document_type_column",
+    "get_amount_column",
+    "get_document_classes",
+    "get_numeric_amounts",
+    "get_comparison_amounts",
+    "apply_to_text",
+    "normalize_document_text",
+    "_polars_text",
+    "build_advance_index",
+    "_pandas_advance_mask",
+    "_polars_advance_mask",
+    "match_advances_to_invoices",
+    "_pandas_match_advances",
+    "_polars_match_keys",
+    "_polars_match_advances",
+    "AmountPool",
+    "find_amount_combinations",
+    "_match_supplier_combinations",
+    "get_combination_keys",
+    "match_advance_combinations",
+    "add_document_control_columns",
+    "annotate_payment_risk",
+)
+
+# Caché en disco de la Lista PI y Tesorería ya limpias. Un directorio vacío
+# en la variable de entorno desactiva la caché.
+DISK_CACHE_DIR_ENV_VAR = "PRENOMINA_CACHE_DIR"
+DISK_CACHE_DEFAULT_DIR = ".prenomina_cache"
+DISK_CACHE_MAX_MB_ENV_VAR = "PRENOMINA_CACHE_MAX_MB"
+DISK_CACHE_DEFAULT_MAX_MB = 512
+# Incrementar cuando cambie una regla de limpieza que no esté en el código de
+# CLEANING_PIPELINE_FUNCTIONS ni en CLEANING_PIPELINE_CONSTANTS.
+CLEANING_PIPELINE_VERSION = 1
+CLEANING_PIPELINE_FUNCTIONS = (
+    "clean_column_name",
+    "clean_names",
+    "read_excel_pruned",
+    "clean_lista_pi",
+    "resolve_lista_pi_columns",
+    "add_normalized_document_columns",
+    "get_document_classes",
+    "get_document_type_column",
+    "get_numeric_amounts",
+    "get_amount_column",
+    "get_comparison_amounts",
+    "filter_eligible_payment_documents",
+    "_pandas_eligible_mask",
+    "_polars_eligible_mask",
+    "mark_factoring_references",
+    "_pandas_factoring_mask",
+    "_polars_factoring_mask",
+    "_polars_text",
+    "apply_lista_pi_schema",
+    "apply_to_text",
+    "normalize_document_text",
+)
+CLEANING_PIPELINE_CONSTANTS = (
+    "COLUMNS_TO_DROP_NOMINA",
+    "COLUMNS_TO_DROP_NOMINA_POST_FILTER",
+    "PAYMENT_CONTROL_COLUMNS",
+    "DATE_COLUMNS_NOMINA",
+    "TESORERIA_SOURCE_COLUMNS",
+    "DOCUMENT_TYPE_COLUMN_CANDIDATES",
+    "CATEGORY_COLUMNS_NOMINA",
+    "CATEGORY_MAX_UNIQUE_RATIO",
+    "INTEGER_COLUMNS_NOMINA",
+)
 PAYMENT_CONTROL_COLUMNS = ("bloqueo_de_pago", "v_a_de_pago")
 
 # Control preventivo de pagos duplicados por anticipos.
@@ -38,381 +237,4289 @@ DOCUMENT_TYPE_COLUMN_CANDIDATES = (
     "clase_de_documento", "tipo_de_documento", "clase_documento", "tipo_documento",
 )
 GENERIC_ACCOUNTING_DOCUMENT_TYPES = frozenset({"AB", "SA"})
+ADVANCE_MATCH_KEYS = ["cuenta", "monto_comparacion"]
+# Cruce por combinaciones: un anticipo que cubre varias facturas o varios
+# anticipos que cubren una factura. Entre muchos importes alguna suma coincide
+# por azar, así que sólo se combinan documentos de la misma sociedad con fecha
+# de documento a no más de COMBINATION_DATE_WINDOW_DAYS días, y de ellos los
+# COMBINATION_MAX_CANDIDATES más cercanos en fecha. Aun así, una suma no
+# prueba la compensación: la coincidencia queda en revisión manual, igual que
+# un proveedor que agota su tiempo de búsqueda o el tiempo total de la pasada.
+COMBINATION_MAX_DOCUMENTS = 3
+COMBINATION_DATE_COLUMN = "fecha_de_documento"
+COMBINATION_DATE_WINDOW_DAYS = 90
+COMBINATION_MAX_CANDIDATES = 20
+COMBINATION_REVIEW_STATUS = "REVISION_MANUAL_COMBINACION"
+COMBINATION_TIME_LIMIT_ENV_VAR = "PRENOMINA_COMBINATION_TIME_LIMIT_S"
+COMBINATION_DEFAULT_TIME_LIMIT_S = 10.0
+COMBINATION_TOTAL_TIME_LIMIT_ENV_VAR = "PRENOMINA_COMBINATION_TOTAL_TIME_LIMIT_S"
+COMBINATION_DEFAULT_TOTAL_TIME_LIMIT_S = 30.0
+# Posibles facturas duplicadas: mismo proveedor, importe dentro de la tolerancia
+# relativa, fechas de documento cercanas y referencia parecida. Sólo se
+# comparan facturas del mismo bloque (proveedor, tramo de importe, ventana de
+# fechas) o de bloques vecinos.
+DUPLICATE_AMOUNT_TOLERANCE = 0.01
+DUPLICATE_DATE_WINDOW_DAYS = 7
+DUPLICATE_MIN_REFERENCE_SIMILARITY = 0.8
+REFERENCE_BIGRAM_BUCKETS = 256
+DUPLICATE_SCORING_CHUNK_PAIRS = 20_000
+# Un proveedor cuyos bloques darían más pares que este tope (p. ej. miles de
+# facturas recurrentes del mismo importe y semana) se compara por ventana:
+# ordenadas por referencia, cada factura sólo con las siguientes.
+DUPLICATE_MAX_SUPPLIER_PAIRS = 500_000
+DUPLICATE_WINDOW_INVOICES = 50
+# Columnas con el resultado del cruce de anticipos para cada documento.
+VALIDATION_RESULT_COLUMNS = [
+    "estado_validacion",
+    "documentos_anticipo_relacionados",
+    "requiere_revision_manual",
+]
 MINIMUM_EXPORT_TOTAL_CLP = 10_000_000
 EXPORT_COLUMNS_TO_EXCLUDE = [
     "referencia_factoring",
+    "clase_documento_sap",
     "monto_comparacion",
     "es_anticipo_potencial",
     "estado_validacion",
     "documentos_anticipo_relacionados",
     "requiere_revision_manual",
 ]
+# Las tablas de la aplicación se envían al navegador por páginas.
+VIEW_PAGE_SIZES = (50, 100, 500, 1000)
+VIEW_DEFAULT_PAGE_SIZE = 100
+VIEW_SUMMARY = "Resumen por proveedor"
+VIEW_DETAIL = "Detalle por documento"
+
+
+# --- Instrumentación por etapa ---
+# Con PRENOMINA_PROFILE_DIR definido, cada ejecución deja un archivo .prof de
+# cProfile; con PRENOMINA_STAGE_LOG, los registros por etapa van a ese archivo.
+PROFILE_DIR_ENV_VAR = "PRENOMINA_PROFILE_DIR"
+STAGE_LOG_ENV_VAR = "PRENOMINA_STAGE_LOG"
+TRACE_MEMORY_ENV_VAR = "PRENOMINA_TRACE_MEMORY"
+STAGE_LOGGER = logging.getLogger("prenomina.etapas")
+_ACTIVE_INSTRUMENTATION = contextvars.ContextVar("prenomina_instrumentation", default=None)
+# Etapa de la carga cacheada en curso; `disk_cached` anota en ella de dónde
+# salió el resultado.
+_ACTIVE_LOAD_STAGE = contextvars.ContextVar("prenomina_load_stage", default=None)
+# tracemalloc es uno solo por proceso y lo comparten las sesiones y los
+# trabajos de fondo: lo inicia la primera instrumentación que mide memoria y
+# lo detiene la última. El pico sólo se reinicia si no hay otra etapa medida
+# abierta en otro hilo; si la hay, el pico registrado es una cota superior.
+_TRACEMALLOC_LOCK = threading.Lock()
+_tracemalloc_users = 0
+_tracemalloc_owned = False
+_open_traced_stages = 0
+
+
+class PipelineInstrumentation:
+    """Registra tiempo, filas y memoria pico de cada etapa de una ejecución.
+
+    Se activa con `activate()` en el hilo que ejecuta el proceso; las etapas
+    marcadas con `instrument_stage` dentro de ese contexto quedan en `stages`.
+    La memoria pico se mide con tracemalloc sólo si `trace_memory` es True,
+    porque el rastreo hace más lentas las etapas. En la aplicación, con varias
+    sesiones o trabajos midiendo a la vez, el pico es aproximado: incluye la
+    memoria de las etapas que corren en paralelo.
+    """
+
+    def __init__(self, trace_memory: bool = False):
+        self.trace_memory = trace_memory
+        self.stages = []
+        self.profile_path = None
+        self.job_profile_path = None
+        # Pila de etapas abiertas por hilo: la carga de archivos corre en paralelo.
+        self._open_stages = {}
+
+    @contextlib.contextmanager
+    def activate(self):
+        if self.trace_memory:
+            _acquire_tracemalloc()
+        profile_dir = os.environ.get(PROFILE_DIR_ENV_VAR, "").strip()
+        profiler = cProfile.Profile() if profile_dir else None
+        token = _ACTIVE_INSTRUMENTATION.set(self)
+        if profiler is not None:
+            profiler.enable()
+        try:
+            yield self
+        finally:
+            if profiler is not None:
+                profiler.disable()
+                os.makedirs(profile_dir, exist_ok=True)
+                self.profile_path = os.path.join(
+                    profile_dir, f"prenomina-{time.strftime('%Y%m%d-%H%M%S')}-{os.getpid()}.prof"
+                )
+                profiler.dump_stats(self.profile_path)
+            _ACTIVE_INSTRUMENTATION.reset(token)
+            if self.trace_memory:
+                _release_tracemalloc()
+
+    def include_job(self, job_instrumentation: "PipelineInstrumentation") -> None:
+        """Agrega las etapas y el perfil de un trabajo de fondo ya terminado."""
+        self.stages.extend(job_instrumentation.stages)
+        self.job_profile_path = job_instrumentation.profile_path
+
+    def to_frame(self) -> pd.DataFrame:
+        """Etapas registradas, en orden de término."""
+        return pd.DataFrame(
+            self.stages,
+            columns=[
+                "etapa", "segundos", "filas_entrada", "filas_salida", "memoria_pico_mb", "cache"
+            ],
+        )
+
+
+def _acquire_tracemalloc() -> None:
+    """Registra un usuario de tracemalloc y lo inicia si es el primero."""
+    global _tracemalloc_users, _tracemalloc_owned
+    with _TRACEMALLOC_LOCK:
+        if _tracemalloc_users == 0 and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            _tracemalloc_owned = True
+        _tracemalloc_users += 1
+
+
+def _release_tracemalloc() -> None:
+    """Libera un usuario de tracemalloc; el último detiene el rastreo que se inició aquí."""
+    global _tracemalloc_users, _tracemalloc_owned
+    with _TRACEMALLOC_LOCK:
+        _tracemalloc_users -= 1
+        if _tracemalloc_users == 0 and _tracemalloc_owned:
+            tracemalloc.stop()
+            _tracemalloc_owned = False
+
+
+@contextlib.contextmanager
+def instrument_stage(name: str, rows_in: int | None = None):
+    """Mide una etapa y la registra en la instrumentación activa y en el log.
+
+    Entrega un diccionario donde la etapa puede informar `filas_salida`.
+    """
+    global _open_traced_stages
+    report_stage(name)
+    instrumentation = _ACTIVE_INSTRUMENTATION.get()
+    tracing = (
+        instrumentation is not None
+        and instrumentation.trace_memory
+        and tracemalloc.is_tracing()
+    )
+    record = {"etapa": name, "filas_entrada": rows_in, "filas_salida": None}
+    if tracing:
+        open_stages = instrumentation._open_stages.setdefault(threading.get_ident(), [])
+        record["_pico_hijas"] = 0
+        with _TRACEMALLOC_LOCK:
+            # Sólo están abiertas las etapas de este hilo: se puede reiniciar
+            # el pico sin alterar la medición de otro trabajo.
+            if _open_traced_stages == len(open_stages):
+                if open_stages:
+                    parent = open_stages[-1]
+                    parent["_pico_hijas"] = max(
+                        parent["_pico_hijas"], tracemalloc.get_traced_memory()[1]
+                    )
+                tracemalloc.reset_peak()
+            _open_traced_stages += 1
+        open_stages.append(record)
+    started = time.perf_counter()
+    try:
+        yield record
+    finally:
+        record["segundos"] = round(time.perf_counter() - started, 4)
+        record["memoria_pico_mb"] = None
+        if tracing:
+            with _TRACEMALLOC_LOCK:
+                _open_traced_stages -= 1
+            open_stages.pop()
+            # Una etapa anidada reinicia el pico; se conserva el mayor.
+            peak = max(tracemalloc.get_traced_memory()[1], record.pop("_pico_hijas"))
+            if open_stages:
+                parent = open_stages[-1]
+                parent["_pico_hijas"] = max(parent["_pico_hijas"], peak)
+            record["memoria_pico_mb"] = round(peak / 1024**2, 1)
+        if instrumentation is not None:
+            instrumentation.stages.append(record)
+        STAGE_LOGGER.info(json.dumps(record, ensure_ascii=False, default=str))
+
+
+def instrument_cached_load(name: str):
+    """Registra una carga cacheada como etapa en cada llamada, también si sale de la caché.
+
+    Se aplica por fuera de `st.cache_data`, que en un acierto no ejecuta la
+    función. El registro lleva `cache`: "memoria" si respondió la caché de
+    Streamlit, "disco" si respondió `disk_cached` y "no" si se leyó el archivo.
+    """
+
+    def decorator(loader):
+        @functools.wraps(loader)
+        def wrapper(uploaded_file):
+            with instrument_stage(name) as stage:
+                stage["cache"] = "memoria"
+                token = _ACTIVE_LOAD_STAGE.set(stage)
+                try:
+                    result = loader(uploaded_file)
+                finally:
+                    _ACTIVE_LOAD_STAGE.reset(token)
+                stage["filas_salida"] = len(result)
+            return result
+
+        wrapper.clear = loader.clear
+        return wrapper
+
+    return decorator
+
+
+def configure_stage_logging() -> None:
+    """Envía los registros por etapa, una línea JSON cada uno, al destino configurado."""
+    if STAGE_LOGGER.handlers:
+        return
+    log_path = os.environ.get(STAGE_LOG_ENV_VAR, "").strip()
+    handler = logging.FileHandler(log_path) if log_path else logging.StreamHandler()
+    handler.setFormatter(logging.Formatter("%(message)s"))
+    STAGE_LOGGER.addHandler(handler)
+    STAGE_LOGGER.setLevel(logging.INFO)
+    STAGE_LOGGER.propagate = False
+
+
+def configure_console_logging() -> None:
+    """Muestra en stderr los mensajes del proceso, uno por línea."""
+    if LOGGER.handlers:
+        return
+    handler = logging.StreamHandler()
+    handler.setFormatter(logging.Formatter("%(message)s"))
+    LOGGER.addHandler(handler)
+    LOGGER.setLevel(logging.INFO)
+
+
+# --- Trabajo de fondo ---
+# La aplicación ejecuta la carga y la validación en un hilo de fondo para que
+# la página siga respondiendo; el avance se informa por etapa y el usuario
+# puede cancelar. Fuera de un trabajo (ejecución por lotes) todo es inmediato.
+BACKGROUND_WORKERS_ENV_VAR = "PRENOMINA_BACKGROUND_WORKERS"
+BACKGROUND_POLL_SECONDS = 0.5
+_ACTIVE_JOB = contextvars.ContextVar("prenomina_job", default=None)
+_BACKGROUND_EXECUTOR = None
+_BACKGROUND_EXECUTOR_LOCK = threading.Lock()
+
+
+class PipelineCancelled(Exception):
+    """El usuario canceló el procesamiento en curso."""
+
+
+def get_background_executor() -> concurrent.futures.ThreadPoolExecutor:
+    """Hilos compartidos por las sesiones para los trabajos de fondo."""
+    global _BACKGROUND_EXECUTOR
+    with _BACKGROUND_EXECUTOR_LOCK:
+        if _BACKGROUND_EXECUTOR is None:
+            configured = os.environ.get(BACKGROUND_WORKERS_ENV_VAR, "").strip()
+            _BACKGROUND_EXECUTOR = concurrent.futures.ThreadPoolExecutor(
+                max_workers=max(1, int(configured)) if configured else 4,
+                thread_name_prefix="prenomina",
+            )
+        return _BACKGROUND_EXECUTOR
+
+
+def submit_in_current_context(pool: concurrent.futures.Executor, function, *args):
+    """Envía `function` a `pool` con el contexto del hilo actual.
+
+    El hilo nuevo hereda el trabajo de fondo (avance y cancelación), la
+    instrumentación y la sesión de Streamlit del hilo que lo envía.
+    """
+    context = contextvars.copy_context()
+    job = _ACTIVE_JOB.get()
+
+    def run():
+        if job is not None:
+            job.attach_script_context()
+        return function(*args)
+
+    return pool.submit(context.run, run)
+
+
+class BackgroundJob:
+    """Procesamiento en un hilo de fondo con avance por etapa y cancelación.
+
+    `key` identifica las entradas del trabajo; la sesión lo conserva mientras
+    la clave no cambie. La cancelación es cooperativa: el trabajo se detiene
+    con `PipelineCancelled` al comenzar la siguiente etapa.
+    """
+
+    def __init__(self, key, trace_memory: bool = False):
+        self.key = key
+        self.instrumentation = PipelineInstrumentation(trace_memory)
+        self.cancel_event = threading.Event()
+        self.step = 0
+        self.total_steps = 1
+        self.step_label = ""
+        self.stage = None
+        self.future = None
+        self.script_context = None
+
+    def start(self, function, *args) -> "BackgroundJob":
+        from streamlit.runtime.scriptrunner import get_script_run_ctx
+
+        # Las funciones cacheadas de Streamlit esperan el contexto de la sesión.
+        self.script_context = get_script_run_ctx(suppress_warning=True)
+
+        def run():
+            self.attach_script_context()
+            _ACTIVE_JOB.set(self)
+            with self.instrumentation.activate():
+                return function(*args)
+
+        self.future = get_background_executor().submit(contextvars.Context().run, run)
+        return self
+
+    def attach_script_context(self) -> None:
+        if self.script_context is not None:
+            from streamlit.runtime.scriptrunner import add_script_run_ctx
+
+            add_script_run_ctx(threading.current_thread(), self.script_context)
+
+    def cancel(self) -> None:
+        self.cancel_event.set()
+        self.future.cancel()
+
+    def done(self) -> bool:
+        return self.future.done()
+
+    def result(self):
+        """Resultado del trabajo; relanza su error o `PipelineCancelled`."""
+        if self.future.cancelled():
+            raise PipelineCancelled()
+        return self.future.result()
+
+    def progress(self) -> tuple[float, str]:
+        """Fracción completada y descripción de la etapa en curso."""
+        text = self.step_label
+        if self.stage:
+            text = f"{text}: {self.stage}" if text else self.stage
+        return min(self.step / max(self.total_steps, 1), 1.0), text
+
+
+def report_progress(label: str, step: int, total_steps: int) -> None:
+    """Informa al trabajo activo el paso en curso; detiene si fue cancelado."""
+    job = _ACTIVE_JOB.get()
+    if job is None:
+        return
+    raise_if_cancelled()
+    job.step, job.total_steps, job.step_label, job.stage = step, total_steps, label, None
+
+
+def report_stage(name: str) -> None:
+    """Informa al trabajo activo la etapa que comienza; detiene si fue cancelado."""
+    job = _ACTIVE_JOB.get()
+    if job is not None:
+        raise_if_cancelled()
+        job.stage = name
+
+
+def raise_if_cancelled() -> None:
+    """Lanza `PipelineCancelled` si el trabajo activo fue cancelado."""
+    job = _ACTIVE_JOB.get()
+    if job is not None and job.cancel_event.is_set():
+        raise PipelineCancelled()
+
+
+# --- Lectura de Excel ---
+def _read_excel_with_pandas(source, usecols, engine: str) -> pd.DataFrame:
+    return pd.read_excel(source, engine=engine, usecols=usecols)
+
+
+def _read_excel_streaming(source, usecols) -> pd.DataFrame:
+    """Lee la primera hoja fila a fila con openpyxl en modo sólo lectura."""
+    return next(iter_excel_chunks(source, usecols, chunk_rows=None))
+
+
+def iter_excel_chunks(source, usecols=None, chunk_rows: int | None = STREAMING_CHUNK_ROWS):
+    """Entrega la primera hoja en bloques de `chunk_rows` filas.
+
+    Usa openpyxl en modo sólo lectura, por lo que la memoria depende del
+    tamaño del bloque y no del archivo. Con `chunk_rows=None` entrega un único
+    bloque. Siempre entrega al menos un bloque, aunque la hoja esté vacía.
+    """
+    from openpyxl import load_workbook
+
+    workbook = load_workbook(source, read_only=True, data_only=True)
+    try:
+        rows = workbook.worksheets[0].iter_rows(values_only=True)
+        header = next(rows, ())
+        positions = [
+            position
+            for position, column in enumerate(header)
+            if column is not None and (usecols is None or usecols(column))
+        ]
+        columns = [header[position] for position in positions]
+        records = []
+        yielded = False
+        for row in rows:
+            if not any(value is not None for value in row):
+                continue
+            records.append(
+                [row[position] if position < len(row) else None for position in positions]
+            )
+            if chunk_rows is not None and len(records) >= chunk_rows:
+                raise_if_cancelled()
+                yield pd.DataFrame.from_records(records, columns=columns)
+                records, yielded = [], True
+        if records or not yielded:
+            yield pd.DataFrame.from_records(records, columns=columns)
+    finally:
+        workbook.close()
+
+
+EXCEL_READERS = {
+    "calamine": lambda source, usecols: _read_excel_with_pandas(
+        source, usecols, "calamine"
+    ),
+    "openpyxl": lambda source, usecols: _read_excel_with_pandas(
+        source, usecols, "openpyxl"
+    ),
+    "openpyxl_streaming": _read_excel_streaming,
+}
+
+
+def get_excel_engine_order() -> list[str]:
+    """Motores de lectura a intentar, del más rápido al más conservador."""
+    forced_engine = os.environ.get(EXCEL_ENGINE_ENV_VAR, "").strip()
+    if forced_engine:
+        if forced_engine not in EXCEL_READERS:
+            raise ValueError(
+                f"Motor de lectura Excel desconocido en {EXCEL_ENGINE_ENV_VAR}: "
+                f"{forced_engine}. Opciones: {', '.join(EXCEL_READERS)}."
+            )
+        return [forced_engine]
+    engines = ["openpyxl", "openpyxl_streaming"]
+    if importlib.util.find_spec("python_calamine") is not None:
+        engines.insert(0, "calamine")
+    return engines
+
+
+def read_excel_pruned(source, keep_column=None) -> pd.DataFrame:
+    """Lee la primera hoja de un Excel leyendo sólo las columnas necesarias.
+
+    `keep_column` recibe el nombre limpio de cada columna y decide si se lee.
+    Se usa el motor más rápido instalado y, si falla, se recurre al siguiente
+    hasta la lectura fila a fila. Registra el tiempo de lectura de cada archivo.
+    """
+    skipped_columns = set()
+
+    def usecols(column) -> bool:
+        if keep_column is None or keep_column(clean_column_name(column)):
+            return True
+        skipped_columns.add(column)
+        return False
+
+    file_name = getattr(
+        source, "name", source if isinstance(source, (str, os.PathLike)) else "en memoria"
+    )
+    check_memory_budget(
+        f"lectura {file_name}", get_source_size_mb(source) * XLSX_MEMORY_EXPANSION
+    )
+    errors = []
+    for engine in get_excel_engine_order():
+        skipped_columns.clear()
+        if hasattr(source, "seek"):
+            source.seek(0)
+        started = time.perf_counter()
+        try:
+            df = EXCEL_READERS[engine](source, usecols)
+        except Exception as error:  # se intenta con el siguiente motor
+            errors.append(f"{engine}: {error}")
+            continue
+        if hasattr(source, "seek"):
+            # El archivo queda como se recibió: la caché de Streamlit lo
+            # identifica también por su posición de lectura.
+            source.seek(0)
+        LOGGER.info(
+            f"[carga] {file_name}: motor={engine} filas={len(df):,} "
+            f"columnas={len(df.columns)} omitidas={len(skipped_columns)} "
+            f"tiempo={time.perf_counter() - started:.2f} s"
+        )
+        return df
+    raise ValueError(f"No se pudo leer {file_name}: " + "; ".join(errors))
+
+
+# --- Caché en disco de datos limpios ---
+def get_file_content_hash(source) -> str:
+    """Calcula el hash del contenido de un archivo subido o de una ruta."""
+    digest = hashlib.blake2b(digest_size=20)
+    if hasattr(source, "getvalue"):
+        digest.update(source.getvalue())
+    elif hasattr(source, "read"):
+        source.seek(0)
+        digest.update(source.read())
+        source.seek(0)
+    else:
+        with open(source, "rb") as file:
+            for chunk in iter(lambda: file.read(1 << 20), b""):
+                digest.update(chunk)
+    return digest.hexdigest()
+
+
+def get_cleaning_pipeline_hash(loader) -> str:
+    """Resume el código y las constantes que determinan el resultado limpio.
+
+    Cambiar `clean_names`, `filter_eligible_payment_documents`, el propio
+    cargador o sus constantes produce otro hash e invalida la caché.
+    """
+    digest = hashlib.blake2b(digest_size=8)
+    digest.update(f"{CLEANING_PIPELINE_VERSION}|{pd.__version__}".encode())
+    for function in (loader, *(globals()[name] for name in CLEANING_PIPELINE_FUNCTIONS)):
+        try:
+            digest.update(inspect.getsource(function).encode())
+        except (OSError, TypeError):
+            digest.update(function.__qualname__.encode())
+    for name in CLEANING_PIPELINE_CONSTANTS:
+        value = globals()[name]
+        digest.update(repr(sorted(value) if isinstance(value, frozenset) else value).encode())
+    return digest.hexdigest()
+
+
+def get_disk_cache_dir() -> str | None:
+    """Directorio de la caché, o None si está desactivada o falta pyarrow."""
+    cache_dir = os.environ.get(DISK_CACHE_DIR_ENV_VAR, DISK_CACHE_DEFAULT_DIR).strip()
+    if not cache_dir or importlib.util.find_spec("pyarrow") is None:
+        return None
+    return cache_dir
+
+
+def evict_disk_cache(cache_dir: str, max_bytes: int) -> None:
+    """Elimina los archivos menos usados hasta respetar el tamaño máximo."""
+    entries = []
+    for entry in os.scandir(cache_dir):
+        if entry.is_file() and entry.name.endswith(".parquet"):
+            stat = entry.stat()
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+    total_bytes = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total_bytes <= max_bytes:
+            break
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        total_bytes -= size
+
+
+def disk_cached(kind: str):
+    """Guarda en Parquet el resultado limpio de un cargador de archivos.
+
+    La clave es el hash del contenido del archivo más el hash del pipeline de
+    limpieza. Al cambiar el pipeline se eliminan las entradas anteriores del
+    mismo tipo, y el directorio se mantiene bajo `PRENOMINA_CACHE_MAX_MB`
+    eliminando primero lo usado hace más tiempo.
+    """
+
+    def decorator(loader):
+        @functools.wraps(loader)
+        def wrapper(uploaded_file):
+            load_stage = _ACTIVE_LOAD_STAGE.get()
+            if load_stage is not None:
+                load_stage["cache"] = "no"
+            cache_dir = get_disk_cache_dir()
+            if cache_dir is None:
+                return loader(uploaded_file)
+
+            pipeline_hash = get_cleaning_pipeline_hash(loader)
+            file_name = f"{kind}-{get_file_content_hash(uploaded_file)}-{pipeline_hash}.parquet"
+            cache_path = os.path.join(cache_dir, file_name)
+            if os.path.exists(cache_path):
+                try:
+                    df = pd.read_parquet(cache_path)
+                except Exception as error:  # entrada corrupta: se regenera
+                    LOGGER.warning(f"[cache] {kind}: entrada ilegible, se regenera ({error})")
+                else:
+                    os.utime(cache_path)
+                    if load_stage is not None:
+                        load_stage["cache"] = "disco"
+                    LOGGER.info(f"[cache] {kind}: acierto {file_name}")
+                    return df
+
+            df = loader(uploaded_file)
+            os.makedirs(cache_dir, exist_ok=True)
+            # Sólo se eliminan entradas terminadas de otro pipeline: los .tmp
+            # pueden ser de una carga en curso en otro hilo o proceso.
+            for entry in os.scandir(cache_dir):
+                if (
+                    entry.name.startswith(f"{kind}-")
+                    and entry.name.endswith(".parquet")
+                    and not entry.name.endswith(f"-{pipeline_hash}.parquet")
+                ):
+                    try:
+                        os.remove(entry.path)
+                    except FileNotFoundError:  # otra carga ya la eliminó
+                        pass
+            temporary_path = f"{cache_path}.{os.getpid()}-{threading.get_ident()}.tmp"
+            try:
+                df.to_parquet(temporary_path)
+            except Exception as error:  # p. ej. columnas con tipos mixtos
+                LOGGER.warning(f"[cache] {kind}: no se pudo guardar ({error})")
+                if os.path.exists(temporary_path):
+                    os.remove(temporary_path)
+                return df
+            os.replace(temporary_path, cache_path)
+            max_mb = float(
+                os.environ.get(DISK_CACHE_MAX_MB_ENV_VAR, DISK_CACHE_DEFAULT_MAX_MB)
+            )
+            evict_disk_cache(cache_dir, int(max_mb * 1024 * 1024))
+            LOGGER.info(f"[cache] {kind}: guardado {file_name}")
+            return df
+
+        return wrapper
+
+    return decorator
+
+
+# --- Funciones de Carga y Limpieza de Datos ---
+def apply_to_text(series: pd.Series, transform) -> pd.Series:
+    """Aplica una transformación vectorizada de texto; los nulos llegan como "".
+
+    En columnas categóricas la transformación se aplica sólo a las categorías
+    y el resultado se expande con los códigos, sin recorrer cada fila.
+    """
+    if not isinstance(series.dtype, pd.CategoricalDtype):
+        return transform(series.fillna("").astype(str))
+    categories = pd.Series(series.cat.categories.astype(str))
+    transformed = transform(pd.concat([categories, pd.Series([""])], ignore_index=True))
+    codes = series.cat.codes.to_numpy()
+    # El código -1 (nulo) toma el último valor: la transformación de "".
+    return pd.Series(
+        transformed.to_numpy()[codes], index=series.index, name=series.name
+    )
+
+
+def normalize_document_text(series: pd.Series) -> pd.Series:
+    """Texto SAP sin espacios en los extremos y en mayúsculas."""
+    return apply_to_text(series, lambda text: text.str.strip().str.upper())
+
+
+def apply_lista_pi_schema(df: pd.DataFrame) -> pd.DataFrame:
+    """Aplica el esquema compacto de tipos a la Lista PI leída.
+
+    - texto de baja cardinalidad (clase de documento, nombre, referencia,
+      controles de pago) como `category`;
+    - cuenta y número de documento como el entero más pequeño que los contiene;
+    - importes enteros como `int64`; con decimales, `float64`. No se reducen:
+      `abs()` del mínimo de un entero reducido y las sumas por acreedor
+      desbordarían;
+    - fechas como `datetime64` normalizado (sin hora).
+
+    Devuelve un DataFrame nuevo; el recibido no se modifica.
+    """
+    df = df.copy(deep=False)
+    for column in CATEGORY_COLUMNS_NOMINA:
+        if column in df.columns and not isinstance(df[column].dtype, pd.CategoricalDtype):
+            if df[column].nunique() <= CATEGORY_MAX_UNIQUE_RATIO * len(df):
+                df[column] = df[column].astype("category")
+    for column in INTEGER_COLUMNS_NOMINA:
+        if column in df.columns:
+            df[column] = _downcast_integral(df[column])
+    for column in df.columns:
+        if column.startswith("importe_en_moneda"):
+            df[column] = _downcast_integral(
+                pd.to_numeric(df[column], errors="coerce"), smallest=False
+            )
+    # Fechas como datetime64 normalizado (sin hora) para operar vectorizado.
+    for column in DATE_COLUMNS_NOMINA:
+        if column in df.columns:
+            df[column] = pd.to_datetime(df[column], errors="coerce").dt.normalize()
+    return df
+
+
+def _downcast_integral(series: pd.Series, smallest: bool = True) -> pd.Series:
+    """Pasa a entero una columna numérica sin nulos ni decimales.
+
+    Con `smallest` se usa el entero más pequeño que contiene los valores; si
+    no, `int64`.
+    """
+    if not pd.api.types.is_numeric_dtype(series) or series.isna().any():
+        return series
+    values = series.to_numpy(dtype="float64")
+    if not np.array_equal(values, np.round(values)):
+        return series.astype("float64")
+    if not smallest:
+        return series.astype("int64")
+    downcast = "unsigned" if series.empty or series.min() >= 0 else "integer"
+    return pd.to_numeric(series.astype("int64"), downcast=downcast)
+
+
+def log_memory_report(stage: str, df: pd.DataFrame) -> None:
+    """Registra filas y memoria ocupada por un DataFrame en una etapa.
+
+    Medir la memoria recorre cada texto del DataFrame, por lo que sólo se hace
+    con la instrumentación de memoria activa. El presupuesto de memoria del
+    proceso se verifica siempre.
+    """
+    instrumentation = _ACTIVE_INSTRUMENTATION.get()
+    if instrumentation is not None and instrumentation.trace_memory:
+        megabytes = df.memory_usage(deep=True).sum() / 1024**2
+        LOGGER.info(f"[memoria] {stage}: filas={len(df):,} memoria={megabytes:,.1f} MB")
+    check_memory_budget(stage)
+
+
+class MemoryBudgetError(MemoryError):
+    """La ejecución superaría el presupuesto de memoria configurado."""
+
+
+def get_process_memory_mb() -> float | None:
+    """Memoria residente actual del proceso en MB, si el sistema la informa."""
+    try:
+        with open("/proc/self/statm") as statm:
+            resident_pages = int(statm.read().split()[1])
+        return resident_pages * os.sysconf("SC_PAGE_SIZE") / 1024**2
+    except (OSError, ValueError, IndexError, AttributeError):
+        if resource is None:
+            return None
+        # Sin /proc se usa el pico del proceso, una cota superior.
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def check_memory_budget(stage: str, additional_mb: float = 0.0) -> None:
+    """Falla con un mensaje claro si el proceso supera `PRENOMINA_MEMORY_BUDGET_MB`.
+
+    `additional_mb` es la memoria que la etapa aún va a necesitar, para
+    detenerse antes de empezarla en vez de quedar sin memoria a mitad.
+    """
+    configured = os.environ.get(MEMORY_BUDGET_ENV_VAR, "").strip()
+    if not configured:
+        return
+    budget_mb = float(configured)
+    current_mb = get_process_memory_mb()
+    if current_mb is None:
+        return
+    if current_mb + additional_mb > budget_mb:
+        estimate = f" + {additional_mb:,.0f} MB estimados" if additional_mb else ""
+        raise MemoryBudgetError(
+            f"La etapa '{stage}' supera el presupuesto de memoria: "
+            f"{current_mb:,.0f} MB en uso{estimate} > {budget_mb:,.0f} MB "
+            f"({MEMORY_BUDGET_ENV_VAR}). Use la ejecución por lotes con "
+            "--por-particiones o aumente el presupuesto."
+        )
+
+
+def get_source_size_mb(source) -> float:
+    """Tamaño en MB de un archivo subido o de una ruta."""
+    if hasattr(source, "size"):
+        return source.size / 1024**2
+    if hasattr(source, "getbuffer"):
+        return source.getbuffer().nbytes / 1024**2
+    return os.path.getsize(source) / 1024**2
+
+
+def filter_eligible_payment_documents(df: pd.DataFrame) -> pd.DataFrame:
+    """Conserva sólo partidas sin bloqueo A ni vía de pago C."""
+    missing_columns = [column for column in PAYMENT_CONTROL_COLUMNS if column not in df]
+    if missing_columns:
+        raise ValueError(
+            "La Lista PI no contiene columnas requeridas para validar la nómina: "
+            + ", ".join(missing_columns)
+        )
+
+    return df[get_validation_backend().eligible_mask(df)]
+
+
+def _pandas_eligible_mask(df: pd.DataFrame) -> pd.Series:
+    """Partidas sin bloqueo A ni vía de pago C."""
+    payment_block = normalize_document_text(df["bloqueo_de_pago"])
+    payment_method = normalize_document_text(df["v_a_de_pago"])
+    return payment_block.ne("A") & payment_method.ne("C")
+
+
+def mark_factoring_references(df: pd.DataFrame) -> pd.DataFrame:
+    """Marca documentos cedidos a una cuenta de factoring."""
+    return df.assign(referencia_factoring=get_validation_backend().factoring_mask(df))
+
+
+def _pandas_factoring_mask(df: pd.DataFrame) -> pd.Series:
+    """Referencias que contienen FACTORING, sin distinguir mayúsculas."""
+    return apply_to_text(
+        df.get("referencia", pd.Series("", index=df.index)),
+        lambda text: text.str.contains("FACTORING", case=False, na=False),
+    ).astype(bool)
+
+
+@instrument_cached_load("carga lista_pi")
+@st.cache_data
+@disk_cached("lista_pi")
+def load_nomina_df(uploaded_file):
+    """Carga y limpia el archivo de nómina (Lista PI Acreedores)."""
+    with instrument_stage("lectura lista_pi") as stage:
+        df = read_excel_pruned(
+            uploaded_file,
+            keep_column=lambda column: column not in COLUMNS_TO_DROP_NOMINA,
+        )
+        stage["filas_salida"] = len(df)
+    return clean_lista_pi(df)
+
+
+def clean_lista_pi(df: pd.DataFrame) -> pd.DataFrame:
+    """Limpia una Lista PI leída: nombres, tipos, elegibilidad y factoring.
+
+    Cada regla se aplica fila a fila, así que puede usarse tanto con el
+    archivo completo como con cada bloque del modo por particiones.
+    """
+    df = resolve_lista_pi_columns(clean_names(df))  # Limpia nombres de columnas
+    log_memory_report("lista_pi lectura", df)
+
+    # Filtrar y limpiar datos
+    df = (
+        df.astype({"cuenta": "Int64"})
+        .drop(columns=COLUMNS_TO_DROP_NOMINA, errors="ignore")
+        .dropna(subset=["cuenta"])
+    )
+    df = apply_lista_pi_schema(df)
+    log_memory_report("lista_pi esquema", df)
+    with instrument_stage("filter_eligible_payment_documents", len(df)) as stage:
+        df = filter_eligible_payment_documents(df)
+        stage["filas_salida"] = len(df)
+    df = mark_factoring_references(df)
+    df = add_normalized_document_columns(df)
+    df = df.drop(columns=COLUMNS_TO_DROP_NOMINA_POST_FILTER, errors="ignore")
+    log_memory_report("lista_pi limpia", df)
+
+    return df
+
+
+def resolve_lista_pi_columns(df: pd.DataFrame) -> pd.DataFrame:
+    """Renombra a su nombre canónico las columnas SAP que llegan con alias.
+
+    La clase de documento puede venir como cualquiera de
+    `DOCUMENT_TYPE_COLUMN_CANDIDATES` y el importe como una única columna
+    `importe_en_moneda*`; desde la carga, todas las etapas usan
+    `clase_de_documento` e `importe_en_moneda_doc`.
+    """
+    renames = {}
+    type_columns = [column for column in DOCUMENT_TYPE_COLUMN_CANDIDATES if column in df.columns]
+    if type_columns and type_columns[0] != DOCUMENT_TYPE_COLUMN_CANDIDATES[0]:
+        renames[type_columns[0]] = DOCUMENT_TYPE_COLUMN_CANDIDATES[0]
+    amount_columns = [column for column in df.columns if column.startswith("importe_en_moneda")]
+    if len(amount_columns) == 1 and amount_columns[0] != "importe_en_moneda_doc":
+        renames[amount_columns[0]] = "importe_en_moneda_doc"
+    return df.rename(columns=renames) if renames else df
+
+
+def add_normalized_document_columns(df: pd.DataFrame) -> pd.DataFrame:
+    """Agrega una sola vez las columnas derivadas que usan las etapas de control.
+
+    - `clase_documento_sap`: clase de documento sin espacios y en mayúsculas,
+      como categoría;
+    - `monto_comparacion`: importe absoluto redondeado, clave del cruce de
+      anticipos.
+    """
+    return df.assign(
+        clase_documento_sap=get_document_classes(df).astype("category"),
+        monto_comparacion=get_comparison_amounts(df),
+    )
+
+
+@st.cache_resource
+def load_nomina_supplier_index(uploaded_file) -> "SupplierIndex":
+    """Índice por proveedor de la Lista PI cargada, cacheado junto al archivo.
+
+    Se guarda como recurso compartido y no como copia: el índice es de sólo
+    lectura y copiarlo en cada ejecución costaría tanto como construirlo.
+    """
+    return build_supplier_index(load_nomina_df(uploaded_file))
+
+
+def get_load_workers() -> int:
+    """Hilos para cargar varias Listas PI; uno si no se indica en la variable de entorno.
+
+    Leer un xlsx es Python puro y retiene el GIL, así que más hilos no acortan
+    la primera carga. Sólo ayudan cuando las Listas PI salen de la caché en
+    disco, cuya lectura de parquet sí libera el GIL.
+    """
+    configured = os.environ.get(LOAD_WORKERS_ENV_VAR, "").strip()
+    return max(1, int(configured)) if configured else 1
+
+
+def get_company_code(name) -> str:
+    """Sociedad asignada a un archivo: su nombre sin carpeta ni extensión."""
+    return os.path.splitext(os.path.basename(str(name)))[0].strip()
+
+
+def assign_company_code(df: pd.DataFrame, company: str) -> pd.DataFrame:
+    """Agrega `sociedad` como texto; si el archivo ya la trae, sólo completa los vacíos."""
+    if COMPANY_CODE_COLUMN not in df.columns:
+        return df.assign(**{COMPANY_CODE_COLUMN: company})
+    codes = df[COMPANY_CODE_COLUMN]
+    if pd.api.types.is_float_dtype(codes):
+        try:
+            codes = codes.astype("Int64")  # 1000.0 → "1000"
+        except (TypeError, ValueError):
+            pass
+    return df.assign(
+        **{COMPANY_CODE_COLUMN: codes.astype("string").fillna(company).astype(object)}
+    )
+
+
+def merge_lista_pi_frames(frames) -> pd.DataFrame:
+    """Une Listas PI limpias de varias sociedades en un solo universo.
+
+    `frames` son pares (sociedad, DataFrame) en el orden de carga. Una fila
+    que aparece en más de un archivo con la misma sociedad y el mismo
+    contenido se conserva una vez; las repeticiones dentro de un mismo archivo
+    se mantienen, igual que al cargar un solo archivo. El resultado tiene un
+    índice nuevo y el esquema compacto de `apply_lista_pi_schema`. Las
+    sociedades que salen del nombre del archivo quedan en
+    `attrs[COMPANY_FROM_FILE_NAME_ATTR]`.
+    """
+    labelled = [assign_company_code(df, company) for company, df in frames]
+    named_companies = sorted(
+        {
+            company
+            for company, df in frames
+            if COMPANY_CODE_COLUMN not in df.columns or df[COMPANY_CODE_COLUMN].isna().any()
+        }
+    )
+    # Categorías distintas por archivo no se unen: se pasa a texto y se vuelve.
+    categorical = {
+        column
+        for df in labelled
+        for column in df.columns
+        if isinstance(df[column].dtype, pd.CategoricalDtype)
+    }
+    merged = pd.concat(
+        [
+            df.astype({column: object for column in categorical if column in df.columns})
+            for df in labelled
+        ],
+        ignore_index=True,
+    )
+    rows = pd.DataFrame(
+        {
+            "archivo": np.repeat(np.arange(len(labelled)), [len(df) for df in labelled]),
+            "huella": pd.util.hash_pandas_object(
+                merged[sorted(merged.columns)], index=False
+            ).to_numpy(),
+        }
+    )
+    rows["ocurrencia"] = rows.groupby(["archivo", "huella"], sort=False).cumcount()
+    duplicated = rows.duplicated(["huella", "ocurrencia"]).to_numpy()
+    merged = merged.loc[~duplicated].reset_index(drop=True)
+    merged = apply_lista_pi_schema(
+        merged.astype({column: "category" for column in categorical})
+    )
+    merged.attrs[COMPANY_FROM_FILE_NAME_ATTR] = named_companies
+    LOGGER.info(
+        f"[carga] listas_pi={len(labelled)} filas={len(merged):,} "
+        f"duplicadas_descartadas={int(duplicated.sum()):,}"
+    )
+    log_memory_report("lista_pi unida", merged)
+    return merged
+
+
+def load_lista_pi_files(sources, names=None) -> pd.DataFrame:
+    """Carga las Listas PI de una o varias sociedades.
+
+    Cada archivo pasa por `load_nomina_df` (con sus cachés), en los hilos que
+    indique `get_load_workers`. La sociedad de cada uno sale de `names` (o de
+    la ruta) cuando el archivo no trae la columna. Un solo archivo se devuelve
+    tal cual; varios se unen con `merge_lista_pi_frames`.
+    Un archivo repetido con el mismo nombre y el mismo contenido se carga una
+    sola vez; con otro nombre es otra sociedad y se conserva.
+    """
+    sources = list(sources)
+    if names is None:
+        names = [getattr(source, "name", source) for source in sources]
+    if len(sources) == 1:
+        return load_nomina_df(sources[0])
+    unique = {}
+    companies_by_content = {}
+    for source, name in zip(sources, names):
+        content_hash = get_file_content_hash(source)
+        unique.setdefault((get_company_code(name), content_hash), (source, name))
+        companies_by_content.setdefault(content_hash, set()).add(get_company_code(name))
+    if len(unique) < len(sources):
+        LOGGER.warning(f"[carga] se omiten {len(sources) - len(unique)} Lista(s) PI repetida(s)")
+    for companies in companies_by_content.values():
+        if len(companies) > 1:
+            LOGGER.warning(
+                f"[carga] las Listas PI {', '.join(sorted(companies))} tienen el mismo "
+                "contenido; se cargan como sociedades distintas"
+            )
+    with concurrent.futures.ThreadPoolExecutor(
+        max_workers=min(len(unique), get_load_workers()),
+        thread_name_prefix="prenomina-lista-pi",
+    ) as pool:
+        futures = [
+            (name, submit_in_current_context(pool, load_nomina_df, source))
+            for source, name in unique.values()
+        ]
+        frames = [(get_company_code(name), future.result()) for name, future in futures]
+    return merge_lista_pi_frames(frames)
+
+
+@instrument_cached_load("carga tesoreria")
+@st.cache_data
+@disk_cached("tesoreria")
+def load_tesoreria_df(uploaded_file):
+    """Carga y limpia el archivo de Tesorería."""
+    with instrument_stage("lectura tesoreria") as stage:
+        df_tes = read_excel_pruned(
+            uploaded_file,
+            keep_column=TESORERIA_SOURCE_COLUMNS.__contains__,
+        )
+        stage["filas_salida"] = len(df_tes)
+    df_tes = df_tes.rename(columns={"Proveedor": "cuenta"})
+    df_tes = clean_names(df_tes)  # Aplicar clean_names después del rename
+
+    # Usar nombres de columna limpios por janitor
+    # 'nº_documento_de_pago' -> 'n_documento_de_pago'
+    # 'importe_pagado_en_ml' ya está limpio
+    df_tes = df_tes.dropna(subset=["n_documento_de_pago"])
+    df_tes["importe_pagado_en_ml"] = pd.to_numeric(
+        df_tes["importe_pagado_en_ml"], errors="coerce"
+    )
+    df_tes = df_tes.dropna(subset=["importe_pagado_en_ml"])
+    # Los $10 MM son prioridad de revisión, no un filtro de exclusión.
+    df_tes["prioridad_monto"] = df_tes["importe_pagado_en_ml"].abs().ge(10_000_000)
+    df_tes = df_tes.sort_values(
+        by=["prioridad_monto", "importe_pagado_en_ml"],
+        ascending=[False, True],
+    )[["cuenta", "importe_pagado_en_ml", "prioridad_monto"]]
+    # Asegurar que 'cuenta' en tesorería también sea Int64 para consistencia
+    if "cuenta" in df_tes.columns:
+        try:
+            df_tes["cuenta"] = df_tes["cuenta"].astype("Int64")
+        except (ValueError, TypeError) as error:
+            raise ValueError(
+                "No se pudo convertir la columna 'cuenta' de Tesorería a tipo numérico entero. Verifique que la columna 'Proveedor' contiene solo valores numéricos."
+            ) from error
+    return df_tes
+
+
+# --- Funciones de Procesamiento ---
+def get_document_type_column(df: pd.DataFrame) -> str:
+    """Obtiene la columna SAP que contiene la clase de documento."""
+    for column in DOCUMENT_TYPE_COLUMN_CANDIDATES:
+        if column in df.columns:
+            return column
+    raise ValueError("No se encontró la columna de clase de documento SAP.")
+
+
+def get_amount_column(df: pd.DataFrame) -> str:
+    """Obtiene la columna de importe de la Lista PI."""
+    candidates = [column for column in df.columns if column.startswith("importe_en_moneda")]
+    if len(candidates) != 1:
+        raise ValueError("No se pudo identificar de forma unívoca la columna de importe.")
+    return candidates[0]
+
+
+@dataclass
+class SupplierIndex:
+    """Posiciones de fila, nombre y total por proveedor de un DataFrame.
+
+    Se construye con una sola agrupación por `cuenta` y lo consumen el filtro
+    por Tesorería, los totales exportables y el plan de hojas, sin volver a
+    recorrer el DataFrame. Las posiciones valen sólo para el DataFrame con que
+    se construyó, o uno con las mismas etiquetas de fila en el mismo orden.
+    Es de sólo lectura: la aplicación lo comparte entre ejecuciones.
+    """
+
+    positions: dict
+    names: dict
+    totals: pd.Series
+    rows: int
+    index: pd.Index
+
+    def matches(self, df: pd.DataFrame) -> bool:
+        """Indica si las posiciones del índice valen para `df`."""
+        return len(df) == self.rows and (
+            df.index is self.index or df.index.equals(self.index)
+        )
+
+    def take(self, df: pd.DataFrame, cuentas) -> pd.DataFrame:
+        """Filas de `cuentas` en el orden original del DataFrame."""
+        if not self.matches(df):
+            raise ValueError("El índice de proveedores no corresponde al DataFrame.")
+        selected = [self.positions[cuenta] for cuenta in cuentas if cuenta in self.positions]
+        if not selected:
+            return df.iloc[[]]
+        return df.iloc[np.sort(np.concatenate(selected))]
+
+
+def build_supplier_index(df: pd.DataFrame) -> SupplierIndex:
+    """Indexa un DataFrame por `cuenta`: posiciones, primer nombre y total."""
+    groups = df.groupby("cuenta")
+    positions = groups.indices
+    amount_column = "importe_en_moneda_doc"
+    totals = (
+        groups[amount_column].sum()
+        if amount_column in df.columns
+        else pd.Series(dtype="float64", name=amount_column)
+    )
+    names = {}
+    if "nombre_1" in df.columns:
+        raw_names = df["nombre_1"].to_numpy(dtype=object)
+        names = {cuenta: raw_names[rows[0]] for cuenta, rows in positions.items()}
+    return SupplierIndex(
+        positions=positions, names=names, totals=totals, rows=len(df), index=df.index
+    )
+
+
+def get_document_classes(df: pd.DataFrame) -> pd.Series:
+    """Clase de documento normalizada: la calculada en la carga o, si falta, ahora."""
+    if "clase_documento_sap" in df.columns:
+        return df["clase_documento_sap"]
+    return normalize_document_text(df[get_document_type_column(df)])
+
+
+def get_numeric_amounts(df: pd.DataFrame) -> pd.Series:
+    """Importe como número; la carga ya lo deja numérico y no se vuelve a convertir."""
+    amounts = df[get_amount_column(df)]
+    if pd.api.types.is_numeric_dtype(amounts):
+        return amounts
+    return pd.to_numeric(amounts, errors="coerce")
+
+
+def get_comparison_amounts(df: pd.DataFrame) -> pd.Series:
+    """Importe absoluto redondeado usado como clave del cruce de anticipos."""
+    if "monto_comparacion" in df.columns:
+        return df["monto_comparacion"]
+    return get_numeric_amounts(df).abs().round(0)
+
+
+def build_advance_index(source_df: pd.DataFrame) -> pd.DataFrame:
+    """Indexa los anticipos AB/SA positivos por proveedor e importe absoluto.
+
+    Devuelve una fila por anticipo con la clave de cruce
+    (`cuenta`, `monto_comparacion`), su número de documento y su índice en la
+    Lista PI de origen. La fecha de documento y la sociedad, si la Lista PI
+    las trae, acotan el cruce por combinaciones.
+    """
+    advance_mask = get_validation_backend().advance_mask(source_df)
+    advances = pd.DataFrame(
+        {
+            "cuenta": source_df.loc[advance_mask, "cuenta"],
+            "monto_comparacion": get_comparison_amounts(source_df)[advance_mask],
+            "n_documento_anticipo": source_df.loc[advance_mask, "n_documento"].astype(str),
+            "indice_anticipo": source_df.index[advance_mask],
+        }
+    )
+    for column in (COMBINATION_DATE_COLUMN, COMPANY_CODE_COLUMN):
+        if column in source_df.columns:
+            advances[column] = source_df.loc[advance_mask, column]
+    return advances.dropna(subset=ADVANCE_MATCH_KEYS)
+
+
+def _pandas_advance_mask(source_df: pd.DataFrame) -> pd.Series:
+    """Filas AB/SA con importe positivo."""
+    document_types = get_document_classes(source_df)
+    amounts = get_numeric_amounts(source_df)
+    # Sólo un AB/SA contabilizado en positivo representa un anticipo ya
+    # pagado; uno en negativo no acredita que no exista deuda con el acreedor.
+    return document_types.isin(GENERIC_ACCOUNTING_DOCUMENT_TYPES) & amounts.gt(0)
+
+
+def match_advances_to_invoices(
+    advance_index: pd.DataFrame,
+    invoices: pd.DataFrame,
+) -> tuple[pd.Series, pd.Index]:
+    """Cruza facturas con anticipos por (`cuenta`, `monto_comparacion`).
+
+    Los anticipos se agregan a una fila por clave antes del cruce, de modo que
+    el resultado crece con el número de facturas y no con el producto de
+    facturas por anticipos del proveedor. Devuelve los documentos de anticipo
+    relacionados por índice de factura y los índices de anticipo que
+    coincidieron con alguna factura.
+    """
+    return get_validation_backend().match_advances(advance_index, invoices)
+
+
+def _pandas_match_advances(
+    advance_index: pd.DataFrame, invoices: pd.DataFrame
+) -> tuple[pd.Series, pd.Index]:
+    advance_references = (
+        advance_index.drop_duplicates(ADVANCE_MATCH_KEYS + ["n_documento_anticipo"])
+        .sort_values("n_documento_anticipo", kind="stable")
+        .groupby(ADVANCE_MATCH_KEYS, sort=False)["n_documento_anticipo"]
+        .agg(", ".join)
+        .rename("documentos_anticipo_relacionados")
+        .reset_index()
+    )
+    invoice_keys = invoices[ADVANCE_MATCH_KEYS].dropna()
+    matched_invoices = (
+        invoice_keys.reset_index(names="indice_factura")
+        .merge(advance_references, on=ADVANCE_MATCH_KEYS, how="inner")
+        .set_index("indice_factura")["documentos_anticipo_relacionados"]
+    )
+    matched_advances = advance_index.merge(
+        invoice_keys.drop_duplicates(), on=ADVANCE_MATCH_KEYS, how="inner"
+    )["indice_anticipo"]
+    return matched_invoices, pd.Index(matched_advances)
+
+
+class CombinationSearchTimeout(TimeoutError):
+    """La búsqueda de combinaciones de un proveedor superó su tiempo límite."""
+
+
+def get_combination_time_limit() -> float:
+    """Segundos de búsqueda de combinaciones por proveedor."""
+    configured = os.environ.get(COMBINATION_TIME_LIMIT_ENV_VAR, "").strip()
+    return max(0.0, float(configured)) if configured else COMBINATION_DEFAULT_TIME_LIMIT_S
+
+
+def get_combination_total_time_limit() -> float:
+    """Segundos de búsqueda de combinaciones para todos los proveedores juntos."""
+    configured = os.environ.get(COMBINATION_TOTAL_TIME_LIMIT_ENV_VAR, "").strip()
+    return (
+        max(0.0, float(configured)) if configured else COMBINATION_DEFAULT_TOTAL_TIME_LIMIT_S
+    )
+
+
+@dataclass
+class AmountPool:
+    """Importes de mayor a menor con los índices que usa la búsqueda de combinaciones.
+
+    Se construye una vez por lado y proveedor y se reutiliza para cada importe
+    buscado mientras no cambien los documentos libres.
+    """
+
+    amounts: list[int]
+    ascending: list[int] = field(init=False)
+    prefix: list[int] = field(init=False)
+
+    def __post_init__(self) -> None:
+        self.ascending = self.amounts[::-1]
+        # prefix[i] es la suma de amounts[:i]: lo máximo alcanzable con k
+        # importes desde la posición i es prefix[i + k] - prefix[i].
+        self.prefix = list(itertools.accumulate(self.amounts, initial=0))
+
+    def first_at_most(self, amount: int) -> int:
+        """Primera posición cuyo importe no supera `amount`."""
+        return len(self.amounts) - bisect.bisect_right(self.ascending, amount)
+
+    def occurrences(self, amount: int) -> int:
+        """Cantidad de documentos con exactamente `amount`."""
+        return bisect.bisect_right(self.ascending, amount) - bisect.bisect_left(
+            self.ascending, amount
+        )
+
+    def has_interchangeable(self, positions: list[int]) -> bool:
+        """Indica si otro documento libre con igual importe cabe en el grupo.
+
+        La búsqueda no repite ramas con el mismo importe, así que un grupo
+        único por importe puede corresponder a varios grupos de documentos.
+        """
+        chosen = [self.amounts[position] for position in positions]
+        return any(self.occurrences(amount) > chosen.count(amount) for amount in set(chosen))
+
+
+def find_amount_combinations(
+    pool: AmountPool,
+    target: int,
+    deadline: float,
+    max_items: int = COMBINATION_MAX_DOCUMENTS,
+    limit: int = 2,
+) -> list[list[int]]:
+    """Busca grupos de 2 a `max_items` importes de `pool` que sumen `target`.
+
+    La búsqueda en profundidad salta los importes mayores que el saldo
+    pendiente, corta la rama cuando los siguientes importes no alcanzan a
+    cubrirlo, no repite ramas con el mismo importe y resuelve los dos últimos
+    lugares con una búsqueda binaria del complemento. Se detiene al encontrar
+    `limit` grupos; con el valor por omisión, dos grupos bastan para saber que
+    la coincidencia es ambigua. Como los importes repetidos no abren ramas
+    nuevas, un único grupo sólo identifica documentos si
+    `AmountPool.has_interchangeable` es falso. Devuelve las posiciones de cada
+    grupo y lanza `CombinationSearchTimeout` al superar `deadline`
+    (`time.perf_counter()`).
+    """
+    amounts, prefix = pool.amounts, pool.prefix
+    count = len(amounts)
+    chosen = []
+    combinations = []
+
+    def found(*positions: int) -> bool:
+        combinations.append(chosen + list(positions))
+        return len(combinations) >= limit
+
+    def search(start: int, remaining: int, slots: int) -> bool:
+        if time.perf_counter() > deadline:
+            raise CombinationSearchTimeout
+        previous = None
+        for position in range(max(start, pool.first_at_most(remaining)), count):
+            amount = amounts[position]
+            if amount == previous:
+                continue
+            previous = amount
+            if prefix[min(count, position + slots)] - prefix[position] < remaining:
+                return False
+            if amount == remaining:
+                # Un solo documento es el cruce uno a uno, ya resuelto antes.
+                if chosen and found(position):
+                    return True
+            elif slots == 2:
+                complement = remaining - amount
+                if complement > amount:
+                    return False
+                partner = max(position + 1, pool.first_at_most(complement))
+                if partner < count and amounts[partner] == complement and found(
+                    position, partner
+                ):
+                    return True
+            else:
+                chosen.append(position)
+                if search(position + 1, remaining - amount, slots - 1):
+                    return True
+                chosen.pop()
+        return False
+
+    if target > 0:
+        search(0, target, max_items)
+    return combinations
+
+
+@dataclass
+class SupplierCombinations:
+    """Resultado del cruce por combinaciones de un proveedor, por índice de documento."""
+
+    facturas: dict = field(default_factory=dict)
+    anticipos: list = field(default_factory=list)
+    facturas_revision: list = field(default_factory=list)
+    anticipos_revision: list = field(default_factory=list)
+    ambiguas: int = 0
+    agoto_tiempo: bool = False
+
+
+def _match_supplier_combinations(
+    advances: pd.DataFrame,
+    invoices: pd.DataFrame,
+    deadline: float,
+) -> SupplierCombinations:
+    """Resuelve las combinaciones de anticipos y facturas de un proveedor y sociedad.
+
+    Ambos lados traen `monto_comparacion` y `dia` (día del documento; NaN sin
+    fecha). Cada búsqueda usa, de los `COMBINATION_MAX_CANDIDATES` documentos
+    del otro lado más cercanos en fecha, los libres a no más de
+    `COMBINATION_DATE_WINDOW_DAYS` días; un documento sin fecha no se combina.
+    Sólo una combinación única cuenta: si hay más de una, o si otro documento
+    libre con el mismo importe podría reemplazar a uno del grupo, el importe
+    no identifica los documentos. Si se agota el tiempo, pasan a revisión
+    manual los anticipos aún libres y las facturas que ellos podrían cubrir.
+    """
+    advances = advances.sort_values(
+        ["monto_comparacion", "n_documento_anticipo"], ascending=[False, True], kind="stable"
+    )
+    invoices = invoices.sort_values("monto_comparacion", ascending=False, kind="stable")
+    advance_ids = advances["indice_anticipo"].tolist()
+    advance_documents = advances["n_documento_anticipo"].tolist()
+    advance_amounts = advances["monto_comparacion"].to_numpy(dtype="int64")
+    advance_days = advances["dia"].to_numpy(dtype="float64")
+    invoice_ids = invoices.index.tolist()
+    invoice_amounts = invoices["monto_comparacion"].to_numpy(dtype="int64")
+    invoice_days = invoices["dia"].to_numpy(dtype="float64")
+    free_advances = np.ones(len(advance_ids), dtype=bool)
+    free_invoices = np.ones(len(invoice_ids), dtype=bool)
+    # Posiciones (en orden de importe) ordenadas por día, para ubicar la ventana.
+    advances_by_day = np.argsort(advance_days, kind="stable")
+    invoices_by_day = np.argsort(invoice_days, kind="stable")
+
+    def candidates(by_day, days, free, day) -> np.ndarray:
+        # Posiciones libres de la ventana, de mayor a menor importe.
+        if np.isnan(day):
+            return by_day[:0]
+        middle = np.searchsorted(days[by_day], day)
+        nearby = by_day[
+            max(0, middle - COMBINATION_MAX_CANDIDATES):middle + COMBINATION_MAX_CANDIDATES
+        ]
+        distances = np.abs(days[nearby] - day)
+        if len(nearby) > COMBINATION_MAX_CANDIDATES:
+            nearest = np.argsort(distances, kind="stable")[:COMBINATION_MAX_CANDIDATES]
+            nearby, distances = nearby[nearest], distances[nearest]
+        return np.sort(nearby[free[nearby] & (distances <= COMBINATION_DATE_WINDOW_DAYS)])
+
+    def unique_combination(pool: AmountPool, target: int, result: SupplierCombinations):
+        combinations = find_amount_combinations(pool, target, deadline)
+        if len(combinations) > 1 or (combinations and pool.has_interchangeable(combinations[0])):
+            result.ambiguas += 1
+            return None
+        return combinations[0] if combinations else None
+
+    result = SupplierCombinations()
+    try:
+        # Un anticipo que cubre varias facturas.
+        for advance in range(len(advance_ids)):
+            positions = candidates(
+                invoices_by_day, invoice_days, free_invoices, advance_days[advance]
+            )
+            if len(positions) < 2:
+                continue
+            combination = unique_combination(
+                AmountPool(invoice_amounts[positions].tolist()),
+                int(advance_amounts[advance]),
+                result,
+            )
+            if combination is not None:
+                covered = positions[combination]
+                for position in covered:
+                    result.facturas[invoice_ids[position]] = [advance_documents[advance]]
+                free_invoices[covered] = False
+                free_advances[advance] = False
+                result.anticipos.append(advance_ids[advance])
+        # Varios anticipos que cubren una factura.
+        for invoice in np.flatnonzero(free_invoices):
+            positions = candidates(
+                advances_by_day, advance_days, free_advances, invoice_days[invoice]
+            )
+            if len(positions) < 2:
+                continue
+            combination = unique_combination(
+                AmountPool(advance_amounts[positions].tolist()),
+                int(invoice_amounts[invoice]),
+                result,
+            )
+            if combination is not None:
+                covering = positions[combination]
+                result.facturas[invoice_ids[invoice]] = sorted(
+                    advance_documents[position] for position in covering
+                )
+                result.anticipos.extend(advance_ids[position] for position in covering)
+                free_advances[covering] = False
+                free_invoices[invoice] = False
+    except CombinationSearchTimeout:
+        result.agoto_tiempo = True
+        # Sólo una factura que no supera la suma de los mayores anticipos
+        # libres podría estar compensada por ellos.
+        reachable = advance_amounts[free_advances][:COMBINATION_MAX_DOCUMENTS].sum()
+        result.facturas_revision = [
+            invoice_ids[position]
+            for position in np.flatnonzero(free_invoices & (invoice_amounts <= reachable))
+        ]
+        result.anticipos_revision = [
+            advance_ids[position] for position in np.flatnonzero(free_advances)
+        ]
+    return result
+
+
+def get_combination_keys(
+    advance_index: pd.DataFrame, invoices: pd.DataFrame
+) -> tuple[pd.DataFrame, pd.DataFrame]:
+    """Agrega a ambos lados `dia` y `grupo`, las claves que acotan las combinaciones.
+
+    `dia` cuenta días desde 1970 según `COMBINATION_DATE_COLUMN`; si un lado no
+    tiene la columna, no hay ventana y todos los días valen 0. `grupo` numera
+    las sociedades de ambos lados con los mismos códigos; sin la columna en
+    los dos, todo es un grupo.
+    """
+
+    def on_both_sides(column: str) -> bool:
+        return column in advance_index.columns and column in invoices.columns
+
+    def days(df: pd.DataFrame) -> pd.Series:
+        dates = pd.to_datetime(df[COMBINATION_DATE_COLUMN], errors="coerce").dt.normalize()
+        return (dates - pd.Timestamp(0)) / pd.Timedelta(days=1)
+
+    if on_both_sides(COMBINATION_DATE_COLUMN):
+        advance_days, invoice_days = days(advance_index), days(invoices)
+    else:
+        advance_days, invoice_days = 0.0, 0.0
+    if on_both_sides(COMPANY_CODE_COLUMN):
+        codes, _ = pd.factorize(
+            pd.concat(
+                [
+                    advance_index[COMPANY_CODE_COLUMN].astype(object),
+                    invoices[COMPANY_CODE_COLUMN].astype(object),
+                ],
+                ignore_index=True,
+            )
+        )
+        advance_groups, invoice_groups = codes[: len(advance_index)], codes[len(advance_index):]
+    else:
+        advance_groups, invoice_groups = 0, 0
+    return (
+        advance_index.assign(dia=advance_days, grupo=advance_groups),
+        invoices.assign(dia=invoice_days, grupo=invoice_groups),
+    )
+
+
+def match_advance_combinations(
+    advance_index: pd.DataFrame,
+    invoices: pd.DataFrame,
+    time_limit: float | None = None,
+    total_time_limit: float | None = None,
+) -> tuple[pd.Series, pd.Index, pd.Index, pd.Index]:
+    """Cruza por combinaciones anticipos y facturas sin coincidencia uno a uno.
+
+    Para cada proveedor busca primero, anticipo por anticipo (del mayor al
+    menor), un grupo de facturas de su sociedad y su ventana de fechas que
+    sume exactamente su importe, y luego, para cada factura restante, un grupo
+    de anticipos que la cubra. Cada documento participa en una sola
+    combinación y sólo una combinación única cuenta. Cada proveedor tiene
+    `time_limit` segundos y la pasada completa, `total_time_limit`; lo que
+    quede sin resolver al agotar cualquiera de los dos pasa a revisión manual.
+    Devuelve los documentos de anticipo que suman cada factura, por índice de
+    factura; los índices de anticipo usados; y los índices de factura y de
+    anticipo en revisión por tiempo.
+    """
+    if time_limit is None:
+        time_limit = get_combination_time_limit()
+    if total_time_limit is None:
+        total_time_limit = get_combination_total_time_limit()
+    total_deadline = time.perf_counter() + total_time_limit
+    invoices = invoices.loc[
+        invoices["monto_comparacion"].gt(0),
+        [
+            column
+            for column in (*ADVANCE_MATCH_KEYS, COMBINATION_DATE_COLUMN, COMPANY_CODE_COLUMN)
+            if column in invoices.columns
+        ],
+    ]
+    advance_index = advance_index[advance_index["monto_comparacion"].gt(0)]
+    suppliers = pd.Index(invoices["cuenta"].dropna().unique()).intersection(
+        advance_index["cuenta"].dropna().unique()
+    )
+    matched = SupplierCombinations()
+    timed_out_suppliers = 0
+    ambiguous = 0
+    if len(suppliers):
+        advance_index, invoices = get_combination_keys(
+            advance_index[advance_index["cuenta"].isin(suppliers)],
+            invoices[invoices["cuenta"].isin(suppliers)],
+        )
+        advance_groups = dict(iter(advance_index.groupby(["cuenta", "grupo"])))
+        for key, supplier_invoice_rows in invoices.groupby(["cuenta", "grupo"]):
+            if key not in advance_groups:
+                continue
+            raise_if_cancelled()
+            supplier = _match_supplier_combinations(
+                advance_groups[key],
+                supplier_invoice_rows,
+                min(time.perf_counter() + time_limit, total_deadline),
+            )
+            matched.facturas.update(supplier.facturas)
+            matched.anticipos.extend(supplier.anticipos)
+            matched.facturas_revision.extend(supplier.facturas_revision)
+            matched.anticipos_revision.extend(supplier.anticipos_revision)
+            timed_out_suppliers += supplier.agoto_tiempo
+            ambiguous += supplier.ambiguas
+    if matched.facturas or ambiguous or timed_out_suppliers:
+        LOGGER.info(
+            f"[anticipos] combinaciones: facturas={len(matched.facturas):,} "
+            f"anticipos={len(matched.anticipos):,} ambiguas={ambiguous:,} "
+            f"proveedores_en_revision={timed_out_suppliers:,} "
+            f"facturas_en_revision={len(matched.facturas_revision):,} "
+            f"tiempo_total_agotado={'sí' if time.perf_counter() > total_deadline else 'no'}"
+        )
+    return (
+        pd.Series(
+            {index: ", ".join(documents) for index, documents in matched.facturas.items()},
+            dtype=object,
+            name="documentos_anticipo_relacionados",
+        ),
+        pd.Index(matched.anticipos),
+        pd.Index(matched.facturas_revision),
+        pd.Index(matched.anticipos_revision),
+    )
+
+
+def validate_payment_risk(
+    df_nomina: pd.DataFrame,
+    advance_source: pd.DataFrame | None = None,
+    advance_index: pd.DataFrame | None = None,
+) -> tuple[pd.DataFrame, pd.DataFrame, pd.DataFrame]:
+    """Alerta sobre facturas de proveedores con anticipos AB/SA asociados.
+
+    Los AB/SA de la fecha de nómina permanecen incluidos y se reportan. Sólo se
+    retienen cuando compensan exactamente otra factura propuesta. Los AB/SA de
+    otras fechas se usan como referencia de control, sin incorporarse a la nómina.
+    Las notas de crédito/débito (EC/ED) son correcciones de monto al pago del
+    proveedor y se incluyen siempre en la nómina pagable.
+
+    Un AB/SA sólo se considera anticipo ya contabilizado (y por lo tanto ya
+    pagado, sin deuda pendiente contra el acreedor) cuando su importe está
+    contabilizado con signo positivo en la cuenta del acreedor. Un AB/SA con
+    signo negativo no constituye evidencia de un anticipo ya cubierto, por lo
+    que no gatilla la alerta preventiva.
+
+    El cruce exige el mismo proveedor y el mismo importe absoluto redondeado.
+    La factura que coincide uno a uno queda bloqueada fuera de la nómina
+    pagable y se marca `requiere_revision_manual`, junto con el AB/SA de la
+    nómina que la compensa. Las combinaciones (un anticipo que cubre varias
+    facturas o varios anticipos que cubren una factura; ver
+    `match_advance_combinations`) no bloquean: sus documentos, y los de un
+    proveedor cuya búsqueda agota el tiempo límite, quedan retenidos como
+    `REVISION_MANUAL_COMBINACION` para revisión manual.
+
+    `advance_index` permite reutilizar el índice de `build_advance_index` ya
+    calculado sobre `advance_source`, p. ej. al evaluar varias fechas.
+    """
+    validated_df = annotate_payment_risk(df_nomina, advance_source, advance_index)
+    return split_validation_results(validated_df)
+
+
+def add_document_control_columns(df_nomina: pd.DataFrame) -> pd.DataFrame:
+    """Agrega las columnas de control que dependen sólo de cada documento.
+
+    El resultado del cruce queda en su valor inicial: apto para cruce, sin
+    anticipos relacionados y sin revisión manual.
+    """
+    validated_df = df_nomina.copy(deep=False)
+    validated_df["clase_documento_sap"] = get_document_classes(df_nomina)
+    validated_df["monto_comparacion"] = get_comparison_amounts(df_nomina)
+    validated_df["es_anticipo_potencial"] = validated_df["clase_documento_sap"].isin(
+        GENERIC_ACCOUNTING_DOCUMENT_TYPES
+    )
+    validated_df["estado_validacion"] = "APTO_PARA_CRUCE"
+    validated_df["documentos_anticipo_relacionados"] = ""
+    validated_df["requiere_revision_manual"] = False
+    return validated_df
+
+
+def annotate_payment_risk(
+    df_nomina: pd.DataFrame,
+    advance_source: pd.DataFrame | None = None,
+    advance_index: pd.DataFrame | None = None,
+) -> pd.DataFrame:
+    """Agrega a la nómina las columnas de control de anticipos AB/SA."""
+    validated_df = add_document_control_columns(df_nomina)
+    generic_mask = validated_df["es_anticipo_potencial"]
+
+    if advance_index is None:
+        advance_index = build_advance_index(
+            advance_source if advance_source is not None else df_nomina
+        )
+    invoices = validated_df[
+        validated_df["estado_validacion"].eq("APTO_PARA_CRUCE") & ~generic_mask
+    ]
+    matched_invoices, matched_advance_indexes = match_advances_to_invoices(
+        advance_index, invoices
+    )
+    combined_invoices, combined_advances, review_invoices, review_advances = (
+        match_advance_combinations(
+            advance_index[~advance_index["indice_anticipo"].isin(matched_advance_indexes)],
+            invoices[~invoices.index.isin(matched_invoices.index)],
+        )
+    )
+    review_mask = (
+        validated_df.index.isin(review_invoices)
+        | validated_df.index.isin(combined_invoices.index)
+        | (
+            generic_mask
+            & (
+                validated_df.index.isin(review_advances)
+                | validated_df.index.isin(combined_advances)
+            )
+        )
+    )
+    if review_mask.any():
+        validated_df.loc[review_mask, "estado_validacion"] = COMBINATION_REVIEW_STATUS
+        validated_df.loc[review_mask, "requiere_revision_manual"] = True
+        validated_df.loc[combined_invoices.index, "documentos_anticipo_relacionados"] = (
+            combined_invoices
+        )
+    if not matched_invoices.empty:
+        matched_advance_mask = generic_mask & validated_df.index.isin(
+            matched_advance_indexes
+        )
+        matched_invoice_mask = validated_df.index.isin(matched_invoices.index)
+        validated_df.loc[matched_advance_mask, "estado_validacion"] = (
+            "ANTICIPO_COMPENSA_FACTURA"
+        )
+        validated_df.loc[matched_invoice_mask, "estado_validacion"] = (
+            "BLOQUEADO_POR_ANTICIPO"
+        )
+        validated_df.loc[
+            matched_advance_mask | matched_invoice_mask, "requiere_revision_manual"
+        ] = True
+        validated_df.loc[matched_invoices.index, "documentos_anticipo_relacionados"] = (
+            matched_invoices
+        )
+
+    return validated_df
+
+
+def split_validation_results(
+    validated_df: pd.DataFrame,
+) -> tuple[pd.DataFrame, pd.DataFrame, pd.DataFrame]:
+    """Separa la nómina anotada en pagable, retenida y facturas bloqueadas."""
+    generic_mask = validated_df["es_anticipo_potencial"].astype(bool)
+    retained_df = validated_df[
+        validated_df["estado_validacion"].ne("APTO_PARA_CRUCE")
+    ]
+    blocked_invoices_df = validated_df[
+        validated_df["requiere_revision_manual"] & ~generic_mask
+    ]
+    payable_df = validated_df[
+        validated_df["estado_validacion"].eq("APTO_PARA_CRUCE")
+    ]
+    return payable_df, retained_df, blocked_invoices_df
+
+
+# --- Posibles facturas duplicadas ---
+DUPLICATE_PAIR_COLUMNS = [
+    "cuenta",
+    "nombre_1",
+    "n_documento",
+    "n_documento_par",
+    "referencia",
+    "referencia_par",
+    "importe_en_moneda_doc",
+    "importe_par",
+    "fecha_de_documento",
+    "fecha_de_documento_par",
+    "dias_entre_documentos",
+    "similitud_referencia",
+]
+DUPLICATE_RUNTIME_COLUMNS = [
+    "cuenta",
+    "nombre_1",
+    "facturas",
+    "pares_comparados",
+    "posibles_duplicados",
+    "segundos",
+]
+
+
+def normalize_references(references: pd.Series) -> pd.Series:
+    """Referencia comparable: mayúsculas, sólo letras y dígitos, sin ceros a la izquierda."""
+    return apply_to_text(
+        references,
+        lambda text: text.str.upper()
+        .str.replace(r"[^0-9A-Z]", "", regex=True)
+        .str.replace(r"(?<![0-9])0+(?=[0-9])", "", regex=True),
+    )
+
+
+def reference_similarity(left: np.ndarray, right: np.ndarray) -> np.ndarray:
+    """Similitud de Dice de los bigramas de cada par de referencias normalizadas.
+
+    Cada referencia distinta se convierte una vez en un vector de conteos de
+    bigramas, repartidos en `REFERENCE_BIGRAM_BUCKETS` casillas. La similitud
+    de todos los pares se calcula a la vez como 2·Σ mín(conteos) dividido por
+    los bigramas de ambas. Referencias iguales valen 1 y una vacía, 0.
+    """
+    codes, uniques = pd.factorize(np.concatenate([left, right]))
+    # Todas las referencias, con marcas de inicio y fin, en un solo arreglo de
+    # caracteres; un bigrama empieza en cualquier posición salvo la última de
+    # cada referencia.
+    lengths = np.array([len(text) + 2 for text in uniques], dtype=np.int64)
+    chars = np.frombuffer(
+        "".join(f"^{text}$" for text in uniques).encode("utf-32-le"), dtype=np.uint32
+    ).astype(np.int64)
+    starts = np.ones(len(chars), dtype=bool)
+    starts[np.cumsum(lengths) - 1] = False
+    positions = np.flatnonzero(starts)
+    buckets = (chars[positions] * 31 + chars[positions + 1]) % REFERENCE_BIGRAM_BUCKETS
+    rows = np.repeat(np.arange(len(uniques)), lengths - 1)
+    vectors = np.bincount(
+        rows * REFERENCE_BIGRAM_BUCKETS + buckets,
+        minlength=len(uniques) * REFERENCE_BIGRAM_BUCKETS,
+    ).astype(np.uint16).reshape(len(uniques), REFERENCE_BIGRAM_BUCKETS)
+    sizes = lengths - 1
+    left_codes, right_codes = codes[: len(left)], codes[len(left) :]
+    similarity = np.empty(len(left), dtype="float64")
+    for start in range(0, len(left), DUPLICATE_SCORING_CHUNK_PAIRS):
+        chunk = slice(start, start + DUPLICATE_SCORING_CHUNK_PAIRS)
+        shared = np.minimum(
+            vectors[left_codes[chunk]], vectors[right_codes[chunk]]
+        ).sum(axis=1, dtype=np.int64)
+        similarity[chunk] = 2 * shared / (sizes[left_codes[chunk]] + sizes[right_codes[chunk]])
+    similarity[left_codes == right_codes] = 1.0
+    similarity[(left == "") | (right == "")] = 0.0
+    return similarity
+
+
+def plan_duplicate_blocks(keys: pd.DataFrame) -> tuple[np.ndarray, pd.DataFrame]:
+    """Pares de bloques vecinos que hay que cruzar, sin generar aún los pares de facturas.
+
+    `keys` tiene `posicion`, `cuenta`, `bloque_importe` y `bloque_fecha`. Dos
+    facturas dentro de la tolerancia de importe y de la ventana de fechas
+    quedan a lo más a un bloque de distancia en cada eje, así que basta con
+    cruzar cada bloque consigo mismo y con la mitad de sus vecinos. Devuelve
+    las posiciones ordenadas por bloque y, por cada par de bloques, la cuenta,
+    el inicio y el tamaño de ambos bloques en ese orden y los pares de
+    facturas que genera, ordenados por proveedor.
+    """
+    block_columns = ["cuenta", "bloque_importe", "bloque_fecha"]
+    ordered = keys.sort_values([*block_columns, "posicion"], kind="stable")
+    blocks = ordered.groupby(block_columns, sort=False).size().rename("tamano").reset_index()
+    blocks["inicio"] = np.cumsum(blocks["tamano"].to_numpy()) - blocks["tamano"].to_numpy()
+    block_pairs = []
+    for amount_offset, date_offset in ((0, 0), (0, 1), (1, -1), (1, 0), (1, 1)):
+        neighbors = blocks.assign(
+            bloque_importe=blocks["bloque_importe"] - amount_offset,
+            bloque_fecha=blocks["bloque_fecha"] - date_offset,
+        )
+        block_pairs.append(blocks.merge(neighbors, on=block_columns, suffixes=("", "_par")))
+    block_pairs = pd.concat(block_pairs, ignore_index=True)
+    sizes, partner_sizes = block_pairs["tamano"], block_pairs["tamano_par"]
+    block_pairs["pares"] = np.where(
+        block_pairs["inicio"].eq(block_pairs["inicio_par"]),
+        sizes * (sizes - 1) // 2,
+        sizes * partner_sizes,
+    )
+    block_pairs = block_pairs[block_pairs["pares"].gt(0)].sort_values(
+        ["inicio", "inicio_par"], kind="stable", ignore_index=True
+    )
+    return (
+        ordered["posicion"].to_numpy(),
+        block_pairs[["cuenta", "inicio", "tamano", "inicio_par", "tamano_par", "pares"]],
+    )
+
+
+def expand_block_pairs(
+    order: np.ndarray, block_pairs: pd.DataFrame
+) -> tuple[np.ndarray, np.ndarray]:
+    """Pares de posiciones de los pares de bloques dados, cada uno con la menor primero."""
+    starts = block_pairs["inicio"].to_numpy()
+    partner_starts = block_pairs["inicio_par"].to_numpy()
+    partner_sizes = block_pairs["tamano_par"].to_numpy()
+    products = block_pairs["tamano"].to_numpy() * partner_sizes
+    pair = np.repeat(np.arange(len(block_pairs)), products)
+    step = np.arange(products.sum()) - np.repeat(np.cumsum(products) - products, products)
+    first = starts[pair] + step // partner_sizes[pair]
+    second = partner_starts[pair] + step % partner_sizes[pair]
+    # Dentro de un mismo bloque, cada par una sola vez.
+    keep = (starts[pair] != partner_starts[pair]) | (first < second)
+    left, right = order[first[keep]], order[second[keep]]
+    return np.minimum(left, right), np.maximum(left, right)
+
+
+def iter_supplier_duplicate_candidates(
+    order: np.ndarray,
+    supplier_blocks: pd.DataFrame,
+    positions: np.ndarray,
+    references: np.ndarray,
+):
+    """Entrega por tramos los pares candidatos de un proveedor.
+
+    Cada tramo tiene a lo más `DUPLICATE_SCORING_CHUNK_PAIRS` pares, salvo que
+    un solo par de bloques dé más. Si los bloques del proveedor suman más de
+    `DUPLICATE_MAX_SUPPLIER_PAIRS` pares, sus facturas (`positions`) se ordenan
+    por referencia y cada una se compara con las `DUPLICATE_WINDOW_INVOICES`
+    siguientes.
+    """
+    pair_counts = supplier_blocks["pares"].to_numpy()
+    if pair_counts.sum() <= DUPLICATE_SCORING_CHUNK_PAIRS:
+        yield expand_block_pairs(order, supplier_blocks)
+        return
+    if pair_counts.sum() <= DUPLICATE_MAX_SUPPLIER_PAIRS:
+        chunk_ids = (np.cumsum(pair_counts) - pair_counts) // DUPLICATE_SCORING_CHUNK_PAIRS
+        for _, chunk in supplier_blocks.groupby(chunk_ids, sort=False):
+            yield expand_block_pairs(order, chunk)
+        return
+    reference_codes = pd.factorize(references[positions], sort=True)[0]
+    by_reference = positions[np.argsort(reference_codes, kind="stable")]
+    for distance in range(1, min(DUPLICATE_WINDOW_INVOICES, len(by_reference) - 1) + 1):
+        left, right = by_reference[:-distance], by_reference[distance:]
+        yield np.minimum(left, right), np.maximum(left, right)
+
+
+def detect_duplicate_invoices(df: pd.DataFrame) -> tuple[pd.DataFrame, pd.DataFrame]:
+    """Pares de facturas de un mismo proveedor que podrían ser la misma factura.
+
+    Un par es sospechoso cuando cumple todo lo siguiente:
+    - las dos facturas tienen el mismo signo;
+    - los importes difieren a lo más en `DUPLICATE_AMOUNT_TOLERANCE`, en forma relativa;
+    - las fechas de documento están a no más de `DUPLICATE_DATE_WINDOW_DAYS` días;
+    - los números de documento son distintos;
+    - las referencias tienen una similitud de al menos `DUPLICATE_MIN_REFERENCE_SIMILARITY`.
+
+    Los AB/SA no participan. Para no comparar todos los pares, cada factura se
+    asigna a un bloque por proveedor, tramo de importe y ventana de fechas
+    (`plan_duplicate_blocks`). Los pares candidatos se generan y se puntúan
+    proveedor por proveedor, por tramos y vectorizados
+    (`iter_supplier_duplicate_candidates`). Devuelve los pares sospechosos y,
+    para cada proveedor con candidatos, las facturas, los pares comparados,
+    los pares sospechosos y los segundos empleados en generarlos y
+    puntuarlos, del más lento al más rápido.
+    """
+    duplicates = pd.DataFrame(columns=DUPLICATE_PAIR_COLUMNS)
+    runtimes = pd.DataFrame(columns=DUPLICATE_RUNTIME_COLUMNS)
+    if df.empty or "fecha_de_documento" not in df.columns:
+        return duplicates, runtimes
+    amounts = get_numeric_amounts(df)
+    dates = pd.to_datetime(df["fecha_de_documento"], errors="coerce").dt.normalize()
+    eligible = (
+        ~get_document_classes(df).isin(GENERIC_ACCOUNTING_DOCUMENT_TYPES)
+        & amounts.abs().ge(1)
+        & dates.notna()
+        & df["cuenta"].notna()
+    )
+    invoices = df[eligible]
+    if len(invoices) < 2:
+        return duplicates, runtimes
+    invoice_amounts = amounts[eligible].to_numpy(dtype="float64")
+    invoice_days = (dates[eligible] - dates[eligible].min()).dt.days.to_numpy()
+    documents = invoices["n_documento"].to_numpy()
+    references = (
+        normalize_references(invoices["referencia"]).to_numpy(dtype=object)
+        if "referencia" in invoices.columns
+        else np.full(len(invoices), "", dtype=object)
+    )
+    keys = pd.DataFrame(
+        {
+            "posicion": np.arange(len(invoices)),
+            "cuenta": invoices["cuenta"].to_numpy(),
+            # Importes dentro de la tolerancia caen en el mismo tramo o en uno
+            # vecino: el ancho del tramo es la mayor distancia logarítmica.
+            "bloque_importe": np.floor(
+                np.log(np.abs(invoice_amounts)) / -np.log1p(-DUPLICATE_AMOUNT_TOLERANCE)
+            ).astype("int64"),
+            "bloque_fecha": invoice_days // DUPLICATE_DATE_WINDOW_DAYS,
+        }
+    )
+    order, block_pairs = plan_duplicate_blocks(keys)
+    supplier_positions = keys.groupby("cuenta", sort=False).indices
+    invoices_per_supplier = keys["cuenta"].value_counts()
+
+    found_left, found_right, found_similarity, runtime_rows = [], [], [], []
+    windowed_suppliers = 0
+    for cuenta, supplier_blocks in block_pairs.groupby("cuenta", sort=False):
+        started = time.perf_counter()
+        windowed_suppliers += supplier_blocks["pares"].sum() > DUPLICATE_MAX_SUPPLIER_PAIRS
+        compared = 0
+        supplier_left, supplier_right, supplier_similarity = [], [], []
+        for left, right in iter_supplier_duplicate_candidates(
+            order, supplier_blocks, supplier_positions[cuenta], references
+        ):
+            raise_if_cancelled()
+            compared += len(left)
+            left_amounts, right_amounts = invoice_amounts[left], invoice_amounts[right]
+            close = (
+                (np.sign(left_amounts) == np.sign(right_amounts))
+                & (
+                    np.abs(left_amounts - right_amounts)
+                    <= DUPLICATE_AMOUNT_TOLERANCE
+                    * np.maximum(np.abs(left_amounts), np.abs(right_amounts))
+                )
+                & (np.abs(invoice_days[left] - invoice_days[right]) <= DUPLICATE_DATE_WINDOW_DAYS)
+                & (documents[left] != documents[right])
+            )
+            left, right = left[close], right[close]
+            similarity = reference_similarity(references[left], references[right])
+            similar = similarity >= DUPLICATE_MIN_REFERENCE_SIMILARITY
+            supplier_left.append(left[similar])
+            supplier_right.append(right[similar])
+            supplier_similarity.append(similarity[similar])
+        left, right = np.concatenate(supplier_left), np.concatenate(supplier_right)
+        # Los pares de cada proveedor, en el orden de las facturas.
+        pair_order = np.lexsort((right, left))
+        found_left.append(left[pair_order])
+        found_right.append(right[pair_order])
+        found_similarity.append(np.concatenate(supplier_similarity)[pair_order])
+        runtime_rows.append((cuenta, compared, len(left), time.perf_counter() - started))
+
+    if runtime_rows:
+        runtimes = pd.DataFrame(
+            runtime_rows, columns=["cuenta", "pares_comparados", "posibles_duplicados", "segundos"]
+        )
+        first_rows = invoices.groupby("cuenta", sort=False).head(1).set_index("cuenta")
+        runtimes = runtimes.assign(
+            nombre_1=runtimes["cuenta"].map(first_rows["nombre_1"])
+            if "nombre_1" in first_rows.columns
+            else None,
+            facturas=runtimes["cuenta"].map(invoices_per_supplier).astype("int64"),
+        )[DUPLICATE_RUNTIME_COLUMNS].sort_values("segundos", ascending=False, ignore_index=True)
+    left = np.concatenate(found_left) if found_left else np.array([], dtype="int64")
+    right = np.concatenate(found_right) if found_right else np.array([], dtype="int64")
+    if len(left):
+        left_rows, right_rows = invoices.iloc[left], invoices.iloc[right]
+        raw_references = invoices.get("referencia", pd.Series("", index=invoices.index))
+        duplicates = pd.DataFrame(
+            {
+                "cuenta": left_rows["cuenta"].to_numpy(),
+                "nombre_1": left_rows["nombre_1"].to_numpy()
+                if "nombre_1" in invoices.columns
+                else None,
+                "n_documento": documents[left],
+                "n_documento_par": documents[right],
+                "referencia": raw_references.to_numpy(dtype=object)[left],
+                "referencia_par": raw_references.to_numpy(dtype=object)[right],
+                "importe_en_moneda_doc": invoice_amounts[left],
+                "importe_par": invoice_amounts[right],
+                "fecha_de_documento": dates[eligible].to_numpy()[left],
+                "fecha_de_documento_par": dates[eligible].to_numpy()[right],
+                "dias_entre_documentos": np.abs(invoice_days[left] - invoice_days[right]),
+                "similitud_referencia": np.concatenate(found_similarity).round(3),
+            }
+        )
+    LOGGER.info(
+        f"[duplicados] facturas={len(invoices):,} "
+        f"pares_comparados={sum(row[1] for row in runtime_rows):,} "
+        f"posibles_duplicados={len(duplicates):,} "
+        f"proveedores_por_ventana={windowed_suppliers:,} "
+        f"segundos_max_proveedor={runtimes['segundos'].max() if len(runtimes) else 0:.3f}"
+    )
+    return duplicates, runtimes
+
+
+# --- Revalidación incremental ---
+def get_validation_pipeline_hash() -> str:
+    """Resume el código del control de anticipos para invalidar instantáneas."""
+    digest = hashlib.blake2b(digest_size=8)
+    digest.update(
+        f"{pd.__version__}|{sorted(GENERIC_ACCOUNTING_DOCUMENT_TYPES)}|"
+        f"{COMBINATION_MAX_DOCUMENTS}|{COMBINATION_DATE_WINDOW_DAYS}".encode()
+    )
+    for name in VALIDATION_PIPELINE_FUNCTIONS:
+        try:
+            digest.update(inspect.getsource(globals()[name]).encode())
+        except (OSError, TypeError):
+            digest.update(name.encode())
+    return digest.hexdigest()
+
+
+def build_snapshot_rows(
+    df_nomina: pd.DataFrame,
+    advance_source: pd.DataFrame,
+) -> pd.DataFrame:
+    """Huella por documento (`cuenta`, `n_documento`) de ambas entradas del control.
+
+    `origen` distingue la nómina de la fuente de anticipos y `ocurrencia`
+    numera documentos repetidos, de modo que cualquier alta, baja o cambio de
+    contenido de un documento aparece como diferencia de su proveedor.
+    """
+    frames = []
+    for origin, df in (("nomina", df_nomina), ("anticipos", advance_source)):
+        rows = pd.DataFrame(
+            {
+                "cuenta": df["cuenta"],
+                "n_documento": df["n_documento"].astype(str),
+                "origen": origin,
+                "huella": pd.util.hash_pandas_object(
+                    df[sorted(df.columns)], index=False
+                ).astype("int64"),
+            },
+            index=df.index,
+        )
+        rows["ocurrencia"] = rows.groupby(SNAPSHOT_KEY_COLUMNS[:4], sort=False).cumcount()
+        frames.append(rows)
+    return pd.concat(frames)
+
+
+def get_snapshot_path() -> str | None:
+    """Ruta de la instantánea vigente, o None si el almacén está desactivado."""
+    snapshot_dir = os.environ.get(SNAPSHOT_DIR_ENV_VAR, SNAPSHOT_DEFAULT_DIR).strip()
+    if not snapshot_dir or importlib.util.find_spec("pyarrow") is None:
+        return None
+    return os.path.join(snapshot_dir, f"lista_pi-{get_validation_pipeline_hash()}.parquet")
+
+
+def load_validation_snapshot() -> pd.DataFrame | None:
+    """Lee la última Lista PI validada con sus resultados, si existe."""
+    snapshot_path = get_snapshot_path()
+    if snapshot_path is None or not os.path.exists(snapshot_path):
+        return None
+    try:
+        return pd.read_parquet(snapshot_path)
+    except Exception as error:  # instantánea corrupta: se recalcula todo
+        LOGGER.warning(f"[instantánea] ilegible, se recalcula todo ({error})")
+        return None
+
+
+def save_validation_snapshot(snapshot: pd.DataFrame) -> None:
+    """Reemplaza la instantánea; descarta las de versiones anteriores del control."""
+    snapshot_path = get_snapshot_path()
+    if snapshot_path is None:
+        return
+    snapshot_dir = os.path.dirname(snapshot_path)
+    os.makedirs(snapshot_dir, exist_ok=True)
+    temporary_path = f"{snapshot_path}.{os.getpid()}.tmp"
+    try:
+        snapshot.to_parquet(temporary_path)
+    except Exception as error:  # p. ej. columnas con tipos mixtos
+        LOGGER.warning(f"[instantánea] no se pudo guardar ({error})")
+        if os.path.exists(temporary_path):
+            os.remove(temporary_path)
+        return
+    os.replace(temporary_path, snapshot_path)
+    for entry in os.scandir(snapshot_dir):
+        if entry.name.endswith(".parquet") and entry.path != snapshot_path:
+            os.remove(entry.path)
+
+
+def validate_payment_risk_incremental(
+    df_nomina: pd.DataFrame,
+    advance_source: pd.DataFrame,
+    snapshot: pd.DataFrame | None,
+) -> tuple[tuple[pd.DataFrame, pd.DataFrame, pd.DataFrame], pd.DataFrame, dict]:
+    """Revalida sólo los proveedores cuyos documentos cambiaron.
+
+    Compara la nómina y la fuente de anticipos con la instantánea anterior por
+    (`cuenta`, `n_documento`). El cruce de anticipos se ejecuta sólo para los
+    proveedores con diferencias; para el resto se reutilizan las columnas de
+    control de la instantánea. El resultado es idéntico a
+    `validate_payment_risk`. Devuelve los resultados, la nueva instantánea y
+    la cantidad de proveedores recalculados y reutilizados.
+    """
+    rows = build_snapshot_rows(df_nomina, advance_source)
+    nomina_rows = rows[rows["origen"].eq("nomina")]
+    suppliers = pd.Index(rows["cuenta"].dropna().unique())
+    if snapshot is None:
+        changed_suppliers = suppliers
+    else:
+        diff = rows[SNAPSHOT_KEY_COLUMNS].merge(
+            snapshot[SNAPSHOT_KEY_COLUMNS], how="outer", indicator=True
+        )
+        changed_suppliers = pd.Index(
+            diff.loc[diff["_merge"].ne("both"), "cuenta"].dropna().unique()
+        )
+    changed_mask = df_nomina["cuenta"].isin(changed_suppliers)
+
+    validated_df = add_document_control_columns(df_nomina)
+    result_parts = []
+    if changed_mask.any():
+        result_parts.append(
+            annotate_payment_risk(
+                df_nomina[changed_mask],
+                advance_source[advance_source["cuenta"].isin(changed_suppliers)],
+            )[VALIDATION_RESULT_COLUMNS]
+        )
+    if not changed_mask.all():
+        result_parts.append(
+            nomina_rows.loc[~changed_mask, SNAPSHOT_KEY_COLUMNS]
+            .reset_index(names="indice")
+            .merge(snapshot, on=SNAPSHOT_KEY_COLUMNS, how="left")
+            .set_index("indice")[VALIDATION_RESULT_COLUMNS]
+        )
+    for part in result_parts:
+        validated_df.loc[part.index, "estado_validacion"] = part["estado_validacion"]
+        validated_df.loc[part.index, "documentos_anticipo_relacionados"] = part[
+            "documentos_anticipo_relacionados"
+        ]
+        validated_df.loc[part.index, "requiere_revision_manual"] = part[
+            "requiere_revision_manual"
+        ].astype(bool)
+
+    new_snapshot = pd.concat(
+        [
+            nomina_rows.join(validated_df[VALIDATION_RESULT_COLUMNS]),
+            rows[rows["origen"].eq("anticipos")],
+        ],
+        ignore_index=True,
+    )
+    stats = {
+        "proveedores_recalculados": int(changed_suppliers.isin(suppliers).sum()),
+        "proveedores_reutilizados": int((~suppliers.isin(changed_suppliers)).sum()),
+    }
+    return split_validation_results(validated_df), new_snapshot, stats
+
+
+def process_nomina_data_dates(df_nomina_input, fecha_referencia_dt):
+    """Calcula las diferencias de días y añade columnas al DataFrame de nómina."""
+    df_processed = df_nomina_input.copy(deep=False)
+
+    ref_date = pd.Timestamp(fecha_referencia_dt).normalize()
+    for date_column, days_column in (
+        ("fecha_de_documento", "dias_fecha_documento"),
+        ("vencimiento_neto", "dias_vencimiento"),
+    ):
+        if date_column in df_processed.columns:
+            dates = pd.to_datetime(df_processed[date_column], errors="coerce")
+            df_processed[days_column] = (
+                (ref_date - dates.dt.normalize()).dt.days.astype("Int64")
+            )
+    return df_processed
+
+
+# --- Registro de documentos pagados ---
+def get_paid_ledger_path() -> str | None:
+    """Ruta del registro de pagos, o None si está desactivado."""
+    return os.environ.get(PAID_LEDGER_ENV_VAR, PAID_LEDGER_DEFAULT_PATH).strip() or None
+
+
+PAID_LEDGER_TABLE_SQL = """
+    CREATE TABLE IF NOT EXISTS documentos_pagados (
+        cuenta INTEGER NOT NULL,
+        n_documento TEXT NOT NULL,
+        monto INTEGER NOT NULL,
+        sociedad TEXT NOT NULL DEFAULT '',
+        fecha_nomina TEXT NOT NULL,
+        PRIMARY KEY (cuenta, n_documento, monto, sociedad)
+    ) WITHOUT ROWID
+"""
+
+
+def connect_paid_ledger(path) -> sqlite3.Connection:
+    """Abre el registro de pagos y crea su tabla si no existe.
+
+    La clave primaria (`cuenta`, `n_documento`, `monto`, `sociedad`) es el
+    índice de las consultas; sin rowid, la tabla se guarda ordenada por esa
+    clave. Un registro anterior, sin `sociedad`, se convierte al abrirlo.
+    """
+    connection = sqlite3.connect(path)
+    connection.execute("PRAGMA journal_mode=WAL")
+    connection.execute("PRAGMA synchronous=NORMAL")
+    columns = [
+        row[1] for row in connection.execute("PRAGMA table_info(documentos_pagados)")
+    ]
+    if columns and COMPANY_CODE_COLUMN not in columns:
+        _upgrade_paid_ledger(connection)
+    connection.execute(PAID_LEDGER_TABLE_SQL)
+    return connection
+
+
+def _upgrade_paid_ledger(connection: sqlite3.Connection) -> None:
+    """Agrega `sociedad` (vacía) a un registro anterior y normaliza sus documentos.
+
+    Si dos documentos quedan con la misma clave, se conserva el primer pago.
+    """
+    with connection:
+        connection.execute("BEGIN")
+        connection.execute("ALTER TABLE documentos_pagados RENAME TO documentos_pagados_v1")
+        connection.execute(PAID_LEDGER_TABLE_SQL)
+        previous = pd.read_sql_query(
+            "SELECT cuenta, n_documento, monto, fecha_nomina FROM documentos_pagados_v1 "
+            "ORDER BY fecha_nomina",
+            connection,
+        )
+        connection.executemany(
+            "INSERT OR IGNORE INTO documentos_pagados VALUES (?, ?, ?, '', ?)",
+            zip(
+                previous["cuenta"].tolist(),
+                normalize_document_numbers(previous["n_documento"]).tolist(),
+                previous["monto"].tolist(),
+                previous["fecha_nomina"].tolist(),
+            ),
+        )
+        connection.execute("DROP TABLE documentos_pagados_v1")
+    LOGGER.info(f"[pagos] registro convertido: documentos={len(previous):,}")
+
+
+def normalize_document_numbers(values: pd.Series) -> pd.Series:
+    """Número de documento como texto; los enteros van sin decimales.
+
+    Así 5100000123, 5100000123.0 y "5100000123.0" dan la misma clave, sin
+    importar si la columna se leyó como entero, Int64, float o texto.
+    """
+    if pd.api.types.is_integer_dtype(values):
+        return values.astype(str)
+    return values.astype(str).str.replace(r"^(\d+)\.0+$", r"\1", regex=True)
+
+
+def get_paid_ledger_keys(df: pd.DataFrame) -> pd.DataFrame:
+    """Clave de cada documento en el registro: cuenta, documento, monto y sociedad.
+
+    El monto es el importe absoluto redondeado del cruce de anticipos. Sólo
+    la columna `Sociedad` de SAP da la sociedad: queda vacía si `df` no tiene
+    la columna o si salió del nombre del archivo, que cambia de una semana a
+    otra. Las filas sin cuenta o sin importe quedan fuera.
+    """
+    if COMPANY_CODE_COLUMN in df.columns:
+        companies = df[COMPANY_CODE_COLUMN].astype(object)
+        named = companies.isin(df.attrs.get(COMPANY_FROM_FILE_NAME_ATTR, []))
+        companies = normalize_document_numbers(companies.where(companies.notna() & ~named, ""))
+    else:
+        companies = ""
+    keys = pd.DataFrame(
+        {
+            "cuenta": pd.to_numeric(df["cuenta"], errors="coerce"),
+            "n_documento": normalize_document_numbers(df["n_documento"]),
+            "monto": get_comparison_amounts(df),
+            "sociedad": companies,
+        },
+        index=df.index,
+    ).dropna()
+    return keys.astype({"cuenta": "int64", "monto": "int64"})
+
+
+def find_paid_documents(df: pd.DataFrame, fecha_nomina) -> pd.Series:
+    """Fecha de la nómina en que ya se pagó cada documento de `df`.
+
+    Las claves se cargan en una tabla temporal y se cruzan con el registro en
+    una sola consulta por su clave primaria. Una sociedad vacía, en el
+    registro o en `df`, coincide con cualquier sociedad. Los pagos
+    registrados en la misma `fecha_nomina` no cuentan: repetir la validación
+    de una nómina ya registrada no la bloquea. Devuelve sólo las
+    coincidencias, con el índice de `df`.
+    """
+    paid_dates = pd.Series(dtype="datetime64[ns]", name="nomina_pago_anterior")
+    path = get_paid_ledger_path()
+    if path is None or df.empty or not os.path.exists(path):
+        return paid_dates
+    keys = get_paid_ledger_keys(df)
+    with contextlib.closing(connect_paid_ledger(path)) as connection:
+        connection.execute(
+            "CREATE TEMP TABLE consulta "
+            "(posicion INTEGER, cuenta INTEGER, n_documento TEXT, monto INTEGER, "
+            "sociedad TEXT)"
+        )
+        connection.executemany(
+            "INSERT INTO consulta VALUES (?, ?, ?, ?, ?)",
+            zip(
+                range(len(keys)),
+                keys["cuenta"].tolist(),
+                keys["n_documento"].tolist(),
+                keys["monto"].tolist(),
+                keys["sociedad"].tolist(),
+            ),
+        )
+        matches = connection.execute(
+            "SELECT consulta.posicion, pagados.fecha_nomina FROM consulta "
+            "JOIN documentos_pagados AS pagados USING (cuenta, n_documento, monto) "
+            "WHERE pagados.fecha_nomina <> ? AND (pagados.sociedad = consulta.sociedad "
+            "OR pagados.sociedad = '' OR consulta.sociedad = '')",
+            (f"{pd.Timestamp(fecha_nomina):%Y-%m-%d}",),
+        ).fetchall()
+    if not matches:
+        return paid_dates
+    positions, dates = zip(*matches)
+    return pd.Series(
+        pd.to_datetime(list(dates)),
+        index=keys.index[list(positions)],
+        name=paid_dates.name,
+    )
+
+
+def record_paid_documents(df: pd.DataFrame, fecha_nomina) -> int:
+    """Registra los documentos de `df` como pagados en la nómina `fecha_nomina`.
+
+    Se inserta por lotes de `PAID_LEDGER_BATCH_ROWS` filas en una sola
+    transacción. Un documento ya registrado conserva la fecha de su primer
+    pago. Devuelve la cantidad de documentos nuevos en el registro.
+    """
+    path = get_paid_ledger_path()
+    if path is None:
+        LOGGER.warning("[pagos] registro desactivado; no se registran documentos")
+        return 0
+    if os.path.dirname(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+    # En el orden de la clave primaria, cada lote se agrega al final del árbol.
+    keys = get_paid_ledger_keys(df).sort_values(["cuenta", "n_documento", "monto", "sociedad"])
+    fecha = f"{pd.Timestamp(fecha_nomina):%Y-%m-%d}"
+    rows = zip(
+        keys["cuenta"].tolist(),
+        keys["n_documento"].tolist(),
+        keys["monto"].tolist(),
+        keys["sociedad"].tolist(),
+        itertools.repeat(fecha),
+    )
+    with contextlib.closing(connect_paid_ledger(path)) as connection, connection:
+        changes_before = connection.total_changes
+        while batch := list(itertools.islice(rows, PAID_LEDGER_BATCH_ROWS)):
+            connection.executemany(
+                "INSERT OR IGNORE INTO documentos_pagados VALUES (?, ?, ?, ?, ?)", batch
+            )
+        inserted = connection.total_changes - changes_before
+    LOGGER.info(f"[pagos] nómina {fecha}: documentos={len(keys):,} nuevos={inserted:,}")
+    return inserted
+
+
+def block_paid_documents(
+    validation_results: tuple[pd.DataFrame, pd.DataFrame, pd.DataFrame],
+    fecha_nomina,
+    document_order: pd.Index,
+) -> tuple[pd.DataFrame, pd.DataFrame, pd.DataFrame]:
+    """Retiene los documentos pagables que el registro tiene pagados en otra nómina.
+
+    Quedan como `PAGADO_EN_NOMINA_ANTERIOR` con revisión manual y la fecha de
+    ese pago en `nomina_pago_anterior`; las facturas pasan además a las
+    bloqueadas. `document_order` es el índice del corte, que fija el orden de
+    los reportes.
+    """
+    payable_df, retained_df, blocked_df = validation_results
+    paid_dates = find_paid_documents(payable_df, fecha_nomina)
+    if paid_dates.empty:
+        return validation_results
+    paid_mask = payable_df.index.isin(paid_dates.index)
+    paid_df = payable_df[paid_mask].assign(
+        estado_validacion=PAID_LEDGER_STATUS,
+        requiere_revision_manual=True,
+        nomina_pago_anterior=paid_dates[~paid_dates.index.duplicated()],
+    )
+    invoices_df = paid_df[~paid_df["es_anticipo_potencial"].astype(bool)]
+
+    def in_document_order(df: pd.DataFrame) -> pd.DataFrame:
+        return df.loc[document_order[document_order.isin(df.index)]]
+
+    return (
+        payable_df[~paid_mask],
+        in_document_order(pd.concat([retained_df, paid_df])),
+        in_document_order(pd.concat([blocked_df, invoices_df])),
+    )
+
+
+def get_exported_documents(payroll: "PayrollRun") -> pd.DataFrame:
+    """Documentos que van en las exportaciones: los de acreedores exportables."""
+    if payroll.indice_proveedores is not None:
+        return payroll.indice_proveedores.take(
+            payroll.nomina_con_calculos, payroll.acreedores_exportables
+        )
+    payable = payroll.nomina_con_calculos
+    return payable[payable["cuenta"].isin(payroll.acreedores_exportables)]
+
+
+# --- Funciones de Generación de Archivos ---
+def get_exportable_creditors(
+    df: pd.DataFrame,
+    supplier_index: SupplierIndex | None = None,
+) -> list[int]:
+    """Obtiene acreedores de la nómina con total igual o menor a -$10 MM.
+
+    Con `supplier_index` se usan sus totales por cuenta en lugar de agrupar.
+    Ante totales iguales, el orden es por cuenta.
+    """
+    required_columns = {"cuenta", "importe_en_moneda_doc"}
+    missing_columns = required_columns.difference(df.columns)
+    if missing_columns:
+        raise ValueError(
+            "Faltan columnas para calcular acreedores exportables: "
+            + ", ".join(sorted(missing_columns))
+        )
+
+    if supplier_index is None or not supplier_index.matches(df):
+        totals = get_validation_backend().creditor_totals(df)
+    else:
+        totals = supplier_index.totals
+    totals = totals.sort_values(kind="stable")
+    return totals.index[totals.le(-MINIMUM_EXPORT_TOTAL_CLP)].tolist()
+
+
+def _pandas_creditor_totals(df: pd.DataFrame) -> pd.Series:
+    """Total de la nómina por cuenta, ordenado por cuenta."""
+    return df.groupby("cuenta")["importe_en_moneda_doc"].sum()
+
+
+def generate_excel_bytes(
+    df_data_for_excel: pd.DataFrame,
+    lista_cuentas_proveedores: list[int],
+    supplier_index: SupplierIndex | None = None,
+) -> bytes:
+    """Genera hojas ordenadas para acreedores con total de nómina menor a -$10 MM.
+
+    Los datos se particionan por cuenta una sola vez y cada hoja se escribe
+    fila a fila en modo `constant_memory` de xlsxwriter. Registra el tiempo de
+    escritura y la memoria pico del proceso.
+    """
+    started = time.perf_counter()
+    export_columns = get_export_columns(df_data_for_excel)
+    sheet_plan = plan_creditor_sheets(
+        df_data_for_excel, lista_cuentas_proveedores, supplier_index
+    )
+    output_buffer = io.BytesIO()
+    workbook = new_export_workbook(output_buffer)
+    for _, positions, sheet_name in sheet_plan:
+        write_creditor_sheet(
+            workbook, sheet_name, df_data_for_excel.iloc[positions], export_columns
+        )
+    workbook.close()
+    log_export_report("excel", 1, sheet_plan, started)
+    return output_buffer.getvalue()
+
+
+def plan_creditor_sheets(
+    df_data_for_excel: pd.DataFrame,
+    lista_cuentas_proveedores: list[int],
+    supplier_index: SupplierIndex | None = None,
+) -> list[tuple]:
+    """Define (cuenta, posiciones de fila, nombre de hoja) por acreedor exportable.
+
+    Las posiciones, nombres y totales salen de `supplier_index` (o de uno
+    construido aquí) y se respeta el orden de `lista_cuentas_proveedores`.
+    """
+    if supplier_index is None or not supplier_index.matches(df_data_for_excel):
+        supplier_index = build_supplier_index(df_data_for_excel)
+    exportable_accounts = set(
+        get_exportable_creditors(df_data_for_excel, supplier_index)
+    )
+    used_sheet_names = set()
+    sheet_plan = []
+    for cuenta_proveedor in lista_cuentas_proveedores:
+        positions = supplier_index.positions.get(cuenta_proveedor)
+        if cuenta_proveedor not in exportable_accounts or positions is None:
+            continue  # Solo crear hoja si hay datos para ese proveedor
+        raw_name = supplier_index.names.get(cuenta_proveedor, cuenta_proveedor)
+        if pd.isna(raw_name):
+            raw_name = cuenta_proveedor
+        sheet_name = get_unique_sheet_name(
+            str(raw_name), cuenta_proveedor, used_sheet_names
+        )
+        sheet_plan.append((cuenta_proveedor, positions, sheet_name))
+    return sheet_plan
+
+
+def get_export_columns(df: pd.DataFrame) -> list[str]:
+    """Columnas exportables, sin las columnas internas de control."""
+    return [column for column in df.columns if column not in EXPORT_COLUMNS_TO_EXCLUDE]
+
+
+def log_export_report(kind: str, files: int, sheet_plan: list[tuple], started: float) -> None:
+    """Registra filas, tiempo de escritura y memoria pico de una exportación."""
+    peak_memory = (
+        f"{resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024:,.0f} MB"
+        if resource is not None
+        else "n/d"
+    )
+    LOGGER.info(
+        f"[{kind}] hojas={len(sheet_plan):,} archivos={files:,} "
+        f"filas={sum(len(positions) for _, positions, _ in sheet_plan):,} "
+        f"tiempo={time.perf_counter() - started:.2f} s "
+        f"memoria_pico_proceso={peak_memory}"
+    )
+
+
+def get_export_workers() -> int:
+    """Procesos para el ZIP por acreedor, según variable de entorno o núcleos."""
+    configured = os.environ.get(EXPORT_WORKERS_ENV_VAR, "").strip()
+    return max(1, int(configured)) if configured else os.cpu_count() or 1
+
+
+def get_export_process_context() -> multiprocessing.context.BaseContext:
+    """Inicio de los procesos del ZIP por acreedor: forkserver o, sin él, spawn.
+
+    No se usa fork: el servidor de Streamlit tiene hilos (Tornado y los
+    trabajos de fondo) y un proceso copiado con fork puede quedar bloqueado
+    en un lock tomado por otro hilo.
+    """
+    if "forkserver" in multiprocessing.get_all_start_methods():
+        return multiprocessing.get_context("forkserver")
+    return multiprocessing.get_context("spawn")
+
+
+def generate_creditor_zip_bytes(
+    df_data_for_excel: pd.DataFrame,
+    lista_cuentas_proveedores: list[int],
+    max_workers: int | None = None,
+    supplier_index: SupplierIndex | None = None,
+) -> bytes:
+    """Genera un ZIP con un libro por acreedor exportable.
+
+    Los libros se construyen en paralelo en procesos hijos y se agregan al
+    ZIP a medida que terminan, en el mismo orden de
+    `lista_cuentas_proveedores`. Cada tarea lleva las filas de su acreedor.
+    """
+    started = time.perf_counter()
+    sheet_plan = plan_creditor_sheets(
+        df_data_for_excel, lista_cuentas_proveedores, supplier_index
+    )
+    max_workers = max_workers or get_export_workers()
+    export_columns = get_export_columns(df_data_for_excel)
+    tasks = (
+        (cuenta_proveedor, sheet_name, df_data_for_excel.iloc[positions], export_columns)
+        for cuenta_proveedor, positions, sheet_name in sheet_plan
+    )
+    output_buffer = io.BytesIO()
+    with zipfile.ZipFile(output_buffer, "w", zipfile.ZIP_DEFLATED) as archive:
+        if max_workers > 1 and len(sheet_plan) > 1:
+            with concurrent.futures.ProcessPoolExecutor(
+                max_workers=max_workers, mp_context=get_export_process_context()
+            ) as executor:
+                chunksize = max(1, len(sheet_plan) // (max_workers * 4))
+                workbooks = executor.map(
+                    build_creditor_workbook, tasks, chunksize=chunksize
+                )
+                for file_name, workbook_bytes in workbooks:
+                    archive.writestr(file_name, workbook_bytes)
+        else:
+            for task in tasks:
+                archive.writestr(*build_creditor_workbook(task))
+    log_export_report("zip", len(sheet_plan), sheet_plan, started)
+    return output_buffer.getvalue()
+
+
+def get_unique_sheet_name(raw_name: str, cuenta, used_sheet_names: set) -> str:
+    """Nombre de hoja válido de 31 caracteres, único dentro del libro."""
+    base_name = re.sub(r"[:/\\?*\[\]]", "_", raw_name)[:31]
+    sheet_name = base_name
+    # Dos acreedores con el mismo nombre se distinguen por cuenta; si ese
+    # nombre también está usado (p. ej. otro acreedor se llama así), se numera.
+    for attempt in itertools.count(1):
+        if sheet_name.lower() not in used_sheet_names:
+            break
+        suffix = f"_{cuenta}" if attempt == 1 else f"_{cuenta}_{attempt}"
+        sheet_name = f"{base_name[:31 - len(suffix)]}{suffix}"
+    used_sheet_names.add(sheet_name.lower())
+    return sheet_name
+
+
+def write_report_excel(df: pd.DataFrame, path) -> None:
+    """Escribe un reporte de control en una hoja Excel con fechas sin hora."""
+    with pd.ExcelWriter(
+        path,
+        engine="xlsxwriter",
+        date_format=EXCEL_DATE_FORMAT,
+        datetime_format=EXCEL_DATE_FORMAT,
+    ) as writer:
+        df.to_excel(writer, index=False)
+
+
+class CsvGzipWriter:
+    """CSV comprimido con gzip que se escribe por bloques de filas.
+
+    El encabezado se escribe con el primer bloque; `close` lo escribe con
+    `columns` si no llegó ninguno. Las fechas quedan como AAAA-MM-DD.
+    """
+
+    def __init__(self, target) -> None:
+        # Nivel 6, como `gzip` en consola: el 9 triplica el tiempo y casi no reduce.
+        self._gzip = gzip.GzipFile(fileobj=target, mode="wb", compresslevel=6, mtime=0)
+        self._header_pending = True
+
+    def write(self, df: pd.DataFrame, chunk_rows: int = EXPORT_CHUNK_ROWS) -> None:
+        for start in range(0, len(df), chunk_rows):
+            text = df.iloc[start : start + chunk_rows].to_csv(
+                index=False, header=self._header_pending, date_format=CSV_DATE_FORMAT
+            )
+            self._header_pending = False
+            self._gzip.write(text.encode("utf-8"))
+
+    def close(self, columns: list[str] | None = None) -> None:
+        if self._header_pending and columns:
+            self._gzip.write(pd.DataFrame(columns=columns).to_csv(index=False).encode("utf-8"))
+        self._gzip.close()
+
+
+def _to_export_table(df: pd.DataFrame):
+    """Tabla Arrow para exportar, con las categorías convertidas a sus valores.
+
+    Así cada archivo guarda sólo los valores de su acreedor y no el catálogo
+    completo de la Lista PI.
+    """
+    import pyarrow as pa
+
+    df = df.astype(
+        {
+            column: df[column].cat.categories.dtype
+            for column in df.columns
+            if isinstance(df[column].dtype, pd.CategoricalDtype)
+        }
+    )
+    return pa.Table.from_pandas(_parquet_safe_text(df), preserve_index=False)
+
+
+class ParquetDatasetWriter:
+    """Dataset Parquet con un directorio `cuenta=<n>` por acreedor.
+
+    Cada acreedor se escribe en archivos de hasta `EXPORT_CHUNK_ROWS` filas. La
+    cuenta queda en el nombre del directorio (partición Hive), no en los
+    archivos. `_acreedores.json` conserva el orden de exportación, que un
+    dataset particionado no guarda; los lectores de Parquet lo ignoran.
+    """
+
+    def __init__(self, target_dir) -> None:
+        if importlib.util.find_spec("pyarrow") is None:
+            raise ValueError("La exportación Parquet requiere pyarrow.")
+        self.target_dir = target_dir
+        self.creditors = []
+        os.makedirs(target_dir, exist_ok=True)
+
+    def write(self, cuenta, table, chunk_rows: int = EXPORT_CHUNK_ROWS) -> None:
+        """Escribe las filas de un acreedor; `table` es un DataFrame o una tabla Arrow."""
+        import pyarrow.parquet as pq
+
+        if isinstance(table, pd.DataFrame):
+            table = _to_export_table(table)
+        if "cuenta" in table.column_names:
+            table = table.drop_columns(["cuenta"])
+        creditor_dir = os.path.join(self.target_dir, f"cuenta={cuenta}")
+        os.makedirs(creditor_dir, exist_ok=True)
+        for part, start in enumerate(range(0, table.num_rows, chunk_rows)):
+            pq.write_table(
+                table.slice(start, chunk_rows),
+                os.path.join(creditor_dir, f"parte-{part:04d}.parquet"),
+            )
+        self.creditors.append({"cuenta": int(cuenta), "filas": table.num_rows})
+
+    def close(self) -> str:
+        manifest_path = os.path.join(self.target_dir, PARQUET_DATASET_MANIFEST)
+        with open(manifest_path, "w", encoding="utf-8") as file:
+            json.dump(self.creditors, file, ensure_ascii=False, indent=1)
+        return manifest_path
+
+
+def write_creditor_csv_gzip(
+    df_data: pd.DataFrame,
+    lista_cuentas_proveedores: list[int],
+    target,
+    supplier_index: SupplierIndex | None = None,
+) -> None:
+    """Escribe en `target` el CSV gzip de los acreedores exportables, uno tras otro.
+
+    Los acreedores pequeños se agrupan en bloques de hasta `EXPORT_CHUNK_ROWS`
+    filas para convertir a texto varios de una vez.
+    """
+    started = time.perf_counter()
+    export_columns = get_export_columns(df_data)
+    sheet_plan = plan_creditor_sheets(df_data, lista_cuentas_proveedores, supplier_index)
+    writer = CsvGzipWriter(target)
+    pending, pending_rows = [], 0
+    for index, (_, positions, _) in enumerate(sheet_plan):
+        pending.append(positions)
+        pending_rows += len(positions)
+        if pending_rows >= EXPORT_CHUNK_ROWS or index == len(sheet_plan) - 1:
+            writer.write(df_data.iloc[np.concatenate(pending)][export_columns])
+            pending, pending_rows = [], 0
+    writer.close(export_columns)
+    log_export_report("csv", 1, sheet_plan, started)
+
+
+def write_creditor_parquet_dataset(
+    df_data: pd.DataFrame,
+    lista_cuentas_proveedores: list[int],
+    target_dir,
+    supplier_index: SupplierIndex | None = None,
+) -> str:
+    """Escribe el dataset Parquet por acreedor y devuelve la ruta del índice de orden.
+
+    La nómina se convierte a Arrow una sola vez y cada acreedor se toma de esa
+    tabla por posiciones.
+    """
+    started = time.perf_counter()
+    writer = ParquetDatasetWriter(target_dir)
+    sheet_plan = plan_creditor_sheets(df_data, lista_cuentas_proveedores, supplier_index)
+    table = _to_export_table(df_data[get_export_columns(df_data)])
+    for cuenta_proveedor, positions, _ in sheet_plan:
+        writer.write(cuenta_proveedor, table.take(positions))
+    manifest_path = writer.close()
+    log_export_report("parquet", len(sheet_plan), sheet_plan, started)
+    return manifest_path
+
+
+def generate_csv_gzip_bytes(
+    df_data: pd.DataFrame,
+    lista_cuentas_proveedores: list[int],
+    supplier_index: SupplierIndex | None = None,
+) -> bytes:
+    """CSV gzip de los acreedores exportables, para descargar."""
+    output_buffer = io.BytesIO()
+    write_creditor_csv_gzip(
+        df_data, lista_cuentas_proveedores, output_buffer, supplier_index
+    )
+    return output_buffer.getvalue()
+
+
+def generate_parquet_dataset_zip_bytes(
+    df_data: pd.DataFrame,
+    lista_cuentas_proveedores: list[int],
+    supplier_index: SupplierIndex | None = None,
+) -> bytes:
+    """ZIP sin recomprimir del dataset Parquet por acreedor, para descargar."""
+    output_buffer = io.BytesIO()
+    with tempfile.TemporaryDirectory(prefix="prenomina-parquet-") as dataset_dir:
+        write_creditor_parquet_dataset(
+            df_data, lista_cuentas_proveedores, dataset_dir, supplier_index
+        )
+        # Parquet ya viene comprimido: se guarda tal cual.
+        with zipfile.ZipFile(output_buffer, "w", zipfile.ZIP_STORED) as archive:
+            for root, _, files in sorted(os.walk(dataset_dir)):
+                for file_name in sorted(files):
+                    path = os.path.join(root, file_name)
+                    archive.write(
+                        path,
+                        os.path.join(
+                            PARQUET_DATASET_DIRNAME, os.path.relpath(path, dataset_dir)
+                        ),
+                    )
+    return output_buffer.getvalue()
+
+
+# --- Motores de validación ---
+# Cada motor implementa los núcleos vectorizados de las reglas. Las funciones
+# públicas siguen recibiendo y devolviendo DataFrames de pandas: el motor
+# calcula máscaras, cruces y totales, y las filas se toman del DataFrame
+# original, así que ambos motores entregan los mismos tipos e índices. La
+# búsqueda de combinaciones de anticipos es común a ambos.
+def _polars_text(series: pd.Series) -> "pl.Series":
+    """Columna de texto en Polars, con los mismos valores que `apply_to_text`."""
+    if isinstance(series.dtype, pd.CategoricalDtype):
+        categories = pl.Series(
+            [*series.cat.categories.astype(str), ""], dtype=pl.String
+        )
+        codes = series.cat.codes.to_numpy()
+        # El código -1 (nulo) toma el último valor: "".
+        return categories.gather(np.where(codes < 0, len(categories) - 1, codes))
+    if isinstance(series.dtype, pd.StringDtype):
+        return pl.from_pandas(series).cast(pl.String).fill_null("")
+    return pl.Series(series.fillna("").astype(str).to_numpy(dtype=object), dtype=pl.String)
+
+
+def _polars_eligible_mask(df: pd.DataFrame) -> np.ndarray:
+    frame = pl.DataFrame(
+        {
+            "bloqueo": _polars_text(df["bloqueo_de_pago"]),
+            "via": _polars_text(df["v_a_de_pago"]),
+        }
+    )
+    return frame.select(
+        pl.col("bloqueo").str.strip_chars().str.to_uppercase().ne("A")
+        & pl.col("via").str.strip_chars().str.to_uppercase().ne("C")
+    ).to_series().to_numpy()
+
+
+def _polars_factoring_mask(df: pd.DataFrame) -> np.ndarray:
+    if "referencia" not in df.columns:
+        return np.zeros(len(df), dtype=bool)
+    return _polars_text(df["referencia"]).str.contains("(?i)FACTORING").to_numpy()
+
+
+def _polars_advance_mask(source_df: pd.DataFrame) -> np.ndarray:
+    frame = pl.DataFrame(
+        {
+            "clase": _polars_text(get_document_classes(source_df)),
+            "importe": pl.from_pandas(get_numeric_amounts(source_df)),
+        }
+    )
+    return frame.select(
+        (
+            pl.col("clase").is_in(sorted(GENERIC_ACCOUNTING_DOCUMENT_TYPES))
+            & pl.col("importe").gt(0)
+        ).fill_null(False)
+    ).to_series().to_numpy()
+
+
+def _has_mixed_object_keys(*frames: pd.DataFrame, keys: list[str]) -> bool:
+    """Indica si alguna clave mezcla números y texto en una columna `object`.
+
+    Polars no puede representar esa columna con un tipo único; pandas compara
+    cada valor por igualdad de Python (1001 == 1001.0, pero 1001 != "1001").
+    """
+    return any(
+        df[column].dtype == object
+        and pd.api.types.infer_dtype(df[column], skipna=True) in ("mixed", "mixed-integer")
+        for df in frames
+        for column in keys
+    )
+
+
+def _polars_match_keys(df: pd.DataFrame) -> "pl.DataFrame":
+    """Claves de cruce con un tipo común: números como Float64, el resto como texto."""
+    columns = {}
+    for column in ADVANCE_MATCH_KEYS:
+        values = pl.from_pandas(df[column])
+        columns[column] = values.cast(pl.Float64 if values.dtype.is_numeric() else pl.String)
+    return pl.DataFrame(columns)
+
+
+def _polars_match_advances(
+    advance_index: pd.DataFrame, invoices: pd.DataFrame
+) -> tuple[pd.Series, pd.Index]:
+    if _has_mixed_object_keys(advance_index, invoices, keys=ADVANCE_MATCH_KEYS):
+        return _pandas_match_advances(advance_index, invoices)
+    invoice_keys = invoices[ADVANCE_MATCH_KEYS].dropna()
+    invoice_frame = _polars_match_keys(invoice_keys).with_row_index("fila_factura")
+    advances = _polars_match_keys(advance_index).with_columns(
+        documento=pl.Series(
+            advance_index["n_documento_anticipo"].to_numpy(dtype=object), dtype=pl.String
+        ),
+        fila_anticipo=pl.int_range(pl.len(), dtype=pl.UInt32),
+    )
+    advance_references = (
+        advances.unique(subset=[*ADVANCE_MATCH_KEYS, "documento"])
+        .group_by(ADVANCE_MATCH_KEYS)
+        .agg(pl.col("documento").sort().str.join(", "))
+    )
+    matched = invoice_frame.join(advance_references, on=ADVANCE_MATCH_KEYS, how="inner")
+    matched_invoices = pd.Series(
+        matched["documento"].to_list(),
+        index=invoice_keys.index[matched["fila_factura"].to_numpy()].rename("indice_factura"),
+        name="documentos_anticipo_relacionados",
+    )
+    matched_rows = advances.join(
+        invoice_frame.select(ADVANCE_MATCH_KEYS).unique(), on=ADVANCE_MATCH_KEYS, how="semi"
+    )["fila_anticipo"].to_numpy()
+    return matched_invoices, pd.Index(advance_index["indice_anticipo"].to_numpy()[matched_rows])
+
+
+def _polars_creditor_totals(df: pd.DataFrame) -> pd.Series:
+    if _has_mixed_object_keys(df, keys=["cuenta"]):
+        return _pandas_creditor_totals(df)
+    amounts = pl.from_pandas(df["importe_en_moneda_doc"])
+    totals = (
+        pl.DataFrame(
+            {
+                "cuenta": pl.from_pandas(df["cuenta"]),
+                # Sumar enteros pequeños en 64 bits, como pandas, evita desbordes.
+                "importe": amounts.cast(pl.Int64 if amounts.dtype.is_integer() else pl.Float64),
+            }
+        )
+        .drop_nulls("cuenta")
+        .group_by("cuenta")
+        .agg(pl.col("importe").sum())
+        .sort("cuenta")
+    )
+    return pd.Series(
+        totals["importe"].to_numpy(),
+        index=pd.Index(totals["cuenta"].to_numpy(), name="cuenta"),
+        name="importe_en_moneda_doc",
+    )
+
+
+@dataclass(frozen=True)
+class ValidationBackend:
+    """Núcleos vectorizados de las reglas de validación sobre un motor."""
+
+    eligible_mask: object
+    factoring_mask: object
+    advance_mask: object
+    match_advances: object
+    creditor_totals: object
+
+
+VALIDATION_BACKENDS = {
+    "pandas": ValidationBackend(
+        eligible_mask=_pandas_eligible_mask,
+        factoring_mask=_pandas_factoring_mask,
+        advance_mask=_pandas_advance_mask,
+        match_advances=_pandas_match_advances,
+        creditor_totals=_pandas_creditor_totals,
+    ),
+    "polars": ValidationBackend(
+        eligible_mask=_polars_eligible_mask,
+        factoring_mask=_polars_factoring_mask,
+        advance_mask=_polars_advance_mask,
+        match_advances=_polars_match_advances,
+        creditor_totals=_polars_creditor_totals,
+    ),
+}
+_BACKEND_FALLBACK_REPORTED = False
+
+
+def get_validation_backend() -> ValidationBackend:
+    """Motor elegido en `PRENOMINA_BACKEND`; pandas si no se indica o falta polars."""
+    global _BACKEND_FALLBACK_REPORTED
+
+    name = os.environ.get(VALIDATION_BACKEND_ENV_VAR, "").strip() or DEFAULT_VALIDATION_BACKEND
+    if name not in VALIDATION_BACKENDS:
+        raise ValueError(
+            f"Motor de validación desconocido en {VALIDATION_BACKEND_ENV_VAR}: {name}. "
+            f"Opciones: {', '.join(VALIDATION_BACKENDS)}."
+        )
+    if name == "polars" and pl is None:
+        if not _BACKEND_FALLBACK_REPORTED:
+            LOGGER.warning("[motor] polars no está instalado; se usa pandas")
+            _BACKEND_FALLBACK_REPORTED = True
+        name = DEFAULT_VALIDATION_BACKEND
+    return VALIDATION_BACKENDS[name]
+
+
+# --- Orquestación del Proceso ---
+class EmptyPayrollError(ValueError):
+    """Los archivos cargados no dejan partidas que validar para la fecha."""
+
+
+@dataclass
+class PayrollRun:
+    """Resultado de validar la nómina semanal para una fecha de corte."""
+
+    fecha_nomina: pd.Timestamp
+    documentos_fecha: pd.DataFrame
+    anticipos_nomina: pd.DataFrame
+    nomina_con_calculos: pd.DataFrame
+    documentos_retenidos: pd.DataFrame
+    facturas_bloqueadas: pd.DataFrame
+    acreedores_exportables: list[int]
+    proveedores_recalculados: int | None = None
+    proveedores_reutilizados: int | None = None
+    # Índice por cuenta de `nomina_con_calculos`, para exportar sin reagrupar.
+    indice_proveedores: SupplierIndex | None = None
+    # Pares de facturas que podrían ser la misma y tiempo de búsqueda por proveedor.
+    posibles_duplicados: pd.DataFrame | None = None
+    tiempos_duplicados: pd.DataFrame | None = None
+
+
+def run_payroll_validation(
+    df_nomina_base: pd.DataFrame,
+    df_tesoreria: pd.DataFrame,
+    fecha_referencia,
+    incremental: bool = False,
+    supplier_index: SupplierIndex | None = None,
+) -> PayrollRun:
+    """Ejecuta filtro, corte de vencimiento, control de anticipos y cálculos.
+
+    Es el mismo proceso de la aplicación, sin depender de widgets de
+    Streamlit. Lanza `EmptyPayrollError` cuando no quedan partidas que validar.
+    Con `incremental`, el control de anticipos se recalcula sólo para los
+    proveedores que cambiaron respecto de la última instantánea guardada.
+    `supplier_index` es el índice de `df_nomina_base`, construido al cargar.
+    """
+    df_nomina_propuesta = select_payroll_proposal(
+        df_nomina_base, df_tesoreria, supplier_index
+    )
+    fecha_nomina = pd.Timestamp(fecha_referencia).normalize()
+    with instrument_stage("corte de vencimiento", len(df_nomina_propuesta)) as stage:
+        df_documentos_fecha = df_nomina_propuesta[
+            df_nomina_propuesta["vencimiento_neto"].le(fecha_nomina)
+        ]
+        stage["filas_salida"] = len(df_documentos_fecha)
+    return validate_payroll_cut(
+        df_nomina_propuesta, df_documentos_fecha, fecha_nomina, incremental=incremental
+    )
+
+
+def select_payroll_proposal(
+    df_nomina_base: pd.DataFrame,
+    df_tesoreria: pd.DataFrame,
+    supplier_index: SupplierIndex | None = None,
+) -> pd.DataFrame:
+    """Partidas de la Lista PI de los proveedores incluidos en Tesorería.
+
+    Con `supplier_index` las filas se toman por posición, sin recorrer la
+    columna `cuenta` completa.
+    """
+    if df_nomina_base.empty or df_tesoreria.empty:
+        raise EmptyPayrollError(
+            "Uno o ambos archivos están vacíos o no se pudieron procesar correctamente. Por favor, verifique los archivos."
+        )
+
+    # Tesorería define los proveedores y la fecha de nómina es el corte de vencimiento.
+    with instrument_stage("filtro proveedores tesoreria", len(df_nomina_base)) as stage:
+        lista_proveedores_tesoreria = df_tesoreria["cuenta"].unique().tolist()
+        if supplier_index is not None:
+            df_nomina_propuesta = supplier_index.take(
+                df_nomina_base, lista_proveedores_tesoreria
+            )
+        else:
+            df_nomina_propuesta = df_nomina_base[
+                df_nomina_base["cuenta"].isin(lista_proveedores_tesoreria)
+            ]
+        stage["filas_salida"] = len(df_nomina_propuesta)
+    log_memory_report("propuesta", df_nomina_propuesta)
+    if df_nomina_propuesta.empty:
+        raise EmptyPayrollError(
+            "No se encontraron partidas abiertas en Lista PI para los "
+            "proveedores incluidos en la nómina de Tesorería."
+        )
+    if "vencimiento_neto" not in df_nomina_propuesta.columns:
+        raise ValueError(
+            "La Lista PI no contiene la columna Vencimiento neto, "
+            "requerida para definir la nómina semanal."
+        )
+    return df_nomina_propuesta
+
+
+def validate_payroll_cut(
+    df_nomina_propuesta: pd.DataFrame,
+    df_documentos_fecha: pd.DataFrame,
+    fecha_nomina: pd.Timestamp,
+    incremental: bool = False,
+    advance_index: pd.DataFrame | None = None,
+) -> PayrollRun:
+    """Control de anticipos, cálculos y acreedores exportables de un corte."""
+    log_memory_report("corte de vencimiento", df_documentos_fecha)
+    if df_documentos_fecha.empty:
+        raise EmptyPayrollError(
+            f"No hay partidas con vencimiento neto hasta {fecha_nomina:%d-%m-%Y} "
+            "para los proveedores de Tesorería."
+        )
+
+    clases_documento_fecha = get_document_classes(df_documentos_fecha)
+    df_anticipos_nomina = df_documentos_fecha[
+        clases_documento_fecha.isin(GENERIC_ACCOUNTING_DOCUMENT_TYPES)
+    ]
+
+    incremental_stats = {}
+    with instrument_stage("validate_payment_risk", len(df_documentos_fecha)) as stage:
+        if incremental:
+            validation_results, snapshot, incremental_stats = (
+                validate_payment_risk_incremental(
+                    df_documentos_fecha,
+                    df_nomina_propuesta,
+                    load_validation_snapshot(),
+                )
+            )
+            save_validation_snapshot(snapshot)
+        else:
+            validation_results = validate_payment_risk(
+                df_documentos_fecha,
+                advance_source=df_nomina_propuesta,
+                advance_index=advance_index,
+            )
+        stage["filas_salida"] = len(validation_results[0])
+    with instrument_stage("block_paid_documents", len(validation_results[0])) as stage:
+        df_nomina_validada, df_documentos_retenidos, df_facturas_bloqueadas = (
+            block_paid_documents(validation_results, fecha_nomina, df_documentos_fecha.index)
+        )
+        stage["filas_salida"] = len(df_nomina_validada)
+    with instrument_stage("detect_duplicate_invoices", len(df_documentos_fecha)) as stage:
+        posibles_duplicados, tiempos_duplicados = detect_duplicate_invoices(
+            df_documentos_fecha
+        )
+        stage["filas_salida"] = len(posibles_duplicados)
+    # Procesar solamente documentos aptos para pago.
+    with instrument_stage("process_nomina_data_dates", len(df_nomina_validada)) as stage:
+        df_nomina_con_calculos = process_nomina_data_dates(
+            df_nomina_validada, fecha_nomina
+        )
+        stage["filas_salida"] = len(df_nomina_con_calculos)
+    log_memory_report("nómina validada", df_nomina_con_calculos)
+    with instrument_stage("get_exportable_creditors", len(df_nomina_con_calculos)) as stage:
+        indice_proveedores = build_supplier_index(df_nomina_con_calculos)
+        acreedores_exportables = get_exportable_creditors(
+            df_nomina_con_calculos, indice_proveedores
+        )
+        stage["filas_salida"] = len(acreedores_exportables)
+    return PayrollRun(
+        fecha_nomina=fecha_nomina,
+        documentos_fecha=df_documentos_fecha,
+        anticipos_nomina=df_anticipos_nomina,
+        nomina_con_calculos=df_nomina_con_calculos,
+        documentos_retenidos=df_documentos_retenidos,
+        facturas_bloqueadas=df_facturas_bloqueadas,
+        acreedores_exportables=acreedores_exportables,
+        indice_proveedores=indice_proveedores,
+        posibles_duplicados=posibles_duplicados,
+        tiempos_duplicados=tiempos_duplicados,
+        **incremental_stats,
+    )
+
+
+@dataclass
+class PayrollProposal:
+    """Propuesta filtrada por Tesorería, lista para cortarse en cualquier fecha."""
+
+    propuesta: pd.DataFrame
+    vencimientos_ordenados: np.ndarray
+    orden_vencimientos: np.ndarray
+    indice_anticipos: pd.DataFrame
+
+
+def prepare_payroll_proposal(
+    df_nomina_base: pd.DataFrame,
+    df_tesoreria: pd.DataFrame,
+    supplier_index: SupplierIndex | None = None,
+) -> PayrollProposal:
+    """Filtra por Tesorería, ordena por vencimiento e indexa anticipos una vez.
+
+    Todo lo que no depende de la fecha de nómina queda en el resultado.
+    """
+    df_nomina_propuesta = select_payroll_proposal(
+        df_nomina_base, df_tesoreria, supplier_index
+    )
+    with instrument_stage("indice de vencimientos", len(df_nomina_propuesta)):
+        due_dates = df_nomina_propuesta["vencimiento_neto"].to_numpy(dtype="datetime64[ns]")
+        # NaT queda al final del orden y nunca entra en un corte.
+        due_order = np.argsort(due_dates, kind="stable")
+    with instrument_stage("build_advance_index", len(df_nomina_propuesta)) as stage:
+        advance_index = build_advance_index(df_nomina_propuesta)
+        stage["filas_salida"] = len(advance_index)
+    return PayrollProposal(
+        propuesta=df_nomina_propuesta,
+        vencimientos_ordenados=due_dates[due_order],
+        orden_vencimientos=due_order,
+        indice_anticipos=advance_index,
+    )
+
+
+def cut_payroll_proposal(
+    proposal: PayrollProposal,
+    fecha_referencia,
+    incremental: bool = False,
+) -> PayrollRun:
+    """Valida la nómina de una fecha sobre una propuesta ya preparada.
+
+    El corte de vencimiento se obtiene con búsqueda binaria. Lanza
+    `EmptyPayrollError` si la fecha no tiene partidas que validar.
+    """
+    fecha_nomina = pd.Timestamp(fecha_referencia).normalize()
+    with instrument_stage("corte de vencimiento", len(proposal.propuesta)) as stage:
+        cut = np.searchsorted(
+            proposal.vencimientos_ordenados,
+            np.datetime64(fecha_nomina, "ns"),
+            side="right",
+        )
+        # Posiciones del corte en el orden original de la Lista PI.
+        df_documentos_fecha = proposal.propuesta.iloc[
+            np.sort(proposal.orden_vencimientos[:cut])
+        ]
+        stage["filas_salida"] = len(df_documentos_fecha)
+    return validate_payroll_cut(
+        proposal.propuesta,
+        df_documentos_fecha,
+        fecha_nomina,
+        incremental=incremental,
+        advance_index=None if incremental else proposal.indice_anticipos,
+    )
+
+
+def run_payroll_scenarios(
+    df_nomina_base: pd.DataFrame,
+    df_tesoreria: pd.DataFrame,
+    fechas_referencia,
+    supplier_index: SupplierIndex | None = None,
+) -> dict:
+    """Evalúa la nómina para varias fechas de corte en una sola pasada.
+
+    La propuesta se filtra por Tesorería y se ordena por vencimiento neto una
+    sola vez; el corte de cada fecha se obtiene con búsqueda binaria. El índice
+    de anticipos se construye una vez y se comparte entre fechas. Devuelve un
+    diccionario por fecha normalizada con su `PayrollRun`, o con el
+    `EmptyPayrollError` si la fecha no tiene partidas que validar.
+    """
+    proposal = prepare_payroll_proposal(df_nomina_base, df_tesoreria, supplier_index)
+    return evaluate_payroll_dates(proposal, fechas_referencia)
+
+
+def evaluate_payroll_dates(proposal: PayrollProposal, fechas_referencia) -> dict:
+    """`PayrollRun` (o `EmptyPayrollError`) por fecha sobre una misma propuesta."""
+    scenarios = {}
+    for fecha_referencia in fechas_referencia:
+        fecha_nomina = pd.Timestamp(fecha_referencia).normalize()
+        if fecha_nomina in scenarios:
+            continue
+        try:
+            scenarios[fecha_nomina] = cut_payroll_proposal(proposal, fecha_nomina)
+        except EmptyPayrollError as warning:
+            scenarios[fecha_nomina] = warning
+    return scenarios
+
+
+def get_following_payroll_dates(fecha_referencia, weeks: int = 3) -> list[date]:
+    """Viernes de las semanas siguientes a la fecha de nómina."""
+    fecha = pd.Timestamp(fecha_referencia).normalize()
+    first_friday = fecha + pd.Timedelta(days=(4 - fecha.weekday()) % 7 or 7)
+    return [(first_friday + pd.Timedelta(weeks=week)).date() for week in range(weeks)]
+
+
+def summarize_payroll_scenarios(scenarios: dict) -> pd.DataFrame:
+    """Totales, bloqueos y acreedores exportables de cada fecha, lado a lado."""
+    rows = []
+    for fecha_nomina, payroll in scenarios.items():
+        # Una fecha sin partidas llega como EmptyPayrollError. Se compara con
+        # Exception porque en la aplicación el resultado puede venir de la
+        # sesión, creado por una ejecución anterior del script con otra clase.
+        if isinstance(payroll, Exception):
+            rows.append({"fecha_nomina": fecha_nomina, "partidas": 0})
+            continue
+        payable = payroll.nomina_con_calculos
+        exportable = payable["cuenta"].isin(payroll.acreedores_exportables)
+        rows.append(
+            {
+                "fecha_nomina": fecha_nomina,
+                "partidas": len(payroll.documentos_fecha),
+                "pagables": len(payable),
+                "total_pagable": payable["importe_en_moneda_doc"].sum(),
+                "facturas_bloqueadas": len(payroll.facturas_bloqueadas),
+                "monto_bloqueado": payroll.facturas_bloqueadas[
+                    "importe_en_moneda_doc"
+                ].sum(),
+                "documentos_retenidos": len(payroll.documentos_retenidos),
+                "acreedores_exportables": len(payroll.acreedores_exportables),
+                "total_exportable": payable.loc[exportable, "importe_en_moneda_doc"].sum(),
+            }
+        )
+    summary = pd.DataFrame(
+        rows,
+        columns=[
+            "fecha_nomina",
+            "partidas",
+            "pagables",
+            "total_pagable",
+            "facturas_bloqueadas",
+            "monto_bloqueado",
+            "documentos_retenidos",
+            "acreedores_exportables",
+            "total_exportable",
+        ],
+    )
+    count_columns = [
+        "partidas",
+        "pagables",
+        "facturas_bloqueadas",
+        "documentos_retenidos",
+        "acreedores_exportables",
+    ]
+    summary[count_columns] = summary[count_columns].fillna(0).astype("int64")
+    return summary.fillna(0).sort_values("fecha_nomina", ignore_index=True)
+
+
+def write_payroll_outputs(
+    payroll: PayrollRun,
+    output_dir,
+    zip_por_acreedor: bool = False,
+    csv_gzip: bool = False,
+    parquet: bool = False,
+) -> list[str]:
+    """Escribe el Excel por acreedor y los reportes de bloqueos y retenciones.
+
+    Con `csv_gzip` y `parquet` escribe además el CSV gzip y el dataset Parquet
+    por acreedor, directamente en disco y por bloques.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    excel_path = os.path.join(output_dir, EXCEL_FILENAME)
+    rows = len(payroll.nomina_con_calculos)
+    with open(excel_path, "wb") as file, instrument_stage("generate_excel_bytes", rows):
+        file.write(
+            generate_excel_bytes(
+                payroll.nomina_con_calculos,
+                payroll.acreedores_exportables,
+                payroll.indice_proveedores,
+            )
+        )
+    written_paths = [excel_path]
+    if zip_por_acreedor:
+        zip_path = os.path.join(output_dir, ZIP_FILENAME)
+        with open(zip_path, "wb") as file, instrument_stage(
+            "generate_creditor_zip_bytes", rows
+        ):
+            file.write(
+                generate_creditor_zip_bytes(
+                    payroll.nomina_con_calculos,
+                    payroll.acreedores_exportables,
+                    supplier_index=payroll.indice_proveedores,
+                )
+            )
+        written_paths.append(zip_path)
+    if csv_gzip:
+        csv_path = os.path.join(output_dir, CSV_FILENAME)
+        with open(csv_path, "wb") as file, instrument_stage("write_creditor_csv_gzip", rows):
+            write_creditor_csv_gzip(
+                payroll.nomina_con_calculos,
+                payroll.acreedores_exportables,
+                file,
+                payroll.indice_proveedores,
+            )
+        written_paths.append(csv_path)
+    if parquet:
+        dataset_dir = os.path.join(output_dir, PARQUET_DATASET_DIRNAME)
+        with instrument_stage("write_creditor_parquet_dataset", rows):
+            write_creditor_parquet_dataset(
+                payroll.nomina_con_calculos,
+                payroll.acreedores_exportables,
+                dataset_dir,
+                payroll.indice_proveedores,
+            )
+        written_paths.append(dataset_dir)
+    for df_report, file_name in (
+        (payroll.facturas_bloqueadas, BLOCKED_REPORT_FILENAME),
+        (payroll.documentos_retenidos, RETAINED_REPORT_FILENAME),
+        (payroll.posibles_duplicados, DUPLICATE_REPORT_FILENAME),
+    ):
+        report_path = os.path.join(output_dir, file_name)
+        write_report_excel(df_report, report_path)
+        written_paths.append(report_path)
+    return written_paths
+
+
+# --- Modo por particiones de proveedor ---
+def _parquet_safe_text(df: pd.DataFrame) -> pd.DataFrame:
+    """Convierte a texto las columnas con tipos mezclados, que Parquet no admite."""
+    df = df.copy(deep=False)
+    for column in df.columns:
+        values = df[column]
+        if isinstance(values.dtype, pd.CategoricalDtype):
+            values = values.astype(object)
+        elif values.dtype != object:
+            continue
+        if pd.api.types.infer_dtype(values, skipna=True).startswith("mixed"):
+            df[column] = values.where(values.isna(), values.astype(str))
+    return df
+
+
+def _read_partition(paths: list[str]) -> pd.DataFrame:
+    """Une los bloques Parquet de una partición y recompacta su esquema."""
+    # Cada bloque se lee por separado: sus esquemas pueden diferir (p. ej.
+    # enteros reducidos a distinto tamaño) y concat los unifica.
+    df = pd.concat([pd.read_parquet(path) for path in paths], ignore_index=True)
+    for column in df.columns:
+        if isinstance(df[column].dtype, pd.CategoricalDtype):
+            df[column] = df[column].astype(object)
+    return apply_lista_pi_schema(df)
+
+
+def partition_lista_pi(
+    source,
+    partition_dir,
+    chunk_rows: int = STREAMING_CHUNK_ROWS,
+    partitions: int = STREAMING_PARTITIONS,
+) -> int:
+    """Lee, limpia y reparte la Lista PI por proveedor sin cargarla completa.
+
+    Cada bloque de `chunk_rows` filas se limpia con `clean_lista_pi` y sus
+    filas se escriben en `partition_dir/parte-NNN/` según `cuenta % partitions`,
+    de modo que todos los documentos de un proveedor quedan en la misma
+    partición. Se agrega `fila_lista_pi` para conservar el orden original.
+    Devuelve la cantidad de filas elegibles escritas.
+    """
+    if importlib.util.find_spec("pyarrow") is None:
+        raise ValueError("El modo por particiones requiere pyarrow para escribir Parquet.")
+    written_rows = 0
+    read_rows = 0
+
+    def usecols(column) -> bool:
+        return clean_column_name(column) not in COLUMNS_TO_DROP_NOMINA
+
+    with instrument_stage("particion lista_pi") as stage:
+        for chunk_number, chunk in enumerate(iter_excel_chunks(source, usecols, chunk_rows)):
+            chunk.index = pd.RangeIndex(read_rows, read_rows + len(chunk))
+            read_rows += len(chunk)
+            df_chunk = clean_lista_pi(chunk)
+            df_chunk[STREAMING_ROW_COLUMN] = df_chunk.index.to_numpy(dtype="int64")
+            df_chunk = _parquet_safe_text(df_chunk.reset_index(drop=True))
+            buckets = (df_chunk["cuenta"].astype("int64") % partitions).to_numpy()
+            for bucket, positions in pd.Series(buckets).groupby(buckets).indices.items():
+                bucket_dir = os.path.join(partition_dir, f"parte-{bucket:03d}")
+                os.makedirs(bucket_dir, exist_ok=True)
+                df_chunk.iloc[positions].to_parquet(
+                    os.path.join(bucket_dir, f"bloque-{chunk_number:05d}.parquet"),
+                    index=False,
+                )
+            written_rows += len(df_chunk)
+        stage["filas_entrada"] = read_rows
+        stage["filas_salida"] = written_rows
+    LOGGER.info(
+        f"[particiones] filas_leidas={read_rows:,} filas_elegibles={written_rows:,} "
+        f"particiones={len(os.listdir(partition_dir)) if os.path.isdir(partition_dir) else 0}"
+    )
+    return written_rows
+
+
+def iter_supplier_partitions(partition_dir):
+    """Entrega (nombre, DataFrame) de cada partición escrita por `partition_lista_pi`."""
+    if not os.path.isdir(partition_dir):
+        return
+    for bucket_name in sorted(os.listdir(partition_dir)):
+        bucket_dir = os.path.join(partition_dir, bucket_name)
+        paths = sorted(
+            os.path.join(bucket_dir, name)
+            for name in os.listdir(bucket_dir)
+            if name.endswith(".parquet")
+        )
+        if paths:
+            yield bucket_name, _read_partition(paths)
+
+
+@dataclass
+class StreamingPayrollRun:
+    """Resumen de una nómina validada partición por partición."""
+
+    fecha_nomina: pd.Timestamp
+    partidas: int = 0
+    pagables: int = 0
+    bloqueadas: int = 0
+    retenidas: int = 0
+    posibles_duplicados: int = 0
+    acreedores_exportables: list[int] = field(default_factory=list)
+    written_paths: list[str] = field(default_factory=list)
+
+
+def run_payroll_streaming(
+    partition_dir,
+    df_tesoreria: pd.DataFrame,
+    fecha_referencia,
+    output_dir,
+    zip_por_acreedor: bool = False,
+    csv_gzip: bool = False,
+    parquet: bool = False,
+    record_paid: bool = False,
+) -> StreamingPayrollRun:
+    """Valida la nómina partición por partición y escribe los archivos de salida.
+
+    Como todas las reglas son por proveedor, cada partición pasa completa por
+    `run_payroll_validation` y sólo una partición está en memoria a la vez.
+    La nómina pagable de cada partición se guarda en Parquet ordenada por
+    cuenta; después se escribe el Excel (y el ZIP) hoja por hoja, leyendo de
+    Parquet sólo las filas del acreedor en curso; el CSV gzip y el dataset
+    Parquet, si se piden, se escriben en la misma pasada. Los reportes de bloqueos y
+    retenciones, que son excepciones, se acumulan en memoria. Con
+    `record_paid`, los documentos exportados se registran como pagados después
+    de escribir las exportaciones.
+    """
+    fecha_nomina = pd.Timestamp(fecha_referencia).normalize()
+    summary = StreamingPayrollRun(fecha_nomina=fecha_nomina)
+    retained_parts, blocked_parts, duplicate_parts = [], [], []
+    # (total, cuenta, nombre, filas, ruta Parquet) de cada acreedor exportable.
+    creditor_rows = []
+    with tempfile.TemporaryDirectory(prefix="prenomina-validada-") as validated_dir:
+        for bucket_name, df_bucket in iter_supplier_partitions(partition_dir):
+            try:
+                payroll = run_payroll_validation(df_bucket, df_tesoreria, fecha_nomina)
+            except EmptyPayrollError:
+                continue  # partición sin proveedores de Tesorería o sin vencimientos
+            summary.partidas += len(payroll.documentos_fecha)
+            summary.pagables += len(payroll.nomina_con_calculos)
+            retained_parts.append(payroll.documentos_retenidos)
+            blocked_parts.append(payroll.facturas_bloqueadas)
+            duplicate_parts.append(payroll.posibles_duplicados)
+            if not payroll.acreedores_exportables:
+                continue
+            df_payable = payroll.nomina_con_calculos
+            df_payable = df_payable[
+                df_payable["cuenta"].isin(payroll.acreedores_exportables)
+            ].sort_values("cuenta", kind="stable")
+            ledger_columns = [
+                column
+                for column in ("cuenta", "n_documento", "monto_comparacion", COMPANY_CODE_COLUMN)
+                if column in df_payable.columns
+            ]
+            validated_path = os.path.join(validated_dir, f"{bucket_name}.parquet")
+            _parquet_safe_text(
+                df_payable.drop(columns=STREAMING_ROW_COLUMN).reset_index(drop=True)
+            ).to_parquet(validated_path, index=False, row_group_size=STREAMING_ROW_GROUP_ROWS)
+            groups = df_payable.groupby("cuenta", sort=False)
+            totals = groups["importe_en_moneda_doc"].sum()
+            sizes = groups.size()
+            first_names = (
+                groups["nombre_1"].first()
+                if "nombre_1" in df_payable.columns
+                else pd.Series(dtype=object)
+            )
+            for cuenta in payroll.acreedores_exportables:
+                creditor_rows.append(
+                    (
+                        totals[cuenta],
+                        cuenta,
+                        first_names.get(cuenta),
+                        int(sizes[cuenta]),
+                        validated_path,
+                    )
+                )
+
+        if not summary.partidas:
+            raise EmptyPayrollError(
+                f"No hay partidas con vencimiento neto hasta {fecha_nomina:%d-%m-%Y} "
+                "para los proveedores de Tesorería."
+            )
+        creditor_rows.sort(key=lambda creditor: creditor[0])
+        summary.acreedores_exportables = [creditor[1] for creditor in creditor_rows]
+        os.makedirs(output_dir, exist_ok=True)
+        summary.written_paths = _write_streaming_exports(
+            creditor_rows, output_dir, zip_por_acreedor, csv_gzip, parquet
+        )
+        if record_paid and creditor_rows:
+            validated_paths = dict.fromkeys(creditor[4] for creditor in creditor_rows)
+            record_paid_documents(
+                pd.concat(
+                    [
+                        pd.read_parquet(path, columns=ledger_columns)
+                        for path in validated_paths
+                    ],
+                    ignore_index=True,
+                ),
+                fecha_nomina,
+            )
+
+    for parts, file_name in (
+        (blocked_parts, BLOCKED_REPORT_FILENAME),
+        (retained_parts, RETAINED_REPORT_FILENAME),
+    ):
+        df_report = (
+            pd.concat(parts, ignore_index=True)
+            .sort_values(STREAMING_ROW_COLUMN, kind="stable")
+            .drop(columns=STREAMING_ROW_COLUMN)
+        )
+        if file_name == BLOCKED_REPORT_FILENAME:
+            summary.bloqueadas = len(df_report)
+        else:
+            summary.retenidas = len(df_report)
+        report_path = os.path.join(output_dir, file_name)
+        write_report_excel(df_report, report_path)
+        summary.written_paths.append(report_path)
+    # Cada proveedor está en una sola partición: basta reordenar por cuenta.
+    df_duplicates = pd.concat(duplicate_parts, ignore_index=True).sort_values(
+        "cuenta", kind="stable", ignore_index=True
+    )
+    summary.posibles_duplicados = len(df_duplicates)
+    report_path = os.path.join(output_dir, DUPLICATE_REPORT_FILENAME)
+    write_report_excel(df_duplicates, report_path)
+    summary.written_paths.append(report_path)
+    return summary
+
+
+def _write_streaming_exports(
+    creditor_rows: list[tuple],
+    output_dir,
+    zip_por_acreedor: bool,
+    csv_gzip: bool = False,
+    parquet: bool = False,
+) -> list[str]:
+    """Escribe el Excel por acreedor (y el ZIP, CSV y Parquet) leyendo cada hoja desde Parquet."""
+    started = time.perf_counter()
+    used_sheet_names = set()
+    sheet_plan = []
+    for _, cuenta, raw_name, rows, validated_path in creditor_rows:
+        if raw_name is None or pd.isna(raw_name):
+            raw_name = cuenta
+        sheet_name = get_unique_sheet_name(str(raw_name), cuenta, used_sheet_names)
+        sheet_plan.append((cuenta, range(rows), sheet_name, validated_path))
+
+    excel_path = os.path.join(output_dir, EXCEL_FILENAME)
+    written_paths = [excel_path]
+    workbook = new_export_workbook(excel_path)
+    archive = None
+    if zip_por_acreedor:
+        written_paths.append(os.path.join(output_dir, ZIP_FILENAME))
+        archive = zipfile.ZipFile(written_paths[-1], "w", zipfile.ZIP_DEFLATED)
+    csv_file = csv_writer = dataset_writer = None
+    if csv_gzip:
+        written_paths.append(os.path.join(output_dir, CSV_FILENAME))
+        csv_file = open(written_paths[-1], "wb")
+        csv_writer = CsvGzipWriter(csv_file)
+    if parquet:
+        written_paths.append(os.path.join(output_dir, PARQUET_DATASET_DIRNAME))
+        dataset_writer = ParquetDatasetWriter(written_paths[-1])
+    export_columns = None
+    try:
+        for cuenta, _, sheet_name, validated_path in sheet_plan:
+            df_sheet = pd.read_parquet(validated_path, filters=[("cuenta", "==", cuenta)])
+            export_columns = get_export_columns(df_sheet)
+            write_creditor_sheet(workbook, sheet_name, df_sheet, export_columns)
+            if archive is not None:
+                output_buffer = io.BytesIO()
+                creditor_workbook = new_export_workbook(output_buffer)
+                write_creditor_sheet(creditor_workbook, sheet_name, df_sheet, export_columns)
+                creditor_workbook.close()
+                archive.writestr(
+                    get_creditor_workbook_name(cuenta, sheet_name),
+                    output_buffer.getvalue(),
+                )
+            if csv_writer is not None:
+                csv_writer.write(df_sheet[export_columns])
+            if dataset_writer is not None:
+                dataset_writer.write(cuenta, df_sheet[export_columns])
+    finally:
+        workbook.close()
+        if archive is not None:
+            archive.close()
+        if csv_writer is not None:
+            csv_writer.close(export_columns)
+            csv_file.close()
+        if dataset_writer is not None:
+            dataset_writer.close()
+    report_plan = [(cuenta, rows, sheet_name) for cuenta, rows, sheet_name, _ in sheet_plan]
+    log_export_report("excel", len(written_paths), report_plan, started)
+    return written_paths
+
+
+def parse_cli_args(argv: list[str] | None = None) -> argparse.Namespace:
+    """Interpreta los argumentos de la ejecución por lotes."""
+    parser = argparse.ArgumentParser(
+        description=(
+            "Valida la nómina semanal sin interfaz: filtra la Lista PI por los "
+            "proveedores de Tesorería, aplica el corte de vencimiento, controla "
+            "anticipos AB/SA y escribe el Excel y los reportes."
+        ),
+    )
+    parser.add_argument(
+        "--lista-pi",
+        required=True,
+        action="append",
+        help=(
+            "Archivo xlsx de Lista PI Acreedores; se puede repetir, uno por "
+            "sociedad, y los archivos se validan como una sola nómina."
+        ),
+    )
+    parser.add_argument("--tesoreria", help="Archivo xlsx de Tesorería.")
+    parser.add_argument("--fecha", help="Fecha de nómina (AAAA-MM-DD).")
+    parser.add_argument(
+        "--run",
+        nargs=2,
+        action="append",
+        default=[],
+        metavar=("FECHA", "TESORERIA"),
+        help="Par fecha/archivo de Tesorería adicional; se puede repetir.",
+    )
+    parser.add_argument(
+        "--incremental",
+        action="store_true",
+        help="Recalcula el control de anticipos sólo para proveedores con cambios.",
+    )
+    parser.add_argument(
+        "--zip-por-acreedor",
+        action="store_true",
+        help=f"Escribe además {ZIP_FILENAME} con un Excel por acreedor.",
+    )
+    parser.add_argument(
+        "--csv",
+        action="store_true",
+        help=f"Escribe además {CSV_FILENAME} con los acreedores exportables.",
+    )
+    parser.add_argument(
+        "--parquet",
+        action="store_true",
+        help=f"Escribe además {PARQUET_DATASET_DIRNAME}/, un dataset Parquet por acreedor.",
+    )
+    parser.add_argument(
+        "--registrar-pagos",
+        action="store_true",
+        help=(
+            "Registra los documentos exportados como pagados; en otra fecha de "
+            "nómina quedan bloqueados como pago repetido."
+        ),
+    )
+    parser.add_argument(
+        "--por-particiones",
+        action="store_true",
+        help=(
+            "Lee la Lista PI por bloques y valida por particiones de proveedores, "
+            "para archivos mayores que la memoria disponible."
+        ),
+    )
+    parser.add_argument(
+        "--bloque-filas",
+        type=int,
+        default=STREAMING_CHUNK_ROWS,
+        help="Filas por bloque de lectura en el modo por particiones.",
+    )
+    parser.add_argument(
+        "--particiones",
+        type=int,
+        default=STREAMING_PARTITIONS,
+        help="Cantidad de particiones de proveedores en el modo por particiones.",
+    )
+    parser.add_argument(
+        "--salida",
+        default="salida_nomina",
+        help="Directorio de salida; se crea una carpeta por fecha de nómina.",
+    )
+    args = parser.parse_args(argv)
+    if bool(args.tesoreria) != bool(args.fecha):
+        parser.error("--tesoreria y --fecha deben indicarse juntos.")
+    if args.tesoreria:
+        args.run.insert(0, [args.fecha, args.tesoreria])
+    if not args.run:
+        parser.error("Indique --tesoreria y --fecha, o al menos un --run FECHA TESORERIA.")
+    if args.por_particiones and args.incremental:
+        parser.error("--por-particiones no admite --incremental.")
+    if args.registrar_pagos and len(args.run) > 1:
+        parser.error("--registrar-pagos admite una sola fecha de nómina.")
+    if args.por_particiones and len(args.lista_pi) > 1:
+        parser.error("--por-particiones admite una sola --lista-pi.")
+    if args.bloque_filas < 1 or args.particiones < 1:
+        parser.error("--bloque-filas y --particiones deben ser mayores que cero.")
+    return args
+
+
+def run_batch_cli(argv: list[str] | None = None) -> int:
+    """Ejecuta una o varias nóminas por lotes reutilizando los archivos leídos."""
+    args = parse_cli_args(argv)
+    configure_console_logging()
+    configure_stage_logging()
+    instrumentation = PipelineInstrumentation(
+        trace_memory=bool(os.environ.get(TRACE_MEMORY_ENV_VAR))
+    )
+    with instrumentation.activate():
+        try:
+            exit_code = _run_batch(args)
+        except MemoryBudgetError as error:
+            LOGGER.error(f"[memoria] {error}")
+            exit_code = 2
+    if instrumentation.profile_path:
+        LOGGER.info(f"[perfil] {instrumentation.profile_path}")
+    return exit_code
+
 
+def _run_batch(args: argparse.Namespace) -> int:
+    if args.por_particiones:
+        return _run_batch_streaming(args)
+    df_nomina_base = load_lista_pi_files(args.lista_pi)
+    indice_base = build_supplier_index(df_nomina_base)
+    tesoreria_by_path = {}
+    scenarios_by_path = {}
+    exit_code = 0
+    for fecha, tesoreria_path in args.run:
+        if tesoreria_path not in tesoreria_by_path:
+            tesoreria_by_path[tesoreria_path] = load_tesoreria_df(tesoreria_path)
+        fecha_nomina = pd.Timestamp(fecha).normalize()
+        try:
+            if args.incremental:
+                payroll = run_payroll_validation(
+                    df_nomina_base,
+                    tesoreria_by_path[tesoreria_path],
+                    fecha_nomina,
+                    incremental=True,
+                    supplier_index=indice_base,
+                )
+            else:
+                # Todas las fechas de un mismo archivo de Tesorería se evalúan
+                # juntas, compartiendo el orden por vencimiento y los anticipos.
+                if tesoreria_path not in scenarios_by_path:
+                    scenarios_by_path[tesoreria_path] = _evaluate_payroll_dates(
+                        df_nomina_base,
+                        tesoreria_by_path[tesoreria_path],
+                        [run_fecha for run_fecha, path in args.run if path == tesoreria_path],
+                        indice_base,
+                    )
+                payroll = scenarios_by_path[tesoreria_path][fecha_nomina]
+                if isinstance(payroll, EmptyPayrollError):
+                    raise payroll
+        except EmptyPayrollError as warning:
+            LOGGER.warning(f"[nómina {fecha_nomina:%Y-%m-%d}] {warning}")
+            exit_code = 1
+            continue
+        written_paths = write_payroll_outputs(
+            payroll,
+            os.path.join(args.salida, f"{fecha_nomina:%Y-%m-%d}"),
+            zip_por_acreedor=args.zip_por_acreedor,
+            csv_gzip=args.csv,
+            parquet=args.parquet,
+        )
+        if args.registrar_pagos:
+            record_paid_documents(get_exported_documents(payroll), fecha_nomina)
+        LOGGER.info(
+            f"[nómina {fecha_nomina:%Y-%m-%d}] partidas={len(payroll.documentos_fecha):,} "
+            f"pagables={len(payroll.nomina_con_calculos):,} "
+            f"bloqueadas={len(payroll.facturas_bloqueadas):,} "
+            f"retenidas={len(payroll.documentos_retenidos):,} "
+            f"posibles_duplicados={len(payroll.posibles_duplicados):,} "
+            f"acreedores_exportables={len(payroll.acreedores_exportables):,}"
+            + (
+                f" proveedores_recalculados={payroll.proveedores_recalculados:,}"
+                f" proveedores_reutilizados={payroll.proveedores_reutilizados:,}"
+                if args.incremental
+                else ""
+            )
+        )
+        for path in written_paths:
+            LOGGER.info(f"  {path}")
+    return exit_code
 
-# --- Funciones de Carga y Limpieza de Datos ---
-def filter_eligible_payment_documents(df: pd.DataFrame) -> pd.DataFrame:
-    """Conserva sólo partidas sin bloqueo A ni vía de pago C."""
-    missing_columns = [column for column in PAYMENT_CONTROL_COLUMNS if column not in df]
-    if missing_columns:
-        raise ValueError(
-            "La Lista PI no contiene columnas requeridas para validar la nómina: "
-            + ", ".join(missing_columns)
+
+def _evaluate_payroll_dates(df_nomina_base, df_tesoreria, fechas, supplier_index) -> dict:
+    """`run_payroll_scenarios` que reporta una propuesta vacía en cada fecha."""
+    try:
+        return run_payroll_scenarios(df_nomina_base, df_tesoreria, fechas, supplier_index)
+    except EmptyPayrollError as warning:
+        return {pd.Timestamp(fecha).normalize(): warning for fecha in fechas}
+
+
+def _run_batch_streaming(args: argparse.Namespace) -> int:
+    """Ejecuta las nóminas sobre una Lista PI repartida una sola vez por proveedor."""
+    tesoreria_by_path = {}
+    exit_code = 0
+    with tempfile.TemporaryDirectory(prefix="prenomina-particiones-") as partition_dir:
+        partition_lista_pi(
+            args.lista_pi[0],
+            partition_dir,
+            chunk_rows=args.bloque_filas,
+            partitions=args.particiones,
         )
+        for fecha, tesoreria_path in args.run:
+            if tesoreria_path not in tesoreria_by_path:
+                tesoreria_by_path[tesoreria_path] = load_tesoreria_df(tesoreria_path)
+            fecha_nomina = pd.Timestamp(fecha).normalize()
+            try:
+                summary = run_payroll_streaming(
+                    partition_dir,
+                    tesoreria_by_path[tesoreria_path],
+                    fecha_nomina,
+                    os.path.join(args.salida, f"{fecha_nomina:%Y-%m-%d}"),
+                    zip_por_acreedor=args.zip_por_acreedor,
+                    csv_gzip=args.csv,
+                    parquet=args.parquet,
+                    record_paid=args.registrar_pagos,
+                )
+            except EmptyPayrollError as warning:
+                LOGGER.warning(f"[nómina {fecha_nomina:%Y-%m-%d}] {warning}")
+                exit_code = 1
+                continue
+            LOGGER.info(
+                f"[nómina {fecha_nomina:%Y-%m-%d}] partidas={summary.partidas:,} "
+                f"pagables={summary.pagables:,} "
+                f"bloqueadas={summary.bloqueadas:,} "
+                f"retenidas={summary.retenidas:,} "
+                f"posibles_duplicados={summary.posibles_duplicados:,} "
+                f"acreedores_exportables={len(summary.acreedores_exportables):,}"
+            )
+            for path in summary.written_paths:
+                LOGGER.info(f"  {path}")
+    return exit_code
 
-    payment_block = df["bloqueo_de_pago"].fillna("").astype(str).str.strip().str.upper()
-    payment_method = df["v_a_de_pago"].fillna("").astype(str).str.strip().str.upper()
-    return df[payment_block.ne("A") & payment_method.ne("C")].copy()
 
+# --- Resultados por etapa en la sesión de Streamlit ---
+SESSION_STAGE_CACHE_KEY = "prenomina_etapas"
+SESSION_JOB_KEY = "prenomina_trabajo"
 
 
-def mark_factoring_references(df: pd.DataFrame) -> pd.DataFrame:
-    """Marca documentos cedidos a una cuenta de factoring."""
-    marked_df = df.copy()
-    marked_df["referencia_factoring"] = (
-        marked_df.get("referencia", pd.Series("", index=marked_df.index))
-        .fillna("")
-        .astype(str)
-        .str.contains("FACTORING", case=False, na=False)
-    )
-    return marked_df
+def get_session_stage(name: str, key, compute):
+    """Resultado de una etapa guardado en la sesión, o calculado con `compute`.
 
+    Cada etapa conserva sólo el resultado de su última clave; si la clave
+    cambia (otro archivo, otra fecha), la etapa se recalcula y reemplaza al
+    anterior. Las etapas previas con la misma clave se reutilizan.
+    """
+    stages = st.session_state.setdefault(SESSION_STAGE_CACHE_KEY, {})
+    cached = stages.get(name)
+    if cached is not None and cached[0] == key:
+        return cached[1]
+    value = compute()
+    stages[name] = (key, value)
+    return value
 
-@st.cache_data
-def load_nomina_df(uploaded_file):
-    """Carga y limpia el archivo de nómina (Lista PI Acreedores)."""
-    df = pd.read_excel(uploaded_file)
-    df = clean_names(df)  # Limpia nombres de columnas
 
-    # Filtrar y limpiar datos
-    df = (
-        df.astype({"cuenta": "Int64"})
-        .drop(columns=COLUMNS_TO_DROP_NOMINA, errors="ignore")
-        .dropna(subset=["cuenta"])
-    )
-    df = filter_eligible_payment_documents(df)
-    df = mark_factoring_references(df)
-    df = df.drop(columns=COLUMNS_TO_DROP_NOMINA_POST_FILTER, errors="ignore")
+def read_session_stage(name: str):
+    """Valor vigente de una etapa ya guardada en la sesión."""
+    return st.session_state[SESSION_STAGE_CACHE_KEY][name][1]
 
-    # Convertir fechas a solo date (sin hora)
-    for col in ["fe_contabilizaci_n", "fecha_de_documento", "vencimiento_neto"]:
-        if col in df.columns:
-            df[col] = pd.to_datetime(df[col], errors="coerce").dt.date
 
-    return df
+def get_missing_session_stages(stage_keys: dict) -> list[str]:
+    """Etapas de `stage_keys` (nombre → clave) que no están en la sesión con esa clave."""
+    stages = st.session_state.get(SESSION_STAGE_CACHE_KEY, {})
+    return [
+        name
+        for name, key in stage_keys.items()
+        if name not in stages or stages[name][0] != key
+    ]
 
 
-@st.cache_data
-def load_tesoreria_df(uploaded_file):
-    """Carga y limpia el archivo de Tesorería."""
-    df_tes = pd.read_excel(uploaded_file)
-    df_tes = df_tes.rename(columns={"Proveedor": "cuenta"})
-    df_tes = clean_names(df_tes)  # Aplicar clean_names después del rename
+def detach_upload(uploaded_file) -> io.BytesIO:
+    """Copia en memoria de un archivo subido, para leerlo fuera del hilo del script."""
+    # Sin `name`: el hash de `st.cache_data` trataría la copia como un archivo
+    # en disco. Una BytesIO anónima se identifica por su contenido.
+    return io.BytesIO(uploaded_file.getvalue())
 
-    # Usar nombres de columna limpios por janitor
-    # 'nº_documento_de_pago' -> 'n_documento_de_pago'
-    # 'importe_pagado_en_ml' ya está limpio
-    df_tes = df_tes.dropna(subset=["n_documento_de_pago"]).copy()
-    df_tes["importe_pagado_en_ml"] = pd.to_numeric(
-        df_tes["importe_pagado_en_ml"], errors="coerce"
-    )
-    df_tes = df_tes.dropna(subset=["importe_pagado_en_ml"])
-    # Los $10 MM son prioridad de revisión, no un filtro de exclusión.
-    df_tes["prioridad_monto"] = df_tes["importe_pagado_en_ml"].abs().ge(10_000_000)
-    df_tes = df_tes.sort_values(
-        by=["prioridad_monto", "importe_pagado_en_ml"],
-        ascending=[False, True],
-    )[["cuenta", "importe_pagado_en_ml", "prioridad_monto"]]
-    # Asegurar que 'cuenta' en tesorería también sea Int64 para consistencia
-    if "cuenta" in df_tes.columns:
+
+def _prepare_uploaded_proposal(
+    files_nomina, file_tesoreria, company_names=None
+) -> tuple[PayrollProposal, int]:
+    """Carga los archivos y prepara la propuesta que no depende de la fecha.
+
+    Tesorería se carga en otro hilo mientras se cargan las Listas PI, que se
+    unen en un solo universo cuando son varias (`load_lista_pi_files`).
+    """
+    with concurrent.futures.ThreadPoolExecutor(
+        max_workers=1, thread_name_prefix="prenomina-carga"
+    ) as pool:
+        tesoreria_future = submit_in_current_context(pool, load_tesoreria_df, file_tesoreria)
         try:
-            df_tes["cuenta"] = df_tes["cuenta"].astype("Int64")
-        except (ValueError, TypeError):
-            st.error(
-                "No se pudo convertir la columna 'cuenta' de Tesorería a tipo numérico entero. Verifique que la columna 'Proveedor' contiene solo valores numéricos."
+            df_nomina = load_lista_pi_files(files_nomina, company_names)
+            supplier_index = (
+                load_nomina_supplier_index(files_nomina[0])
+                if len(files_nomina) == 1
+                else build_supplier_index(df_nomina)
             )
-            st.stop()
-    return df_tes
+        finally:
+            df_tesoreria = tesoreria_future.result()
+    proposal = prepare_payroll_proposal(df_nomina, df_tesoreria, supplier_index)
+    return proposal, int(df_tesoreria["prioridad_monto"].sum())
 
 
-# --- Funciones de Procesamiento ---
-def get_document_type_column(df: pd.DataFrame) -> str:
-    """Obtiene la columna SAP que contiene la clase de documento."""
-    for column in DOCUMENT_TYPE_COLUMN_CANDIDATES:
-        if column in df.columns:
-            return column
-    raise ValueError("No se encontró la columna de clase de documento SAP.")
+def compute_payroll_stages(
+    files_nomina,
+    file_tesoreria,
+    fecha_referencia_dt,
+    incremental: bool,
+    fechas_escenario,
+    missing: list[str],
+    proposal_stage=None,
+    company_names=None,
+) -> dict:
+    """Calcula las etapas `missing` de la sesión; se ejecuta en el trabajo de fondo.
 
+    `proposal_stage` es la propuesta vigente en la sesión, si no hay que
+    recalcularla. `company_names` son los nombres de las Listas PI subidas, de
+    los que sale la sociedad. Devuelve el valor de cada etapa calculada.
+    """
+    steps = [
+        (name, label)
+        for name, label in (
+            ("propuesta", "Carga de archivos"),
+            ("nomina", "Validación de la nómina"),
+            ("escenarios", "Escenarios por fecha"),
+        )
+        if name in missing
+    ]
+    computed = {}
+    for step, (name, label) in enumerate(steps):
+        report_progress(label, step, len(steps))
+        if name == "propuesta":
+            proposal_stage = computed[name] = _prepare_uploaded_proposal(
+                files_nomina, file_tesoreria, company_names
+            )
+        elif name == "nomina":
+            computed[name] = _cut_or_empty(
+                proposal_stage[0], fecha_referencia_dt, incremental
+            )
+        else:
+            computed[name] = evaluate_payroll_dates(proposal_stage[0], fechas_escenario)
+    report_progress("Listo", len(steps), len(steps))
+    return computed
 
-def get_amount_column(df: pd.DataFrame) -> str:
-    """Obtiene la columna de importe de la Lista PI."""
-    candidates = [column for column in df.columns if column.startswith("importe_en_moneda")]
-    if len(candidates) != 1:
-        raise ValueError("No se pudo identificar de forma unívoca la columna de importe.")
-    return candidates[0]
 
+@st.fragment(run_every=BACKGROUND_POLL_SECONDS)
+def _render_job_progress(job: BackgroundJob) -> None:
+    """Barra de avance que se refresca sola; recarga la página al terminar."""
+    if job.done():
+        st.rerun()
+    fraction, text = job.progress()
+    st.progress(fraction, text=text or "Preparando…")
 
-def validate_payment_risk(
-    df_nomina: pd.DataFrame,
-    advance_source: pd.DataFrame | None = None,
-) -> tuple[pd.DataFrame, pd.DataFrame, pd.DataFrame]:
-    """Alerta sobre facturas de proveedores con anticipos AB/SA asociados.
 
-    Los AB/SA de la fecha de nómina permanecen incluidos y se reportan. Sólo se
-    retienen cuando compensan exactamente otra factura propuesta. Los AB/SA de
-    otras fechas se usan como referencia de control, sin incorporarse a la nómina.
-    Las notas de crédito/débito (EC/ED) son correcciones de monto al pago del
-    proveedor y se incluyen siempre en la nómina pagable.
+def run_stages_in_background(
+    stage_keys: dict, start, trace_memory: bool = False
+) -> tuple[bool, BackgroundJob | None]:
+    """Asegura en la sesión las etapas de `stage_keys` calculándolas en segundo plano.
 
-    Un AB/SA sólo se considera anticipo ya contabilizado (y por lo tanto ya
-    pagado, sin deuda pendiente contra el acreedor) cuando su importe está
-    contabilizado con signo positivo en la cuenta del acreedor. Un AB/SA con
-    signo negativo no constituye evidencia de un anticipo ya cubierto, por lo
-    que no gatilla la alerta preventiva.
+    Si faltan etapas, `start(job, missing)` inicia el trabajo que las calcula
+    y la página muestra su avance con un botón para cancelar. Devuelve si las
+    etapas están listas en la sesión y, si se acaban de calcular, el trabajo
+    terminado. Mientras el trabajo sigue en curso o si se canceló, devuelve
+    `(False, None)`.
 
-    Además, se marca `requiere_revision_manual` cuando un proveedor tiene
-    anticipos AB/SA (con signo positivo) relacionados, para validar el pago
-    antes de liberarlo.
+    El trabajo se reconoce por atributos y no por su clase: Streamlit vuelve a
+    ejecutar el script en cada recarga y las clases cambian de identidad.
     """
-    document_type_column = get_document_type_column(df_nomina)
-    amount_column = get_amount_column(df_nomina)
-    validated_df = df_nomina.copy()
-    validated_df["clase_documento_sap"] = (
-        validated_df[document_type_column].fillna("").astype(str).str.strip().str.upper()
-    )
-    validated_df["monto_comparacion"] = (
-        pd.to_numeric(validated_df[amount_column], errors="coerce").abs().round(0)
-    )
-    generic_mask = validated_df["clase_documento_sap"].isin(
-        GENERIC_ACCOUNTING_DOCUMENT_TYPES
-    )
-    validated_df["es_anticipo_potencial"] = generic_mask
-    validated_df["estado_validacion"] = "APTO_PARA_CRUCE"
-    validated_df["documentos_anticipo_relacionados"] = ""
-    validated_df["requiere_revision_manual"] = False
+    missing = get_missing_session_stages(stage_keys)
+    if not missing:
+        return True, None
+    job_key = tuple(stage_keys.items())
+    job = st.session_state.get(SESSION_JOB_KEY)
+    if job is None or job.key != job_key:
+        if job is not None:
+            job.cancel()
+        job = BackgroundJob(job_key, trace_memory)
+        start(job, missing)
+        st.session_state[SESSION_JOB_KEY] = job
+
+    if not job.done():
+        _render_job_progress(job)
+        st.button("Cancelar procesamiento", on_click=job.cancel)
+        return False, None
+    try:
+        computed = job.result()
+    except Exception:
+        if job.cancel_event.is_set():
+            st.warning("Se canceló el procesamiento. Los archivos y la fecha se mantienen.")
+            st.button(
+                "Reanudar procesamiento",
+                on_click=lambda: st.session_state.pop(SESSION_JOB_KEY, None),
+            )
+            return False, None
+        # Un error se informa una vez; la siguiente interacción reintenta.
+        st.session_state.pop(SESSION_JOB_KEY, None)
+        raise
+    st.session_state.pop(SESSION_JOB_KEY, None)
+    stages = st.session_state.setdefault(SESSION_STAGE_CACHE_KEY, {})
+    for name, value in computed.items():
+        stages[name] = (stage_keys[name], value)
+    return True, job
+
 
-    source_df = advance_source.copy() if advance_source is not None else df_nomina.copy()
-    source_type_column = get_document_type_column(source_df)
-    source_amount_column = get_amount_column(source_df)
-    source_df["clase_documento_sap"] = (
-        source_df[source_type_column].fillna("").astype(str).str.strip().str.upper()
+def get_session_view_summary(
+    name: str, key, df: pd.DataFrame, supplier_index: SupplierIndex | None = None
+) -> pd.DataFrame:
+    """Resumen por proveedor de una tabla, guardado en la sesión con la clave de la nómina."""
+    return get_session_stage(
+        f"resumen_{name}", key, lambda: summarize_by_supplier(df, supplier_index)
     )
-    source_df["monto_bruto"] = pd.to_numeric(source_df[source_amount_column], errors="coerce")
-    source_df["monto_comparacion"] = source_df["monto_bruto"].abs().round(0)
-    # Sólo un AB/SA contabilizado en positivo representa un anticipo ya
-    # pagado; uno en negativo no acredita que no exista deuda con el acreedor.
-    advance_confirmed_mask = source_df["clase_documento_sap"].isin(
-        GENERIC_ACCOUNTING_DOCUMENT_TYPES
-    ) & source_df["monto_bruto"].gt(0)
-    advances = source_df[advance_confirmed_mask].copy()
-    advances["indice_anticipo"] = advances.index
 
-    invoices = validated_df[
-        validated_df["estado_validacion"].eq("APTO_PARA_CRUCE") & ~generic_mask
-    ].copy()
-    invoices["indice_factura"] = invoices.index
-    matches = advances.merge(
-        invoices,
-        on=["cuenta"],
-        how="inner",
-        suffixes=("_anticipo", "_factura"),
-    )
-    if not matches.empty:
-        advance_references = (
-            matches.groupby("indice_factura")["n_documento_anticipo"]
-            .apply(lambda docs: ", ".join(sorted({str(doc) for doc in docs})))
-            .to_dict()
-        )
-        candidate_advance_indexes = set(validated_df.index[generic_mask])
-        matched_advance_indexes = set(matches["indice_anticipo"])
-        matched_advance_indexes_in_nomina = (
-            candidate_advance_indexes & matched_advance_indexes
-        )
-        validated_df.loc[
-            validated_df.index.isin(matched_advance_indexes_in_nomina),
-            "requiere_revision_manual",
-        ] = True
-        validated_df.loc[
-            validated_df.index.isin(advance_references),
-            "requiere_revision_manual",
-        ] = True
-        for invoice_index, references in advance_references.items():
-            validated_df.loc[
-                invoice_index, "documentos_anticipo_relacionados"
-            ] = references
 
-    retained_df = validated_df[
-        validated_df["estado_validacion"].ne("APTO_PARA_CRUCE")
-    ].copy()
-    blocked_invoices_df = validated_df[
-        validated_df["requiere_revision_manual"] & ~generic_mask
-    ].copy()
-    payable_df = validated_df[
-        validated_df["estado_validacion"].eq("APTO_PARA_CRUCE")
-    ].copy()
-    return payable_df, retained_df, blocked_invoices_df
-def process_nomina_data_dates(df_nomina_input, fecha_referencia_dt):
-    """Calcula las diferencias de días y añade columnas al DataFrame de nómina."""
-    df_processed = df_nomina_input.copy()
+def _cut_or_empty(proposal: PayrollProposal, fecha_referencia, incremental: bool):
+    """`cut_payroll_proposal` que devuelve el `EmptyPayrollError` en vez de lanzarlo."""
+    try:
+        return cut_payroll_proposal(proposal, fecha_referencia, incremental=incremental)
+    except EmptyPayrollError as warning:
+        return warning
 
-    ref_date = (
-        fecha_referencia_dt.date()
-        if hasattr(fecha_referencia_dt, "date")
-        else fecha_referencia_dt
-    )
-    if "fecha_de_documento" in df_processed.columns:
-        df_processed["dias_fecha_documento"] = df_processed["fecha_de_documento"].apply(
-            lambda d: (ref_date - d).days if pd.notna(d) else None
-        )
-    if "vencimiento_neto" in df_processed.columns:
-        df_processed["dias_vencimiento"] = df_processed["vencimiento_neto"].apply(
-            lambda d: (ref_date - d).days if pd.notna(d) else None
-        )
-    return df_processed
 
+def lazy_export(exports: dict, kind: str, build):
+    """Función sin argumentos que genera un archivo al descargarlo y lo reutiliza."""
 
-# --- Funciones de Generación de Archivos ---
-def get_exportable_creditors(df: pd.DataFrame) -> list[int]:
-    """Obtiene acreedores de la nómina con total igual o menor a -$10 MM."""
-    required_columns = {"cuenta", "importe_en_moneda_doc"}
-    missing_columns = required_columns.difference(df.columns)
-    if missing_columns:
-        raise ValueError(
-            "Faltan columnas para calcular acreedores exportables: "
-            + ", ".join(sorted(missing_columns))
-        )
+    def export() -> bytes:
+        if kind not in exports:
+            exports[kind] = build()
+        return exports[kind]
 
-    totals = (
-        df.groupby("cuenta", as_index=False)["importe_en_moneda_doc"]
-        .sum()
-        .sort_values("importe_en_moneda_doc")
+    return export
+
+
+# --- Vistas paginadas ---
+def summarize_by_supplier(
+    df: pd.DataFrame, supplier_index: SupplierIndex | None = None
+) -> pd.DataFrame:
+    """Una fila por proveedor: cuenta, nombre, partidas e importe total.
+
+    Se ordena desde la mayor deuda. Con `supplier_index` del mismo DataFrame se
+    reutilizan sus grupos en lugar de agrupar de nuevo.
+    """
+    if supplier_index is None or not supplier_index.matches(df):
+        supplier_index = build_supplier_index(df)
+    cuentas = list(supplier_index.positions)
+    summary = pd.DataFrame(
+        {
+            "cuenta": cuentas,
+            "nombre_1": [supplier_index.names.get(cuenta) for cuenta in cuentas],
+            "partidas": [len(supplier_index.positions[cuenta]) for cuenta in cuentas],
+            "importe_en_moneda_doc": supplier_index.totals.reindex(cuentas).to_numpy(),
+        }
+    )
+    return summary.sort_values(
+        ["importe_en_moneda_doc", "cuenta"], kind="stable", ignore_index=True
     )
-    return totals.loc[
-        totals["importe_en_moneda_doc"].le(-MINIMUM_EXPORT_TOTAL_CLP), "cuenta"
-    ].tolist()
-def generate_excel_bytes(
-    df_data_for_excel: pd.DataFrame,
-    lista_cuentas_proveedores: list[int],
-) -> bytes:
-    """Genera hojas ordenadas para acreedores con total de nómina menor a -$10 MM."""
-    exportable_accounts = set(get_exportable_creditors(df_data_for_excel))
-    lista_cuentas_proveedores = [
-        cuenta for cuenta in lista_cuentas_proveedores if cuenta in exportable_accounts
-    ]
 
-    # Construir mapeo cuenta -> nombre_1
-    if "nombre_1" in df_data_for_excel.columns:
-        nombre_map = (
-            df_data_for_excel[["cuenta", "nombre_1"]]
-            .drop_duplicates("cuenta")
-            .set_index("cuenta")["nombre_1"]
-            .to_dict()
-        )
-    else:
-        nombre_map = {}
 
-    output_buffer = io.BytesIO()
-    with pd.ExcelWriter(output_buffer, engine="xlsxwriter") as writer:
-        for cuenta_proveedor in lista_cuentas_proveedores:
-            df_sheet = df_data_for_excel[
-                df_data_for_excel["cuenta"] == cuenta_proveedor
-            ]
-            if not df_sheet.empty:  # Solo crear hoja si hay datos para ese proveedor
-                df_sheet = df_sheet.drop(
-                    columns=EXPORT_COLUMNS_TO_EXCLUDE,
-                    errors="ignore",
-                )
-                raw_name = str(nombre_map.get(cuenta_proveedor, cuenta_proveedor))
-                sheet_name = re.sub(r"[:/\\?*\[\]]", "_", raw_name)[:31]
-                df_sheet.to_excel(writer, sheet_name=sheet_name, index=False)
-    return output_buffer.getvalue()
+def filter_by_suppliers(
+    df: pd.DataFrame, cuentas, supplier_index: SupplierIndex | None = None
+) -> pd.DataFrame:
+    """Filas de `cuentas` en el orden del DataFrame; sin cuentas, el DataFrame completo."""
+    if not cuentas:
+        return df
+    if supplier_index is not None and supplier_index.matches(df):
+        return supplier_index.take(df, cuentas)
+    return df[df["cuenta"].isin(cuentas)]
 
 
-def main():
-    """Función principal de la aplicación Streamlit."""
-    # --- Configuración de la Página ---
-    st.set_page_config(page_title="Pre-nómina", layout="wide")
-    st.title("Nómina de Acreedores")
+def get_page(df: pd.DataFrame, page: int, page_size: int) -> tuple[pd.DataFrame, int]:
+    """Filas de la página `page` (desde 1) y el total de páginas.
 
-    # --- Sidebar: Entradas del Usuario ---
-    st.sidebar.header("Seleccionar fecha de nómina")
-    default_date_val = date.today()
-    fecha_referencia_input = st.sidebar.date_input(
-        "Fecha de nómina (corte de vencimiento)", value=default_date_val
+    Una página fuera de rango se ajusta a la primera o a la última.
+    """
+    pages = max(1, -(-len(df) // page_size))
+    page = min(max(page, 1), pages)
+    start = (page - 1) * page_size
+    return df.iloc[start : start + page_size], pages
+
+
+def _render_page(df: pd.DataFrame, page_key: str, **dataframe_kwargs):
+    """Muestra una página de `df` con sus controles; devuelve lo que entrega `st.dataframe`."""
+    number_key = f"{page_key}_pagina"
+    size_column, page_column, caption_column = st.columns([1, 1, 3])
+    page_size = size_column.selectbox(
+        "Filas por página",
+        VIEW_PAGE_SIZES,
+        index=VIEW_PAGE_SIZES.index(VIEW_DEFAULT_PAGE_SIZE),
+        key=f"{page_key}_filas",
     )
+    pages = max(1, -(-len(df) // page_size))
+    # Un filtro puede dejar menos páginas que la elegida antes.
+    if st.session_state.get(number_key, 1) > pages:
+        st.session_state[number_key] = pages
+    page = page_column.number_input(
+        "Página", min_value=1, max_value=pages, step=1, key=number_key
+    )
+    rows, _ = get_page(df, int(page), page_size)
+    caption_column.caption(f"Página {int(page):,} de {pages:,} · {len(df):,} fila(s)")
+    return st.dataframe(rows, use_container_width=True, hide_index=True, **dataframe_kwargs)
 
-    st.sidebar.header("Carga de archivos")
-    file_nomina = st.sidebar.file_uploader(
-        "Subir archivo de Lista PI Acreedores", type=["xlsx"]
+
+def render_supplier_view(
+    df: pd.DataFrame,
+    key: str,
+    summary: pd.DataFrame,
+    supplier_index: SupplierIndex | None = None,
+) -> None:
+    """Vista paginada de `df`: resumen por proveedor o detalle por documento.
+
+    El resumen es la vista por defecto. Al seleccionar un proveedor del resumen
+    se cargan sólo sus documentos. El filtro de proveedores se aplica en el
+    servidor y al navegador llega únicamente la página visible.
+    """
+    names = {
+        cuenta: nombre
+        for cuenta, nombre in zip(summary["cuenta"], summary["nombre_1"])
+        if pd.notna(nombre)
+    }
+    filter_column, view_column = st.columns([3, 2])
+    cuentas = filter_column.multiselect(
+        "Filtrar proveedores",
+        summary["cuenta"].tolist(),
+        format_func=lambda cuenta: f"{cuenta} · {names[cuenta]}" if cuenta in names else str(cuenta),
+        key=f"{key}_proveedores",
     )
-    file_tesoreria = st.sidebar.file_uploader(
-        "Subir archivo de Tesorería", type=["xlsx"]
+    view = view_column.radio(
+        "Vista", (VIEW_SUMMARY, VIEW_DETAIL), horizontal=True, key=f"{key}_vista"
+    )
+    if view == VIEW_DETAIL:
+        _render_page(filter_by_suppliers(df, cuentas, supplier_index), f"{key}_detalle")
+        return
+
+    summary_rows = summary[summary["cuenta"].isin(cuentas)] if cuentas else summary
+    event = _render_page(
+        summary_rows,
+        f"{key}_resumen",
+        on_select="rerun",
+        selection_mode="single-row",
+        key=f"{key}_seleccion",
+    )
+    selected_rows = event.selection.rows if event is not None else []
+    if not selected_rows:
+        st.caption("Selecciona un proveedor para ver sus documentos.")
+        return
+    page_size = st.session_state[f"{key}_resumen_filas"]
+    page = st.session_state[f"{key}_resumen_pagina"]
+    visible, _ = get_page(summary_rows, int(page), page_size)
+    if selected_rows[0] >= len(visible):
+        return  # La selección corresponde a otra página u otro filtro
+    cuenta = visible["cuenta"].iloc[selected_rows[0]]
+    st.write(f"Documentos del proveedor {cuenta} {names.get(cuenta, '')}".rstrip())
+    _render_page(
+        filter_by_suppliers(df, [cuenta], supplier_index), f"{key}_proveedor_{cuenta}"
     )
 
+
+def render_payroll(
+    files_nomina,
+    file_tesoreria,
+    fecha_referencia_input,
+    fechas_escenario,
+    revalidacion_incremental: bool,
+    instrumentation: PipelineInstrumentation,
+) -> None:
+    """Procesa los archivos subidos y muestra la nómina, sus controles y la descarga."""
     # --- Lógica Principal de Procesamiento ---
-    if file_nomina and file_tesoreria:
+    if files_nomina and file_tesoreria:
         try:
             # Convertir fecha de referencia (datetime.date) a Timestamp de pandas para cálculos
             fecha_referencia_dt = pd.to_datetime(fecha_referencia_input)
 
-            # Cargar DataFrames usando funciones cacheadas
-            df_nomina_base = load_nomina_df(file_nomina)
-            df_tesoreria = load_tesoreria_df(file_tesoreria)
-
-            if df_nomina_base.empty or df_tesoreria.empty:
-                st.warning(
-                    "Uno o ambos archivos están vacíos o no se pudieron procesar correctamente. Por favor, verifique los archivos."
-                )
-                return  # Detener ejecución si los datos base no son válidos
-
-            # Tesorería define los proveedores y la fecha de nómina es el corte de vencimiento.
-            lista_proveedores_tesoreria = df_tesoreria["cuenta"].unique().tolist()
-            df_nomina_propuesta = df_nomina_base[
-                df_nomina_base["cuenta"].isin(lista_proveedores_tesoreria)
-            ].copy()
-            if df_nomina_propuesta.empty:
-                st.warning(
-                    "No se encontraron partidas abiertas en Lista PI para los "
-                    "proveedores incluidos en la nómina de Tesorería."
-                )
-                return
-            if "vencimiento_neto" not in df_nomina_propuesta.columns:
-                raise ValueError(
-                    "La Lista PI no contiene la columna Vencimiento neto, "
-                    "requerida para definir la nómina semanal."
-                )
+            # Cada etapa se guarda en la sesión con la clave de sus entradas:
+            # cambiar la fecha sólo recalcula lo posterior al corte.
+            # El nombre de cada Lista PI entra en la clave: de él sale la sociedad.
+            files_key = (
+                tuple(
+                    (file.name, get_file_content_hash(file)) for file in files_nomina
+                ),
+                get_file_content_hash(file_tesoreria),
+            )
+            payroll_key = (
+                files_key,
+                fecha_referencia_dt.normalize(),
+                revalidacion_incremental,
+            )
+            stage_keys = {"propuesta": files_key, "nomina": payroll_key}
+            if fechas_escenario:
+                stage_keys["escenarios"] = (files_key, tuple(fechas_escenario))
 
-            fecha_nomina = fecha_referencia_dt.date()
-            df_documentos_fecha = df_nomina_propuesta[
-                df_nomina_propuesta["vencimiento_neto"].le(fecha_nomina)
-            ].copy()
-            if df_documentos_fecha.empty:
-                st.warning(
-                    f"No hay partidas con vencimiento neto hasta {fecha_nomina:%d-%m-%Y} "
-                    "para los proveedores de Tesorería."
+            # Las etapas que faltan se calculan en un hilo de fondo; la
+            # página muestra el avance y se recarga al terminar.
+            def start_job(job: BackgroundJob, missing: list[str]) -> None:
+                job.start(
+                    compute_payroll_stages,
+                    [detach_upload(file) for file in files_nomina],
+                    detach_upload(file_tesoreria),
+                    fecha_referencia_dt,
+                    revalidacion_incremental,
+                    tuple(fechas_escenario),
+                    missing,
+                    None if "propuesta" in missing else read_session_stage("propuesta"),
+                    [file.name for file in files_nomina],
                 )
-                return
 
-            clases_documento_fecha = (
-                df_documentos_fecha["clase_de_documento"]
-                .fillna("")
-                .astype(str)
-                .str.strip()
-                .str.upper()
+            ready, finished_job = run_stages_in_background(
+                stage_keys, start_job, instrumentation.trace_memory
             )
-            df_anticipos_nomina = df_documentos_fecha[
-                clases_documento_fecha.isin(GENERIC_ACCOUNTING_DOCUMENT_TYPES)
-            ].copy()
+            if not ready:
+                return  # En curso o cancelado: la página ya muestra el estado
+            if finished_job is not None:
+                instrumentation.include_job(finished_job.instrumentation)
+
+            proposal, pagos_prioritarios = read_session_stage("propuesta")
+            payroll = read_session_stage("nomina")
+            # EmptyPayrollError de una ejecución anterior del script.
+            if isinstance(payroll, Exception):
+                st.warning(str(payroll))
+                return  # Detener ejecución si no hay partidas que validar
+            escenarios = {}
+            if fechas_escenario:
+                escenarios = {
+                    payroll.fecha_nomina: payroll,
+                    **read_session_stage("escenarios"),
+                }
+            fecha_nomina = payroll.fecha_nomina
+            df_documentos_fecha = payroll.documentos_fecha
+            df_anticipos_nomina = payroll.anticipos_nomina
+            df_documentos_retenidos = payroll.documentos_retenidos
+            df_facturas_bloqueadas = payroll.facturas_bloqueadas
+            df_nomina_con_calculos = payroll.nomina_con_calculos
 
             st.info(
                 f"Propuesta con vencimiento neto hasta {fecha_nomina:%d-%m-%Y}: "
                 f"{len(df_documentos_fecha):,} partidas."
             )
-            df_nomina_validada, df_documentos_retenidos, df_facturas_bloqueadas = (
-                validate_payment_risk(
-                    df_documentos_fecha,
-                    advance_source=df_nomina_propuesta,
+            if payroll.proveedores_recalculados is not None:
+                st.caption(
+                    f"Revalidación incremental: {payroll.proveedores_recalculados:,} "
+                    f"proveedor(es) recalculado(s) y {payroll.proveedores_reutilizados:,} "
+                    "reutilizado(s) de la validación anterior."
+                )
+            if escenarios:
+                st.write("### Escenarios por fecha de nómina")
+                st.dataframe(
+                    summarize_payroll_scenarios(escenarios),
+                    use_container_width=True,
+                    hide_index=True,
                 )
-            )
 
             st.write("### Alerta preventiva de duplicidad")
             if df_facturas_bloqueadas.empty:
@@ -426,43 +4533,104 @@ def main():
                 )
                 st.warning(
                     f"Revisa manualmente {len(proveedores_a_revisar):,} proveedor(es) "
-                    f"con anticipo AB/SA asociado a {len(df_facturas_bloqueadas):,} "
-                    "factura(s) propuesta(s). No se bloquea ningún pago automáticamente: "
+                    f"con {len(df_facturas_bloqueadas):,} factura(s) propuesta(s) "
+                    "bloqueada(s) por un anticipo AB/SA asociado o por un pago "
+                    "anterior. Las facturas quedan retenidas fuera de "
+                    "la nómina pagable hasta su revisión: "
                     f"proveedores: {', '.join(str(p) for p in proveedores_a_revisar)}."
                 )
-                st.dataframe(df_facturas_bloqueadas, use_container_width=True, hide_index=True)
+                pagadas_antes = int(
+                    df_facturas_bloqueadas["estado_validacion"]
+                    .eq(PAID_LEDGER_STATUS)
+                    .sum()
+                )
+                if pagadas_antes:
+                    st.error(
+                        f"{pagadas_antes:,} factura(s) ya figuran pagadas en una "
+                        "nómina anterior según el registro de pagos "
+                        "(columna nomina_pago_anterior)."
+                    )
+                revision_combinaciones = int(
+                    df_facturas_bloqueadas["estado_validacion"]
+                    .eq(COMBINATION_REVIEW_STATUS)
+                    .sum()
+                )
+                if revision_combinaciones:
+                    st.info(
+                        f"{revision_combinaciones:,} factura(s) quedaron en revisión "
+                        "manual por el cruce por combinaciones: suman el importe de "
+                        "anticipos (columna documentos_anticipo_relacionados) o la "
+                        "búsqueda de su proveedor superó el tiempo límite."
+                    )
+                render_supplier_view(
+                    df_facturas_bloqueadas,
+                    "bloqueadas",
+                    get_session_view_summary(
+                        "bloqueadas", payroll_key, df_facturas_bloqueadas
+                    ),
+                )
+            st.write("#### Posibles facturas duplicadas")
+            df_posibles_duplicados = payroll.posibles_duplicados
+            if df_posibles_duplicados is None or df_posibles_duplicados.empty:
+                st.success(
+                    "No se detectaron facturas de un mismo proveedor con importe, "
+                    "fecha de documento y referencia similares."
+                )
+            else:
+                st.warning(
+                    f"{len(df_posibles_duplicados):,} par(es) de facturas de "
+                    f"{df_posibles_duplicados['cuenta'].nunique():,} proveedor(es) "
+                    "podrían ser la misma factura: importe a "
+                    f"±{DUPLICATE_AMOUNT_TOLERANCE:.0%}, fechas de documento a "
+                    f"{DUPLICATE_DATE_WINDOW_DAYS} días o menos y referencia similar. "
+                    "No se retienen; revísalos antes de liberar pagos."
+                )
+                render_supplier_view(
+                    df_posibles_duplicados,
+                    "duplicados",
+                    get_session_view_summary(
+                        "duplicados", payroll_key, df_posibles_duplicados
+                    ),
+                )
+            if payroll.tiempos_duplicados is not None and len(
+                payroll.tiempos_duplicados
+            ):
+                with st.expander("Tiempo de la búsqueda de duplicados por proveedor"):
+                    _render_page(payroll.tiempos_duplicados, "duplicados_tiempos")
+
             if not df_documentos_retenidos.empty:
                 st.warning(
                     f"Se retuvieron {len(df_documentos_retenidos):,} documentos "
                     "antes del cruce. Revísalos antes de liberar pagos."
                 )
-                st.dataframe(df_documentos_retenidos, use_container_width=True, hide_index=True)
-
-            # Procesar solamente documentos aptos para pago.
-            df_nomina_con_calculos = process_nomina_data_dates(
-                df_nomina_validada, fecha_referencia_dt
-            )
+                render_supplier_view(
+                    df_documentos_retenidos,
+                    "retenidos",
+                    get_session_view_summary(
+                        "retenidos", payroll_key, df_documentos_retenidos
+                    ),
+                )
 
             st.caption(
                 "La nómina semanal de Tesorería es la base del proceso. "
                 "Los pagos iguales o superiores a $10 MM se marcan como prioritarios."
             )
-            st.metric(
-                "Pagos prioritarios (≥ $10 MM)",
-                int(df_tesoreria["prioridad_monto"].sum()),
-            )
-
-            # Obtener lista única de proveedores de tesorería
-            lista_proveedores_tesoreria = df_tesoreria["cuenta"].unique().tolist()
+            st.metric("Pagos prioritarios (≥ $10 MM)", pagos_prioritarios)
 
-            # Filtrar DataFrame de nómina para mostrar en la UI
-            df_nomina_filtrada_display = df_nomina_con_calculos[
-                df_nomina_con_calculos["cuenta"].isin(lista_proveedores_tesoreria)
-            ]
-
-            # Mostrar datos filtrados
+            # La nómina ya contiene sólo proveedores de Tesorería: el filtro
+            # se aplicó una vez con el índice de proveedores.
             st.write("### Datos Filtrados de Acreedores")
-            st.dataframe(df_nomina_filtrada_display)
+            render_supplier_view(
+                df_nomina_con_calculos,
+                "nomina",
+                get_session_view_summary(
+                    "nomina",
+                    payroll_key,
+                    df_nomina_con_calculos,
+                    payroll.indice_proveedores,
+                ),
+                payroll.indice_proveedores,
+            )
 
             factoring_count = int(
                 df_nomina_con_calculos["referencia_factoring"].sum()
@@ -478,13 +4646,15 @@ def main():
                     f"Se detectaron {len(df_anticipos_nomina):,} documentos AB/SA "
                     "en la nómina. Se incluyen y quedan identificados para revisión."
                 )
-                st.dataframe(
+                render_supplier_view(
                     df_anticipos_nomina,
-                    use_container_width=True,
-                    hide_index=True,
+                    "anticipos",
+                    get_session_view_summary(
+                        "anticipos", payroll_key, df_anticipos_nomina
+                    ),
                 )
 
-            acreedores_exportables = get_exportable_creditors(df_nomina_con_calculos)
+            acreedores_exportables = payroll.acreedores_exportables
             st.metric(
                 "Acreedores exportables (total nómina ≤ -$10 MM)",
                 len(acreedores_exportables),
@@ -494,18 +4664,81 @@ def main():
                 "consideran sólo acreedores con total de nómina menor o igual a -$10 MM."
             )
 
-            excel_bytes = generate_excel_bytes(
-                df_nomina_con_calculos,
-                acreedores_exportables,
+            formato_exportacion = st.radio(
+                "Formato de exportación",
+                (
+                    "Un Excel con una hoja por acreedor",
+                    "ZIP con un Excel por acreedor",
+                    "CSV comprimido (gzip)",
+                    "Dataset Parquet por acreedor (ZIP)",
+                ),
+                horizontal=True,
             )
+            # Los archivos se generan al pulsar la descarga y se guardan
+            # en la sesión junto a la nómina de la que provienen.
+            exportaciones = get_session_stage("exportaciones", payroll_key, dict)
+            if formato_exportacion.startswith("CSV"):
+                build_export = functools.partial(
+                    generate_csv_gzip_bytes,
+                    df_nomina_con_calculos,
+                    acreedores_exportables,
+                    payroll.indice_proveedores,
+                )
+                download_label = "Descargar CSV"
+                download_file_name, download_mime = CSV_FILENAME, CSV_MIME_TYPE
+            elif formato_exportacion.startswith("Dataset"):
+                build_export = functools.partial(
+                    generate_parquet_dataset_zip_bytes,
+                    df_nomina_con_calculos,
+                    acreedores_exportables,
+                    payroll.indice_proveedores,
+                )
+                download_label = "Descargar Parquet"
+                download_file_name = PARQUET_DATASET_ZIP_FILENAME
+                download_mime = ZIP_MIME_TYPE
+            elif formato_exportacion.startswith("ZIP"):
+                build_export = functools.partial(
+                    generate_creditor_zip_bytes,
+                    df_nomina_con_calculos,
+                    acreedores_exportables,
+                    supplier_index=payroll.indice_proveedores,
+                )
+                download_label = "Descargar ZIP"
+                download_file_name, download_mime = ZIP_FILENAME, ZIP_MIME_TYPE
+            else:
+                build_export = functools.partial(
+                    generate_excel_bytes,
+                    df_nomina_con_calculos,
+                    acreedores_exportables,
+                    payroll.indice_proveedores,
+                )
+                download_label = "Descargar Excel"
+                download_file_name, download_mime = EXCEL_FILENAME, EXCEL_MIME_TYPE
 
-            if excel_bytes:  # Solo mostrar botón si se generó contenido
+            if acreedores_exportables:  # Solo mostrar botón si hay hojas que generar
                 st.download_button(
-                    label="Descargar Excel",
-                    data=excel_bytes,
-                    file_name=EXCEL_FILENAME,
-                    mime=EXCEL_MIME_TYPE,
+                    label=download_label,
+                    data=lazy_export(
+                        exportaciones, download_file_name, build_export
+                    ),
+                    file_name=download_file_name,
+                    mime=download_mime,
+                    on_click="ignore",
                 )
+                if get_paid_ledger_path() is not None and st.button(
+                    "Registrar nómina como pagada",
+                    help=(
+                        "Guarda los documentos exportados en el registro de pagos. "
+                        "En otra fecha de nómina quedarán bloqueados como pago repetido."
+                    ),
+                ):
+                    nuevos = record_paid_documents(
+                        get_exported_documents(payroll), fecha_nomina
+                    )
+                    st.success(
+                        f"Se registraron {nuevos:,} documento(s) nuevos como pagados "
+                        f"en la nómina del {fecha_nomina:%d-%m-%Y}."
+                    )
             else:
                 st.info(
                     "No se generaron datos para el archivo Excel (posiblemente no hay proveedores comunes o datos para ellos)."
@@ -526,5 +4759,93 @@ def main():
         )
 
 
+def main():
+    """Función principal de la aplicación Streamlit."""
+    # --- Configuración de la Página ---
+    st.set_page_config(page_title="Pre-nómina", layout="wide")
+    st.title("Nómina de Acreedores")
+
+    # --- Sidebar: Entradas del Usuario ---
+    st.sidebar.header("Seleccionar fecha de nómina")
+    default_date_val = date.today()
+    fecha_referencia_input = st.sidebar.date_input(
+        "Fecha de nómina (corte de vencimiento)", value=default_date_val
+    )
+    fechas_escenario = st.sidebar.multiselect(
+        "Comparar con las próximas nóminas",
+        options=get_following_payroll_dates(fecha_referencia_input),
+        format_func=lambda fecha: fecha.strftime("%d-%m-%Y"),
+        help="Evalúa las fechas elegidas junto a la principal y muestra sus totales lado a lado.",
+    )
+
+    st.sidebar.header("Carga de archivos")
+    files_nomina = st.sidebar.file_uploader(
+        "Subir archivos de Lista PI Acreedores",
+        type=["xlsx"],
+        accept_multiple_files=True,
+        help=(
+            "Una exportación por sociedad. Varios archivos se unen en una sola "
+            "nómina con la columna sociedad y el control de anticipos abarca "
+            "todas las sociedades."
+        ),
+    )
+    file_tesoreria = st.sidebar.file_uploader(
+        "Subir archivo de Tesorería", type=["xlsx"]
+    )
+    revalidacion_incremental = st.sidebar.checkbox(
+        "Revalidar sólo proveedores con cambios",
+        # Desactivada por defecto: la instantánea es un directorio único,
+        # compartido por todas las sesiones del servidor.
+        value=False,
+        help=(
+            "Compara con la última Lista PI validada y recalcula el control de "
+            "anticipos sólo para los proveedores cuyos documentos cambiaron. "
+            "La última validación se comparte entre todos los usuarios."
+        ),
+    )
+
+    mostrar_instrumentacion = st.sidebar.checkbox(
+        "Mostrar instrumentación por etapa",
+        value=False,
+        help="Tiempo, filas y memoria pico de cada etapa de la ejecución.",
+    )
+    configure_console_logging()
+    configure_stage_logging()
+    instrumentation = PipelineInstrumentation(
+        trace_memory=mostrar_instrumentacion or bool(os.environ.get(TRACE_MEMORY_ENV_VAR))
+    )
+
+    try:
+        with instrumentation.activate():
+            render_payroll(
+                files_nomina,
+                file_tesoreria,
+                fecha_referencia_input,
+                fechas_escenario,
+                revalidacion_incremental,
+                instrumentation,
+            )
+    finally:
+        if mostrar_instrumentacion:
+            st.sidebar.header("Instrumentación por etapa")
+            if instrumentation.stages:
+                st.sidebar.dataframe(
+                    instrumentation.to_frame(), use_container_width=True, hide_index=True
+                )
+            else:
+                st.sidebar.caption(
+                    "Sin etapas registradas (las cargas pueden venir de la caché)."
+                )
+            for profile_path in (
+                instrumentation.job_profile_path,
+                instrumentation.profile_path,
+            ):
+                if profile_path:
+                    st.sidebar.caption(f"Perfil cProfile: {profile_path}")
+
+
 if __name__ == "__main__":
-    main()
+    if st.runtime.exists():
+        main()
+    else:
+        sys.exit(run_batch_cli())
@@ -0,0 +1,70 @@
+#!/usr/bin/env python
+# coding: utf-8
+"""Escritura de los libros Excel por acreedor.
+
+Estas funciones viven fuera del script de Streamlit porque los procesos de
+la exportación ZIP las importan por nombre. Streamlit reemplaza `__main__`
+en cada ejecución del script, así que una función definida en el script no
+se puede referenciar con seguridad desde otro proceso.
+"""
+
+import io
+import re
+
+import pandas as pd
+import xlsxwriter
+
+
+EXCEL_DATE_FORMAT = "YYYY-MM-DD"
+
+
+def new_export_workbook(target) -> xlsxwriter.Workbook:
+    """Libro xlsxwriter que escribe fila a fila con memoria constante."""
+    return xlsxwriter.Workbook(
+        target,
+        {
+            "constant_memory": True,
+            "default_date_format": EXCEL_DATE_FORMAT,
+            "nan_inf_to_errors": True,
+        },
+    )
+
+
+def _excel_cell_values(series: pd.Series) -> list:
+    """Convierte una columna a valores Python; los nulos quedan como celda vacía."""
+    return series.astype(object).where(series.notna(), None).tolist()
+
+
+def write_creditor_sheet(
+    workbook: xlsxwriter.Workbook,
+    sheet_name: str,
+    df_sheet: pd.DataFrame,
+    export_columns: list[str],
+) -> None:
+    """Escribe la hoja de un acreedor con encabezado y una fila por documento."""
+    worksheet = workbook.add_worksheet(sheet_name)
+    worksheet.write_row(0, 0, export_columns)
+    # constant_memory exige escribir fila por fila, en orden.
+    column_values = [_excel_cell_values(df_sheet[column]) for column in export_columns]
+    for row_number, row in enumerate(zip(*column_values), start=1):
+        worksheet.write_row(row_number, 0, row)
+
+
+def get_creditor_workbook_name(cuenta_proveedor, sheet_name: str) -> str:
+    """Nombre del libro de un acreedor dentro del ZIP."""
+    file_name = re.sub(r"[^\w\- .]", "_", f"{cuenta_proveedor}_{sheet_name}")
+    return f"{file_name}.xlsx"
+
+
+def build_creditor_workbook(task: tuple) -> tuple[str, bytes]:
+    """Genera el libro de un acreedor; se ejecuta en un proceso de la exportación.
+
+    `task` es (cuenta, nombre de hoja, filas del acreedor, columnas exportables):
+    cada tarea lleva sus propios datos y no depende de estado global.
+    """
+    cuenta_proveedor, sheet_name, df_sheet, export_columns = task
+    output_buffer = io.BytesIO()
+    workbook = new_export_workbook(output_buffer)
+    write_creditor_sheet(workbook, sheet_name, df_sheet, export_columns)
+    workbook.close()
+    return get_creditor_workbook_name(cuenta_proveedor, sheet_name), output_buffer.getvalue()
@@ -1,10 +1,23 @@
 """Pruebas unitarias del control de anticipos y priorización."""
 
+import contextlib
+import gzip
 import importlib.util
 import io
+import json
+import os
 from pathlib import Path
+import shutil
+import sqlite3
+import sys
+import tempfile
+import threading
+import types
 import unittest
+from unittest import mock
+import zipfile
 
+import numpy as np
 import pandas as pd
 
 
@@ -64,6 +77,37 @@ class PaymentRiskTests(unittest.TestCase):
         self.assertEqual(payable["n_documento"].tolist(), [10, 20])
         self.assertTrue(blocked.empty)
 
+    def test_positive_advance_with_other_amount_does_not_block_invoice(self) -> None:
+        source = pd.DataFrame(
+            {
+                "cuenta": [1001, 1001, 1001],
+                "n_documento": [10, 20, 30],
+                "clase_de_documento": ["AB", "EF", "EF"],
+                "importe_en_moneda_doc": [5000, -5000, -7000],
+            }
+        )
+
+        payable, _, blocked = MODULE.validate_payment_risk(source)
+
+        self.assertEqual(payable["n_documento"].tolist(), [30])
+        self.assertEqual(blocked["n_documento"].tolist(), [20])
+
+    def test_lists_every_matching_advance_document_once(self) -> None:
+        source = pd.DataFrame(
+            {
+                "cuenta": [1001, 1001, 1001, 1002],
+                "n_documento": [12, 11, 20, 40],
+                "clase_de_documento": ["SA", "AB", "EF", "AB"],
+                "importe_en_moneda_doc": [5000, 5000.4, -5000, 5000],
+            }
+        )
+
+        _, _, blocked = MODULE.validate_payment_risk(source)
+
+        self.assertEqual(
+            blocked["documentos_anticipo_relacionados"].tolist(), ["11, 12"]
+        )
+
     def test_priority_includes_payment_below_ten_million(self) -> None:
         amounts = pd.Series([-9_000_000, -10_000_000])
         priority = amounts.abs().ge(10_000_000)
@@ -86,20 +130,111 @@ class PaymentRiskTests(unittest.TestCase):
     def test_includes_documents_due_on_or_before_payroll_date(self) -> None:
         source = pd.DataFrame(
             {
-                "vencimiento_neto": [
-                    pd.Timestamp("2026-07-14").date(),
-                    pd.Timestamp("2026-07-17").date(),
-                    pd.Timestamp("2026-07-18").date(),
-                ]
+                "vencimiento_neto": pd.to_datetime(
+                    ["2026-07-14", "2026-07-17", "2026-07-18"]
+                )
             }
         )
 
-        selected = source[
-            source["vencimiento_neto"].le(pd.Timestamp("2026-07-17").date())
-        ]
+        selected = source[source["vencimiento_neto"].le(pd.Timestamp("2026-07-17"))]
 
         self.assertEqual(selected.index.tolist(), [0, 1])
 
+    def test_day_differences_are_vectorized_over_datetime_columns(self) -> None:
+        source = pd.DataFrame(
+            {
+                "fecha_de_documento": pd.to_datetime(["2026-07-01", None]),
+                "vencimiento_neto": pd.to_datetime(["2026-07-20", "2026-07-17"]),
+            }
+        )
+
+        processed = MODULE.process_nomina_data_dates(
+            source, pd.Timestamp("2026-07-17 15:30")
+        )
+
+        self.assertEqual(processed["dias_fecha_documento"].tolist(), [16, pd.NA])
+        self.assertEqual(processed["dias_vencimiento"].tolist(), [-3, 0])
+
+    def test_compact_schema_keeps_filters_and_controls_working(self) -> None:
+        source = pd.DataFrame(
+            {
+                "cuenta": pd.array([1001, 1001, 1001, 1002] * 2, dtype="Int64"),
+                "n_documento": [10, 20, 30, 40, 50, 60, 70, 80],
+                "clase_de_documento": [" ab", "KR", "KR", None] * 2,
+                "referencia": ["factoring x", None, "F-1", "F-1"] * 2,
+                "bloqueo_de_pago": [None, "", "a", None] * 2,
+                "v_a_de_pago": ["T", "T", "T", "c"] * 2,
+                "importe_en_moneda_doc": [5000.0, -5000.0, -7000.0, -1.0] * 2,
+                "vencimiento_neto": ["2026-07-10 08:00"] * 8,
+            }
+        )
+
+        compact = MODULE.apply_lista_pi_schema(source.copy())
+        eligible = MODULE.mark_factoring_references(
+            MODULE.filter_eligible_payment_documents(compact)
+        )
+        _, _, blocked = MODULE.validate_payment_risk(eligible)
+
+        self.assertEqual(compact["cuenta"].dtype, "uint16")
+        self.assertEqual(compact["importe_en_moneda_doc"].dtype, "int64")
+        self.assertIsInstance(compact["clase_de_documento"].dtype, pd.CategoricalDtype)
+        self.assertEqual(compact["vencimiento_neto"].iloc[0], pd.Timestamp("2026-07-10"))
+        self.assertEqual(eligible["n_documento"].tolist(), [10, 20, 50, 60])
+        self.assertEqual(
+            eligible["referencia_factoring"].tolist(), [True, False, True, False]
+        )
+        self.assertEqual(blocked["n_documento"].tolist(), [20, 60])
+
+    def test_compact_schema_keeps_amounts_wide_enough_for_abs_and_totals(self) -> None:
+        source = pd.DataFrame(
+            {"cuenta": [1001, 1001], "importe_en_moneda_doc": [-128, -100]}
+        )
+
+        compact = MODULE.apply_lista_pi_schema(source)
+
+        self.assertEqual(MODULE.get_comparison_amounts(compact).tolist(), [128, 100])
+        self.assertEqual(compact["importe_en_moneda_doc"].sum(), -228)
+
+    def test_compact_schema_and_parquet_text_leave_the_input_unchanged(self) -> None:
+        source = pd.DataFrame(
+            {
+                "cuenta": [1001, 1002],
+                "importe_en_moneda_doc": [-128.0, -100.0],
+                "referencia": ["F-1", 7],
+            }
+        )
+        original = source.copy()
+
+        MODULE.apply_lista_pi_schema(source)
+        MODULE._parquet_safe_text(source)
+
+        pd.testing.assert_frame_equal(source, original)
+
+    def test_load_resolves_column_aliases_and_normalizes_once(self) -> None:
+        source = pd.DataFrame(
+            {
+                "Cuenta": [1001, 1001, 1001],
+                "Nº documento": [10, 20, 30],
+                "Tipo documento": [" ab", "KR", "kr "],
+                "Bloqueo de pago": [None, None, None],
+                "V/a de pago": ["T", "T", "T"],
+                "Importe en moneda local": [5000.0, -5000.0, -7000.4],
+                "Vencimiento neto": ["2026-07-10"] * 3,
+            }
+        )
+
+        cleaned = MODULE.clean_lista_pi(source)
+
+        self.assertIn("clase_de_documento", cleaned.columns)
+        self.assertIn("importe_en_moneda_doc", cleaned.columns)
+        self.assertEqual(cleaned["clase_documento_sap"].tolist(), ["AB", "KR", "KR"])
+        self.assertEqual(cleaned["monto_comparacion"].tolist(), [5000, 5000, 7000])
+        with mock.patch.object(
+            MODULE, "normalize_document_text", side_effect=AssertionError
+        ):
+            _, _, blocked = MODULE.validate_payment_risk(cleaned)
+        self.assertEqual(blocked["n_documento"].tolist(), [20])
+
     def test_exports_only_creditors_with_total_at_least_ten_million(self) -> None:
         source = pd.DataFrame(
             {
@@ -112,6 +247,45 @@ class PaymentRiskTests(unittest.TestCase):
 
         self.assertEqual(exportable, [1001])
 
+    def test_supplier_index_filters_totals_and_names_in_one_pass(self) -> None:
+        source = pd.DataFrame(
+            {
+                "cuenta": [1002, 1001, 1003, 1001],
+                "nombre_1": ["Menor", "Bosch", "Otro", "Bosch SA"],
+                "importe_en_moneda_doc": [-1_000, -6_000_000, -5, -4_000_000],
+            }
+        )
+
+        index = MODULE.build_supplier_index(source)
+        proposal = index.take(source, [1001, 1002, 9999])
+
+        self.assertEqual(proposal.index.tolist(), [0, 1, 3])
+        self.assertEqual(index.names[1001], "Bosch")
+        self.assertEqual(index.totals[1001], -10_000_000)
+        self.assertEqual(MODULE.get_exportable_creditors(source, index), [1001])
+        with self.assertRaises(ValueError):
+            index.take(proposal, [1001])
+
+    def test_supplier_index_rejects_other_frame_with_same_row_count(self) -> None:
+        source = pd.DataFrame(
+            {
+                "cuenta": [1001, 1002, 1001],
+                "nombre_1": ["Bosch", "Logística", "Bosch"],
+                "importe_en_moneda_doc": [-6_000_000, -20_000_000, -5_000_000],
+            }
+        )
+        index = MODULE.build_supplier_index(source)
+        reordered = source.iloc[[1, 0, 2]]
+
+        with self.assertRaises(ValueError):
+            index.take(reordered, [1002])
+        self.assertTrue(index.matches(source.copy()))
+        plan = MODULE.plan_creditor_sheets(reordered, [1002, 1001], index)
+        self.assertEqual(
+            [(cuenta, positions.tolist()) for cuenta, positions, _ in plan],
+            [(1002, [0]), (1001, [1, 2])],
+        )
+
     def test_marks_factoring_references_without_excluding_them(self) -> None:
         source = pd.DataFrame({"referencia": ["FACTORING CESION", "Factura normal"]})
 
@@ -137,6 +311,109 @@ class PaymentRiskTests(unittest.TestCase):
             ["Logística", "Bosch"],
         )
 
+    def test_export_keeps_dates_and_distinguishes_repeated_sheet_names(self) -> None:
+        payroll_documents = pd.DataFrame(
+            {
+                "cuenta": [1001, 1002, 1001],
+                "nombre_1": ["Servicios: Sur", "Servicios: Sur", "Servicios: Sur"],
+                "vencimiento_neto": pd.to_datetime(["2026-07-10", "2026-07-11", None]),
+                "importe_en_moneda_doc": [-6_000_000, -20_000_000, -4_000_000],
+            }
+        )
+
+        excel_bytes = MODULE.generate_excel_bytes(payroll_documents, [1002, 1001])
+        sheets = pd.read_excel(io.BytesIO(excel_bytes), sheet_name=None)
+
+        self.assertEqual(list(sheets), ["Servicios_ Sur", "Servicios_ Sur_1001"])
+        self.assertEqual(
+            sheets["Servicios_ Sur_1001"]["vencimiento_neto"].tolist()[0],
+            pd.Timestamp("2026-07-10"),
+        )
+        self.assertTrue(pd.isna(sheets["Servicios_ Sur_1001"]["vencimiento_neto"][1]))
+
+    def test_sheet_name_suffix_does_not_repeat_an_existing_creditor_name(self) -> None:
+        payroll_documents = pd.DataFrame(
+            {
+                "cuenta": [1003, 1001, 2],
+                "nombre_1": ["A_2", "A", "A"],
+                "importe_en_moneda_doc": [-30_000_000, -20_000_000, -10_000_000],
+            }
+        )
+
+        excel_bytes = MODULE.generate_excel_bytes(payroll_documents, [1003, 1001, 2])
+
+        self.assertEqual(
+            pd.ExcelFile(io.BytesIO(excel_bytes)).sheet_names, ["A_2", "A", "A_2_2"]
+        )
+
+    def test_creditor_zip_contains_one_workbook_per_sheet_in_order(self) -> None:
+        payroll_documents = pd.DataFrame(
+            {
+                "cuenta": [1001, 1002, 1001, 1003],
+                "nombre_1": ["Bosch", "Logística", "Bosch", "Menor"],
+                "importe_en_moneda_doc": [-7_000_000, -20_000_000, -4_000_000, -9_000_000],
+                "monto_comparacion": [7_000_000, 20_000_000, 4_000_000, 9_000_000],
+            }
+        )
+
+        # Streamlit reemplaza __main__ en cada ejecución del script.
+        main_module = sys.modules["__main__"]
+        sys.modules["__main__"] = types.ModuleType("__main__")
+        try:
+            zip_bytes = MODULE.generate_creditor_zip_bytes(
+                payroll_documents, [1002, 1001, 1003], max_workers=2
+            )
+        finally:
+            sys.modules["__main__"] = main_module
+
+        with zipfile.ZipFile(io.BytesIO(zip_bytes)) as archive:
+            self.assertEqual(
+                archive.namelist(), ["1002_Logística.xlsx", "1001_Bosch.xlsx"]
+            )
+            bosch = pd.read_excel(io.BytesIO(archive.read("1001_Bosch.xlsx")))
+        self.assertEqual(bosch["importe_en_moneda_doc"].tolist(), [-7_000_000, -4_000_000])
+        self.assertNotIn("monto_comparacion", bosch.columns)
+
+    def test_csv_and_parquet_exports_follow_creditor_order(self) -> None:
+        payroll_documents = pd.DataFrame(
+            {
+                "cuenta": [1001, 1002, 1001, 1003],
+                "nombre_1": ["Bosch", "Logística", "Bosch", "Menor"],
+                "vencimiento_neto": pd.to_datetime(
+                    ["2026-07-10", "2026-07-11", None, "2026-07-12"]
+                ),
+                "importe_en_moneda_doc": [-7_000_000, -20_000_000, -4_000_000, -9_000_000],
+                "estado_validacion": ["APTO_PARA_CRUCE"] * 4,
+            }
+        )
+        exportable = MODULE.get_exportable_creditors(payroll_documents)
+
+        csv_text = gzip.decompress(
+            MODULE.generate_csv_gzip_bytes(payroll_documents, exportable)
+        ).decode("utf-8")
+        with tempfile.TemporaryDirectory() as dataset_dir:
+            manifest_path = MODULE.write_creditor_parquet_dataset(
+                payroll_documents, exportable, dataset_dir
+            )
+            dataset = pd.read_parquet(os.path.join(dataset_dir, "cuenta=1001"))
+            with open(manifest_path, encoding="utf-8") as file:
+                manifest = json.load(file)
+
+        self.assertEqual(
+            csv_text.splitlines(),
+            [
+                "cuenta,nombre_1,vencimiento_neto,importe_en_moneda_doc",
+                "1002,Logística,2026-07-11,-20000000",
+                "1001,Bosch,2026-07-10,-7000000",
+                "1001,Bosch,,-4000000",
+            ],
+        )
+        self.assertEqual(manifest, [{"cuenta": 1002, "filas": 1}, {"cuenta": 1001, "filas": 2}])
+        self.assertEqual(
+            list(dataset.columns), ["nombre_1", "vencimiento_neto", "importe_en_moneda_doc"]
+        )
+        self.assertEqual(dataset["importe_en_moneda_doc"].tolist(), [-7_000_000, -4_000_000])
+
     def test_future_advance_blocks_matching_payroll_invoice(self) -> None:
         payroll = pd.DataFrame(
             {
@@ -186,5 +463,1208 @@ class PaymentRiskTests(unittest.TestCase):
             set(MODULE.EXPORT_COLUMNS_TO_EXCLUDE).isdisjoint(exported.columns)
         )
 
+    def test_excel_readers_prune_columns_identically(self) -> None:
+        buffer = io.BytesIO()
+        pd.DataFrame(
+            {
+                "Proveedor": [1001, 1002],
+                "Nº documento de pago": [1, 2],
+                "Importe pagado en ML": [-5_000, -7_000],
+                "Texto libre": ["a", "b"],
+            }
+        ).to_excel(buffer, index=False)
+
+        frames = []
+        for engine in ("openpyxl", "openpyxl_streaming"):
+            with mock.patch.dict(
+                MODULE.os.environ, {MODULE.EXCEL_ENGINE_ENV_VAR: engine}
+            ):
+                frames.append(
+                    MODULE.read_excel_pruned(
+                        buffer, keep_column=MODULE.TESORERIA_SOURCE_COLUMNS.__contains__
+                    )
+                )
+
+        self.assertEqual(
+            frames[0].columns.tolist(),
+            ["Proveedor", "Nº documento de pago", "Importe pagado en ML"],
+        )
+        pd.testing.assert_frame_equal(frames[0], frames[1])
+
+
+class AdvanceCombinationTests(unittest.TestCase):
+    def test_invoices_one_advance_covers_go_to_manual_review(self) -> None:
+        source = pd.DataFrame(
+            {
+                "cuenta": [1001, 1001, 1001, 1001],
+                "n_documento": [10, 20, 30, 40],
+                "clase_de_documento": ["AB", "KR", "KR", "KR"],
+                "importe_en_moneda_doc": [9000, -4000, -5000, -7000],
+            }
+        )
+
+        payable, retained, blocked = MODULE.validate_payment_risk(source)
+
+        self.assertEqual(payable["n_documento"].tolist(), [40])
+        self.assertEqual(blocked["n_documento"].tolist(), [20, 30])
+        self.assertEqual(blocked["documentos_anticipo_relacionados"].tolist(), ["10", "10"])
+        # Una suma de importes no prueba la compensación: nada queda bloqueado.
+        self.assertEqual(retained["n_documento"].tolist(), [10, 20, 30])
+        self.assertEqual(
+            set(retained["estado_validacion"]), {MODULE.COMBINATION_REVIEW_STATUS}
+        )
+
+    def test_advances_covering_one_invoice_go_to_review_unless_ambiguous(self) -> None:
+        source = pd.DataFrame(
+            {
+                "cuenta": [1001, 1001, 1001, 1002, 1002, 1002, 1002],
+                "n_documento": [12, 11, 20, 50, 60, 70, 80],
+                "clase_de_documento": ["SA", "AB", "KR", "AB", "KR", "KR", "KR"],
+                # 1002: 300 = 100 + 200 = 150 + 150, el importe no identifica facturas.
+                "importe_en_moneda_doc": [2500, 1500, -4000, 300, -100, -200, -150],
+            }
+        )
+        source = pd.concat(
+            [source, source.iloc[[-1]].assign(n_documento=90)], ignore_index=True
+        )
+
+        payable, _, blocked = MODULE.validate_payment_risk(source)
+
+        self.assertEqual(blocked["n_documento"].tolist(), [20])
+        self.assertEqual(blocked["documentos_anticipo_relacionados"].tolist(), ["11, 12"])
+        self.assertEqual(
+            blocked["estado_validacion"].tolist(), [MODULE.COMBINATION_REVIEW_STATUS]
+        )
+        self.assertEqual(payable["n_documento"].tolist(), [50, 60, 70, 80, 90])
+
+    def test_duplicate_invoice_amounts_make_the_combination_ambiguous(self) -> None:
+        source = pd.DataFrame(
+            {
+                "cuenta": [1001, 1001, 1001, 1001],
+                "n_documento": [10, 20, 21, 22],
+                "clase_de_documento": ["AB", "KR", "KR", "KR"],
+                # 300 = 200 + 100, pero no se sabe si es la factura 21 o la 22.
+                "importe_en_moneda_doc": [300, -200, -100, -100],
+            }
+        )
+
+        with self.assertLogs(MODULE.LOGGER, "INFO") as logs:
+            payable, _, blocked = MODULE.validate_payment_risk(source)
+
+        self.assertTrue(blocked.empty)
+        self.assertEqual(payable["n_documento"].tolist(), [10, 20, 21, 22])
+        self.assertIn("ambiguas=1", "\n".join(logs.output))
+
+    def test_unrelated_amounts_that_sum_to_an_advance_stay_payable(self) -> None:
+        source = pd.DataFrame(
+            {
+                "cuenta": [1001, 1001, 1001],
+                "sociedad": ["1000", "1000", "1000"],
+                "n_documento": [10, 20, 30],
+                "clase_de_documento": ["AB", "KR", "KR"],
+                "importe_en_moneda_doc": [9000, -4000, -5000],
+                "fecha_de_documento": pd.to_datetime(
+                    ["2026-01-05", "2026-01-06", "2026-01-07"]
+                ),
+            }
+        )
+        # 9.000 = 4.000 + 5.000, pero las facturas son de un semestre después
+        # o de otra sociedad.
+        for column, values in (
+            ("fecha_de_documento", pd.to_datetime(["2026-01-05", "2026-07-01", "2026-07-02"])),
+            ("sociedad", ["1000", "2000", "2000"]),
+        ):
+            with self.subTest(column=column):
+                payable, retained, blocked = MODULE.validate_payment_risk(
+                    source.assign(**{column: values})
+                )
+
+                self.assertTrue(blocked.empty)
+                self.assertTrue(retained.empty)
+                self.assertEqual(payable["n_documento"].tolist(), [10, 20, 30])
+        _, retained, _ = MODULE.validate_payment_risk(source)
+        self.assertEqual(retained["n_documento"].tolist(), [10, 20, 30])
+
+    def test_supplier_over_time_limit_goes_to_manual_review(self) -> None:
+        source = pd.DataFrame(
+            {
+                "cuenta": [1001, 1001, 1001, 1001],
+                "n_documento": [10, 20, 30, 40],
+                "clase_de_documento": ["AB", "KR", "KR", "KR"],
+                "importe_en_moneda_doc": [9000, -4000, -5000, -70000],
+            }
+        )
+
+        with mock.patch.dict(os.environ, {MODULE.COMBINATION_TIME_LIMIT_ENV_VAR: "0"}):
+            payable, retained, blocked = MODULE.validate_payment_risk(source)
+
+        # La factura de 70.000 supera lo que el anticipo libre podría cubrir.
+        self.assertEqual(payable["n_documento"].tolist(), [40])
+        self.assertEqual(blocked["n_documento"].tolist(), [20, 30])
+        self.assertEqual(
+            set(retained["estado_validacion"]), {MODULE.COMBINATION_REVIEW_STATUS}
+        )
+
+    def test_pass_over_total_time_limit_goes_to_manual_review(self) -> None:
+        source = pd.DataFrame(
+            {
+                "cuenta": [1001, 1001, 1001, 1002, 1002, 1002],
+                "n_documento": [10, 20, 30, 50, 60, 70],
+                "clase_de_documento": ["AB", "KR", "KR", "AB", "KR", "KR"],
+                "importe_en_moneda_doc": [9000, -4000, -5000, 300, -100, -200],
+            }
+        )
+
+        with mock.patch.dict(
+            os.environ, {MODULE.COMBINATION_TOTAL_TIME_LIMIT_ENV_VAR: "0"}
+        ), self.assertLogs(MODULE.LOGGER, "INFO") as logs:
+            payable, retained, _ = MODULE.validate_payment_risk(source)
+
+        self.assertTrue(payable.empty)
+        self.assertEqual(
+            set(retained["estado_validacion"]), {MODULE.COMBINATION_REVIEW_STATUS}
+        )
+        self.assertIn("proveedores_en_revision=2", "\n".join(logs.output))
+        self.assertIn("tiempo_total_agotado=sí", "\n".join(logs.output))
+
+
+def use_polars_backend(test: unittest.TestCase) -> None:
+    patcher = mock.patch.dict(
+        MODULE.os.environ, {MODULE.VALIDATION_BACKEND_ENV_VAR: "polars"}
+    )
+    patcher.start()
+    test.addCleanup(patcher.stop)
+
+
+# Las mismas pruebas de reglas, ejecutadas con el motor Polars.
+@unittest.skipIf(MODULE.pl is None, "polars no está instalado")
+class PolarsPaymentRiskTests(PaymentRiskTests):
+    def setUp(self) -> None:
+        use_polars_backend(self)
+
+
+@unittest.skipIf(MODULE.pl is None, "polars no está instalado")
+class PolarsAdvanceCombinationTests(AdvanceCombinationTests):
+    def setUp(self) -> None:
+        use_polars_backend(self)
+
+
+class ValidationBackendTests(unittest.TestCase):
+    def run_rules(self, backend: str, lista_pi: pd.DataFrame) -> tuple:
+        with mock.patch.dict(
+            MODULE.os.environ, {MODULE.VALIDATION_BACKEND_ENV_VAR: backend}
+        ):
+            eligible = MODULE.mark_factoring_references(
+                MODULE.filter_eligible_payment_documents(lista_pi)
+            )
+            payable, retained, blocked = MODULE.validate_payment_risk(
+                MODULE.add_normalized_document_columns(eligible)
+            )
+            return eligible, payable, retained, blocked, MODULE.get_exportable_creditors(payable)
+
+    @unittest.skipIf(MODULE.pl is None, "polars no está instalado")
+    def test_polars_matches_pandas_on_synthetic_lista_pi(self) -> None:
+        import benchmark_prenomina
+
+        raw = benchmark_prenomina.generate_lista_pi(5_000, seed=5)
+        lista_pi = MODULE.apply_lista_pi_schema(
+            MODULE.clean_names(raw).astype({"cuenta": "Int64"})
+        )
+        # Cuentas leídas como `object` con números y texto mezclados.
+        mixed_accounts = lista_pi["cuenta"].astype(object)
+        mixed_accounts[::3] = mixed_accounts[::3].astype(str)
+        mixed_lista_pi = lista_pi.assign(cuenta=mixed_accounts)
+
+        for case, source in (("Int64", lista_pi), ("object", mixed_lista_pi)):
+            with self.subTest(cuenta=case):
+                expected = self.run_rules("pandas", source)
+                actual = self.run_rules("polars", source)
+
+                for expected_df, actual_df in zip(expected[:4], actual[:4]):
+                    pd.testing.assert_frame_equal(actual_df, expected_df)
+                self.assertEqual(actual[4], expected[4])
+                self.assertFalse(expected[3].empty)
+
+    def test_unknown_backend_fails_and_missing_polars_falls_back(self) -> None:
+        with mock.patch.dict(
+            MODULE.os.environ, {MODULE.VALIDATION_BACKEND_ENV_VAR: "spark"}
+        ), self.assertRaises(ValueError):
+            MODULE.get_validation_backend()
+        with mock.patch.dict(
+            MODULE.os.environ, {MODULE.VALIDATION_BACKEND_ENV_VAR: "polars"}
+        ), mock.patch.object(MODULE, "pl", None):
+            backend = MODULE.get_validation_backend()
+        self.assertIs(backend, MODULE.VALIDATION_BACKENDS["pandas"])
+
+
+class DuplicateInvoiceTests(unittest.TestCase):
+    def test_flags_close_invoices_with_similar_reference(self) -> None:
+        source = pd.DataFrame(
+            {
+                "cuenta": [1001, 1001, 1001, 1001, 1001, 1002, 1001],
+                "n_documento": [10, 11, 12, 13, 10, 14, 15],
+                "clase_de_documento": ["KR", "KR", "KR", "KR", "KR", "KR", "KR"],
+                "referencia": ["F-001234", "F1234", "F-1234", "Z-9", "F-001234", "F1234", "F 1234"],
+                "importe_en_moneda_doc": [
+                    -100_000, -100_500, -100_000, -100_000, -100_000, -100_000, -99_600,
+                ],
+                "fecha_de_documento": pd.to_datetime(
+                    [
+                        "2026-07-01",  # 10
+                        "2026-07-05",  # 11: a 4 días de la 10
+                        "2026-07-20",  # 12: fuera de la ventana
+                        "2026-07-02",  # 13: otra referencia
+                        "2026-07-01",  # 10 otra vez: misma factura, otra línea
+                        "2026-07-01",  # 14: otro proveedor
+                        "2026-07-09",  # 15: a 4 días de la 11, en la ventana siguiente
+                    ]
+                ),
+            }
+        )
+
+        duplicates, runtimes = MODULE.detect_duplicate_invoices(source)
+
+        self.assertEqual(
+            list(zip(duplicates["n_documento"], duplicates["n_documento_par"])),
+            [(10, 11), (11, 10), (11, 15)],
+        )
+        self.assertEqual(duplicates["similitud_referencia"].unique().tolist(), [1.0])
+        self.assertEqual(duplicates["dias_entre_documentos"].tolist(), [4, 4, 4])
+        self.assertEqual(runtimes["cuenta"].tolist(), [1001])
+        self.assertEqual(runtimes[["facturas", "posibles_duplicados"]].values.tolist(), [[6, 3]])
+
+    def test_blocking_finds_the_same_pairs_as_comparing_all(self) -> None:
+        generator = np.random.default_rng(7)
+        rows = 400
+        source = pd.DataFrame(
+            {
+                "cuenta": generator.integers(1, 4, rows),
+                "n_documento": np.arange(rows),
+                "clase_de_documento": "KR",
+                "referencia": [f"F-{value}" for value in generator.integers(1, 40, rows)],
+                "importe_en_moneda_doc": -generator.integers(1_000, 1_200, rows),
+                "fecha_de_documento": pd.Timestamp("2026-06-01")
+                + pd.to_timedelta(generator.integers(0, 60, rows), unit="D"),
+            }
+        )
+
+        duplicates, runtimes = MODULE.detect_duplicate_invoices(source)
+        # Por tramos pequeños, los pares son los mismos.
+        with mock.patch.object(MODULE, "DUPLICATE_SCORING_CHUNK_PAIRS", 50):
+            chunked, chunked_runtimes = MODULE.detect_duplicate_invoices(source)
+
+        pd.testing.assert_frame_equal(chunked, duplicates)
+        self.assertEqual(
+            chunked_runtimes.set_index("cuenta")["pares_comparados"].to_dict(),
+            runtimes.set_index("cuenta")["pares_comparados"].to_dict(),
+        )
+        left, right = np.triu_indices(rows, k=1)
+        amounts = source["importe_en_moneda_doc"].abs().to_numpy()
+        days = source["fecha_de_documento"].to_numpy()
+        cuentas = source["cuenta"].to_numpy()
+        references = MODULE.normalize_references(source["referencia"]).to_numpy(dtype=object)
+        candidates = (
+            (cuentas[left] == cuentas[right])
+            & (
+                np.abs(amounts[left] - amounts[right])
+                <= MODULE.DUPLICATE_AMOUNT_TOLERANCE
+                * np.maximum(amounts[left], amounts[right])
+            )
+            & (np.abs(days[left] - days[right]) <= np.timedelta64(7, "D"))
+        )
+        left, right = left[candidates], right[candidates]
+        similar = (
+            MODULE.reference_similarity(references[left], references[right])
+            >= MODULE.DUPLICATE_MIN_REFERENCE_SIMILARITY
+        )
+        self.assertGreater(similar.sum(), 0)
+        self.assertEqual(
+            set(zip(duplicates["n_documento"], duplicates["n_documento_par"])),
+            set(zip(left[similar], right[similar])),
+        )
+
+    def test_supplier_with_too_many_pairs_is_compared_by_reference_window(self) -> None:
+        rows = 300
+        # Facturas recurrentes: mismo importe y misma semana, referencias distintas.
+        source = pd.DataFrame(
+            {
+                "cuenta": 1001,
+                "n_documento": np.arange(rows),
+                "clase_de_documento": "KR",
+                "referencia": [f"CONTRATO-{value % 150}-{value}" for value in range(rows)],
+                "importe_en_moneda_doc": -119_000,
+                "fecha_de_documento": pd.Timestamp("2026-07-01"),
+            }
+        )
+        # La misma factura registrada dos veces, con la referencia escrita distinto.
+        source.loc[rows - 1, "referencia"] = "contrato 7 7"
+
+        with mock.patch.multiple(
+            MODULE, DUPLICATE_MAX_SUPPLIER_PAIRS=1_000, DUPLICATE_WINDOW_INVOICES=3
+        ):
+            duplicates, runtimes = MODULE.detect_duplicate_invoices(source)
+
+        self.assertLessEqual(runtimes["pares_comparados"].iloc[0], 3 * rows)
+        self.assertIn(
+            (7, rows - 1), set(zip(duplicates["n_documento"], duplicates["n_documento_par"]))
+        )
+
+
+class PayrollScenarioTests(unittest.TestCase):
+    def setUp(self) -> None:
+        self.lista_pi = pd.DataFrame(
+            {
+                "cuenta": [1001, 1001, 1001, 1002, 1003],
+                "nombre_1": ["Bosch", "Bosch", "Bosch", "Menor", "Otro"],
+                "n_documento": [20, 21, 10, 30, 40],
+                "clase_de_documento": ["KR", "KR", "AB", "KR", "KR"],
+                "vencimiento_neto": pd.to_datetime(
+                    ["2026-07-24", "2026-07-10", "2026-08-30", "2026-07-17", None]
+                ),
+                "importe_en_moneda_doc": [-12_000_000, -5_000, 5_000, -1_000, -7],
+                "referencia_factoring": [False] * 5,
+            }
+        )
+        self.tesoreria = pd.DataFrame({"cuenta": [1001, 1002, 1003]})
+
+    def test_each_date_matches_a_separate_validation_run(self) -> None:
+        scenarios = MODULE.run_payroll_scenarios(
+            self.lista_pi, self.tesoreria, ["2026-07-24", "2026-07-17"]
+        )
+        for fecha_nomina, payroll in scenarios.items():
+            expected = MODULE.run_payroll_validation(
+                self.lista_pi, self.tesoreria, fecha_nomina
+            )
+            pd.testing.assert_frame_equal(
+                payroll.nomina_con_calculos, expected.nomina_con_calculos
+            )
+            pd.testing.assert_frame_equal(
+                payroll.facturas_bloqueadas, expected.facturas_bloqueadas
+            )
+            self.assertEqual(
+                payroll.acreedores_exportables, expected.acreedores_exportables
+            )
+
+        summary = MODULE.summarize_payroll_scenarios(scenarios).set_index("fecha_nomina")
+        self.assertEqual(summary["facturas_bloqueadas"].tolist(), [1, 1])
+        self.assertEqual(summary["acreedores_exportables"].tolist(), [0, 1])
+
+    def test_date_without_due_documents_is_reported_not_raised(self) -> None:
+        scenarios = MODULE.run_payroll_scenarios(
+            self.lista_pi, self.tesoreria, ["2026-07-01", "2026-07-10"]
+        )
+
+        self.assertIsInstance(
+            scenarios[pd.Timestamp("2026-07-01")], MODULE.EmptyPayrollError
+        )
+        self.assertEqual(
+            scenarios[pd.Timestamp("2026-07-10")].documentos_fecha["n_documento"].tolist(),
+            [21],
+        )
+        summary = MODULE.summarize_payroll_scenarios(scenarios)
+        self.assertEqual(summary["partidas"].tolist(), [0, 1])
+
+
+class SessionStageTests(unittest.TestCase):
+    def setUp(self) -> None:
+        patcher = mock.patch.object(MODULE.st, "session_state", {})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_stage_is_reused_until_its_key_changes(self) -> None:
+        compute = mock.Mock(side_effect=["17-07", "24-07"])
+
+        first = MODULE.get_session_stage("nomina", ("hash", "2026-07-17"), compute)
+        again = MODULE.get_session_stage("nomina", ("hash", "2026-07-17"), compute)
+        changed = MODULE.get_session_stage("nomina", ("hash", "2026-07-24"), compute)
+
+        self.assertEqual((first, again, changed), ("17-07", "17-07", "24-07"))
+        self.assertEqual(compute.call_count, 2)
+
+    def test_export_is_built_only_when_downloaded_and_once(self) -> None:
+        exports = MODULE.get_session_stage("exportaciones", ("hash", "2026-07-17"), dict)
+        build = mock.Mock(return_value=b"xlsx")
+
+        download = MODULE.lazy_export(exports, MODULE.EXCEL_FILENAME, build)
+        build.assert_not_called()
+
+        self.assertEqual((download(), download()), (b"xlsx", b"xlsx"))
+        build.assert_called_once()
+
+    def test_background_job_reports_stages_and_stops_when_cancelled(self) -> None:
+        first_stage_started = MODULE.threading.Event()
+        release = MODULE.threading.Event()
+
+        def pipeline() -> str:
+            MODULE.report_progress("Carga de archivos", 0, 2)
+            with MODULE.instrument_stage("lectura lista_pi"):
+                first_stage_started.set()
+                release.wait(5)
+            MODULE.report_progress("Validación de la nómina", 1, 2)
+            return "terminado"
+
+        job = MODULE.BackgroundJob(("hash",)).start(pipeline)
+        self.assertTrue(first_stage_started.wait(5))
+        self.assertEqual(job.progress(), (0.0, "Carga de archivos: lectura lista_pi"))
+
+        job.cancel()
+        release.set()
+
+        with self.assertRaises(MODULE.PipelineCancelled):
+            job.result()
+        self.assertEqual(
+            [stage["etapa"] for stage in job.instrumentation.stages], ["lectura lista_pi"]
+        )
+
+    def test_loads_lista_pi_and_tesoreria_concurrently(self) -> None:
+        # Cada carga espera a la otra: en serie, la barrera vencería.
+        barrier = MODULE.threading.Barrier(2, timeout=5)
+        tesoreria = pd.DataFrame({"cuenta": [1001], "prioridad_monto": [True]})
+
+        def load(result):
+            def loader(_):
+                barrier.wait()
+                return result
+            return loader
+
+        with mock.patch.multiple(
+            MODULE,
+            load_nomina_df=mock.Mock(side_effect=load(pd.DataFrame({"cuenta": [1001]}))),
+            load_tesoreria_df=mock.Mock(side_effect=load(tesoreria)),
+            load_nomina_supplier_index=mock.Mock(return_value="indice"),
+            prepare_payroll_proposal=mock.Mock(return_value="propuesta"),
+        ):
+            proposal, priority = MODULE._prepare_uploaded_proposal(["lista"], "tesoreria")
+
+        self.assertEqual((proposal, priority), ("propuesta", 1))
+
+    def test_detached_upload_is_cached_by_content(self) -> None:
+        upload = io.BytesIO(b"xlsx")
+        upload.name = "tesoreria.xlsx"  # Nombre del navegador, sin archivo en disco
+        calls = []
+
+        @MODULE.st.cache_data
+        def read(source) -> bytes:
+            calls.append(source)
+            return source.getvalue()
+
+        first = read(MODULE.detach_upload(upload))
+        second = read(MODULE.detach_upload(upload))
+
+        self.assertEqual((first, second), (b"xlsx", b"xlsx"))
+        self.assertEqual(len(calls), 1)
+
+
+class MultiCompanyLoadTests(unittest.TestCase):
+    def test_merge_labels_companies_and_drops_rows_repeated_across_files(self) -> None:
+        first = pd.DataFrame(
+            {
+                "cuenta": [1001, 1001, 1002],
+                "n_documento": [10, 10, 30],
+                "nombre_1": pd.Categorical(["A", "A", "B"]),
+                "importe_en_moneda_doc": [-100, -100, -300],
+            }
+        )
+        # La segunda exportación repite una fila de la primera y agrega otra.
+        second = pd.DataFrame(
+            {
+                "cuenta": [1001, 1003],
+                "n_documento": [10, 40],
+                "nombre_1": pd.Categorical(["A", "C"]),
+                "importe_en_moneda_doc": [-100, -400],
+            }
+        )
+
+        merged = MODULE.merge_lista_pi_frames(
+            [("1000", first), ("1000", second), ("2000", second)]
+        )
+
+        self.assertEqual(merged["n_documento"].tolist(), [10, 10, 30, 40, 10, 40])
+        self.assertEqual(
+            merged["sociedad"].astype(str).tolist(),
+            ["1000", "1000", "1000", "1000", "2000", "2000"],
+        )
+        self.assertIsInstance(merged["nombre_1"].dtype, pd.CategoricalDtype)
+        self.assertTrue(merged.index.equals(pd.RangeIndex(6)))
+
+    def test_loads_files_concurrently_and_keeps_sap_company_column(self) -> None:
+        # Cada carga espera a la otra: en serie, la barrera vencería.
+        barrier = MODULE.threading.Barrier(2, timeout=5)
+        frames = {
+            b"a": pd.DataFrame({"cuenta": [1001], "sociedad": [1000.0]}),
+            b"b": pd.DataFrame({"cuenta": [1001], "sociedad": [None]}),
+        }
+
+        def load(source):
+            barrier.wait()
+            return frames[source.getvalue()]
+
+        with mock.patch.object(MODULE, "load_nomina_df", side_effect=load), mock.patch.dict(
+            MODULE.os.environ, {MODULE.LOAD_WORKERS_ENV_VAR: "2"}
+        ):
+            merged = MODULE.load_lista_pi_files(
+                [io.BytesIO(b"a"), io.BytesIO(b"b"), io.BytesIO(b"a")],
+                ["Lista PI 1000.xlsx", "2000.xlsx", "Lista PI 1000.xlsx"],
+            )
+
+        self.assertEqual(merged["sociedad"].astype(str).tolist(), ["1000", "2000"])
+
+    def test_identical_exports_of_two_companies_keep_both(self) -> None:
+        frame = pd.DataFrame({"cuenta": [1001], "n_documento": [10]})
+
+        with mock.patch.object(MODULE, "load_nomina_df", return_value=frame), self.assertLogs(
+            MODULE.LOGGER, "WARNING"
+        ):
+            merged = MODULE.load_lista_pi_files(
+                [io.BytesIO(b"a"), io.BytesIO(b"a")], ["1000.xlsx", "2000.xlsx"]
+            )
+
+        self.assertEqual(merged["sociedad"].astype(str).tolist(), ["1000", "2000"])
+
+    def test_single_file_is_returned_without_company_column(self) -> None:
+        frame = pd.DataFrame({"cuenta": [1001, 1002]}, index=[5, 7])
+
+        with mock.patch.object(MODULE, "load_nomina_df", return_value=frame):
+            loaded = MODULE.load_lista_pi_files([io.BytesIO(b"a")], ["1000.xlsx"])
+
+        self.assertIs(loaded, frame)
+        self.assertNotIn("sociedad", loaded.columns)
+
+
+class SupplierViewTests(unittest.TestCase):
+    def setUp(self) -> None:
+        self.source = pd.DataFrame(
+            {
+                "cuenta": [1002, 1001, 1002, 1003, 1001],
+                "nombre_1": ["B", "A", "B", None, "A"],
+                "n_documento": [10, 20, 30, 40, 50],
+                "importe_en_moneda_doc": [-100, -5000, -200, 50, -10],
+            }
+        )
+
+    def test_summary_has_one_row_per_supplier_ordered_by_debt(self) -> None:
+        index = MODULE.build_supplier_index(self.source)
+
+        summary = MODULE.summarize_by_supplier(self.source, index)
+
+        self.assertEqual(summary["cuenta"].tolist(), [1001, 1002, 1003])
+        self.assertEqual(summary["partidas"].tolist(), [2, 2, 1])
+        self.assertEqual(summary["importe_en_moneda_doc"].tolist(), [-5010, -300, 50])
+        self.assertEqual(summary["nombre_1"].tolist()[:2], ["A", "B"])
+        pd.testing.assert_frame_equal(summary, MODULE.summarize_by_supplier(self.source))
+
+    def test_filters_suppliers_and_clamps_pages(self) -> None:
+        index = MODULE.build_supplier_index(self.source)
+
+        filtered = MODULE.filter_by_suppliers(self.source, [1001, 1003], index)
+        page, pages = MODULE.get_page(filtered, 5, 2)
+
+        self.assertEqual(filtered["n_documento"].tolist(), [20, 40, 50])
+        pd.testing.assert_frame_equal(
+            filtered, MODULE.filter_by_suppliers(self.source, [1001, 1003])
+        )
+        self.assertIs(MODULE.filter_by_suppliers(self.source, []), self.source)
+        self.assertEqual((page["n_documento"].tolist(), pages), ([50], 2))
+        self.assertEqual(MODULE.get_page(self.source.iloc[[]], 1, 50)[1], 1)
+
+
+class IncrementalValidationTests(unittest.TestCase):
+    def setUp(self) -> None:
+        self.proposal = pd.DataFrame(
+            {
+                "cuenta": pd.array([1001, 1001, 1002, 1002, 1003], dtype="Int64"),
+                "n_documento": [10, 20, 30, 40, 50],
+                "clase_de_documento": ["AB", "KR", "SA", "KR", "KR"],
+                "importe_en_moneda_doc": [5_000, -5_000, 7_000, -7_000, -9_000],
+                "vencimiento_neto": pd.to_datetime(
+                    ["2026-08-30", "2026-07-10", "2026-07-10", "2026-07-10", "2026-07-10"]
+                ),
+            }
+        )
+
+    def run_both(self, proposal, snapshot):
+        payroll = proposal[proposal["vencimiento_neto"].le(pd.Timestamp("2026-07-17"))]
+        expected = MODULE.validate_payment_risk(payroll, advance_source=proposal)
+        results, new_snapshot, stats = MODULE.validate_payment_risk_incremental(
+            payroll, proposal, snapshot
+        )
+        for expected_df, result_df in zip(expected, results):
+            pd.testing.assert_frame_equal(expected_df, result_df)
+        return new_snapshot, stats
+
+    def test_recomputes_only_suppliers_with_changed_documents(self) -> None:
+        snapshot, stats = self.run_both(self.proposal, None)
+        self.assertEqual(stats["proveedores_recalculados"], 3)
+
+        changed = self.proposal.copy()
+        changed.loc[3, "importe_en_moneda_doc"] = -6_000
+        _, stats = self.run_both(changed, snapshot)
+
+        self.assertEqual(
+            stats, {"proveedores_recalculados": 1, "proveedores_reutilizados": 2}
+        )
+
+    def test_snapshot_round_trips_through_store(self) -> None:
+        with tempfile.TemporaryDirectory() as snapshot_dir, mock.patch.dict(
+            MODULE.os.environ, {MODULE.SNAPSHOT_DIR_ENV_VAR: snapshot_dir}
+        ):
+            snapshot, _ = self.run_both(self.proposal, None)
+            MODULE.save_validation_snapshot(snapshot)
+            _, stats = self.run_both(self.proposal, MODULE.load_validation_snapshot())
+
+        self.assertEqual(
+            stats, {"proveedores_recalculados": 0, "proveedores_reutilizados": 3}
+        )
+
+
+class PaidLedgerTests(unittest.TestCase):
+    def setUp(self) -> None:
+        work_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(work_dir.cleanup)
+        patcher = mock.patch.dict(
+            MODULE.os.environ,
+            {MODULE.PAID_LEDGER_ENV_VAR: os.path.join(work_dir.name, "pagos.sqlite")},
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.proposal = pd.DataFrame(
+            {
+                "cuenta": [1001, 1001, 1002],
+                "n_documento": [20, 21, 30],
+                "clase_de_documento": ["KR", "KR", "KR"],
+                "importe_en_moneda_doc": [-5_000.4, -7_000, -9_000],
+                "vencimiento_neto": pd.to_datetime(["2026-07-10"] * 3),
+            }
+        )
+
+    def test_blocks_documents_paid_in_another_payroll(self) -> None:
+        self.assertEqual(
+            MODULE.record_paid_documents(self.proposal.iloc[[0, 2]], "2026-07-10"), 2
+        )
+        self.assertEqual(
+            MODULE.record_paid_documents(self.proposal.iloc[[0]], "2026-07-17"), 0
+        )
+        same_week = MODULE.run_payroll_validation(
+            self.proposal, pd.DataFrame({"cuenta": [1001, 1002]}), "2026-07-10"
+        )
+        next_week = MODULE.run_payroll_validation(
+            self.proposal, pd.DataFrame({"cuenta": [1001, 1002]}), "2026-07-17"
+        )
+
+        self.assertEqual(same_week.nomina_con_calculos["n_documento"].tolist(), [20, 21, 30])
+        self.assertEqual(next_week.nomina_con_calculos["n_documento"].tolist(), [21])
+        blocked = next_week.facturas_bloqueadas
+        self.assertEqual(blocked["n_documento"].tolist(), [20, 30])
+        self.assertEqual(blocked["estado_validacion"].unique().tolist(), [MODULE.PAID_LEDGER_STATUS])
+        self.assertEqual(
+            blocked["nomina_pago_anterior"].tolist(), [pd.Timestamp("2026-07-10")] * 2
+        )
+        pd.testing.assert_frame_equal(next_week.documentos_retenidos, blocked)
+
+    def test_changed_amount_is_not_the_same_document(self) -> None:
+        MODULE.record_paid_documents(self.proposal, "2026-07-10")
+        changed = self.proposal.assign(importe_en_moneda_doc=[-5_000, -7_001, -9_000])
+
+        paid = MODULE.find_paid_documents(changed, "2026-07-17")
+
+        self.assertEqual(paid.index.tolist(), [0, 2])
+        with mock.patch.dict(MODULE.os.environ, {MODULE.PAID_LEDGER_ENV_VAR: ""}):
+            self.assertTrue(MODULE.find_paid_documents(changed, "2026-07-17").empty)
+
+    def test_document_read_as_float_matches_one_recorded_as_integer(self) -> None:
+        proposal = self.proposal.assign(n_documento=[5100000123, 5100000124, 5100000125])
+        MODULE.record_paid_documents(proposal, "2026-07-10")
+        # La Lista PI de la semana siguiente trae el documento con decimales.
+        as_float = proposal.astype({"n_documento": "float64"})
+
+        paid = MODULE.find_paid_documents(as_float, "2026-07-17")
+
+        self.assertEqual(paid.index.tolist(), [0, 1, 2])
+        self.assertEqual(
+            MODULE.record_paid_documents(as_float.astype({"n_documento": str}), "2026-07-17"),
+            0,
+        )
+
+    def test_same_document_of_another_company_is_not_paid(self) -> None:
+        MODULE.record_paid_documents(self.proposal.assign(sociedad="1000"), "2026-07-10")
+
+        other_company = MODULE.find_paid_documents(
+            self.proposal.assign(sociedad="2000"), "2026-07-17"
+        )
+        same_company = MODULE.find_paid_documents(
+            self.proposal.assign(sociedad="1000"), "2026-07-17"
+        )
+
+        self.assertTrue(other_company.empty)
+        self.assertEqual(same_company.index.tolist(), [0, 1, 2])
+
+    def test_ledger_without_company_is_upgraded_and_still_blocks(self) -> None:
+        path = MODULE.get_paid_ledger_path()
+        with contextlib.closing(sqlite3.connect(path)) as connection, connection:
+            connection.execute(
+                "CREATE TABLE documentos_pagados (cuenta INTEGER NOT NULL, "
+                "n_documento TEXT NOT NULL, monto INTEGER NOT NULL, "
+                "fecha_nomina TEXT NOT NULL, PRIMARY KEY (cuenta, n_documento, monto)) "
+                "WITHOUT ROWID"
+            )
+            connection.execute(
+                "INSERT INTO documentos_pagados VALUES (1001, '20.0', 5000, '2026-07-03')"
+            )
+
+        paid = MODULE.find_paid_documents(self.proposal.assign(sociedad="1000"), "2026-07-17")
+
+        self.assertEqual(paid.tolist(), [pd.Timestamp("2026-07-03")])
+        self.assertEqual(paid.index.tolist(), [0])
+
+
+class BenchmarkDataTests(unittest.TestCase):
+    def test_synthetic_lista_pi_exercises_every_control(self) -> None:
+        import benchmark_prenomina
+
+        raw = benchmark_prenomina.generate_lista_pi(2_000, seed=3)
+        tesoreria = benchmark_prenomina.generate_tesoreria(raw, seed=3)
+        lista_pi = MODULE.clean_names(raw).astype({"cuenta": "Int64"})
+        lista_pi = MODULE.apply_lista_pi_schema(lista_pi)
+        eligible = MODULE.mark_factoring_references(
+            MODULE.filter_eligible_payment_documents(lista_pi)
+        )
+        _, retained, blocked = MODULE.validate_payment_risk(eligible)
+
+        self.assertEqual(
+            set(lista_pi["clase_de_documento"].unique()),
+            set(benchmark_prenomina.DOCUMENT_CLASS_MIX),
+        )
+        self.assertLess(len(eligible), len(lista_pi))
+        self.assertTrue(eligible["referencia_factoring"].any())
+        self.assertFalse(blocked.empty)
+        self.assertFalse(retained.empty)
+        self.assertTrue(set(tesoreria["Proveedor"]).issubset(set(raw["Cuenta"])))
+
+
+class DiskCacheTests(unittest.TestCase):
+    def setUp(self) -> None:
+        self.cache_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.cache_dir.cleanup)
+        snapshot_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(snapshot_dir.cleanup)
+        patcher = mock.patch.dict(
+            MODULE.os.environ,
+            {
+                MODULE.DISK_CACHE_DIR_ENV_VAR: self.cache_dir.name,
+                MODULE.SNAPSHOT_DIR_ENV_VAR: snapshot_dir.name,
+            },
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_reuses_cleaned_frame_for_same_file_content(self) -> None:
+        calls = []
+
+        @MODULE.disk_cached("prueba")
+        def loader(uploaded_file):
+            calls.append(uploaded_file)
+            return pd.DataFrame(
+                {"cuenta": pd.array([1001, 1002], dtype="Int64")}, index=[3, 7]
+            )
+
+        first = loader(io.BytesIO(b"lista pi"))
+        second = loader(io.BytesIO(b"lista pi"))
+        loader(io.BytesIO(b"otra lista pi"))
+
+        self.assertEqual(len(calls), 2)
+        pd.testing.assert_frame_equal(first, second)
+
+    def test_pipeline_change_invalidates_previous_entries(self) -> None:
+        @MODULE.disk_cached("prueba")
+        def loader(uploaded_file):
+            return pd.DataFrame({"cuenta": [1001]})
+
+        loader(io.BytesIO(b"lista pi"))
+        with mock.patch.object(MODULE, "CLEANING_PIPELINE_VERSION", -1):
+            loader(io.BytesIO(b"lista pi"))
+
+        self.assertEqual(len(os.listdir(self.cache_dir.name)), 1)
+
+    def test_pipeline_change_keeps_temporary_files_of_loads_in_progress(self) -> None:
+        @MODULE.disk_cached("prueba")
+        def loader(uploaded_file):
+            return pd.DataFrame({"cuenta": [1001]})
+
+        in_progress = os.path.join(self.cache_dir.name, "prueba-abc-def.parquet.1-2.tmp")
+        with open(in_progress, "wb") as file:
+            file.write(b"parquet a medio escribir")
+        loader(io.BytesIO(b"lista pi"))
+
+        self.assertTrue(os.path.exists(in_progress))
+
+    def test_cached_loads_are_recorded_with_their_cache_origin(self) -> None:
+        @MODULE.instrument_cached_load("carga prueba")
+        @MODULE.st.cache_data
+        @MODULE.disk_cached("prueba")
+        def loader(uploaded_file):
+            return pd.DataFrame({"cuenta": [1001, 1002]})
+
+        instrumentation = MODULE.PipelineInstrumentation()
+        with instrumentation.activate():
+            loader(io.BytesIO(b"lista pi"))
+            loader(io.BytesIO(b"lista pi"))
+            loader.clear()
+            loader(io.BytesIO(b"lista pi"))
+
+        stages = instrumentation.to_frame()
+        self.assertEqual(stages["etapa"].unique().tolist(), ["carga prueba"])
+        self.assertEqual(stages["cache"].tolist(), ["no", "memoria", "disco"])
+        self.assertEqual(stages["filas_salida"].tolist(), [2, 2, 2])
+
+    def test_evicts_least_recently_used_entries_over_size_limit(self) -> None:
+        for position, name in enumerate(["antiguo", "medio", "reciente"]):
+            path = os.path.join(self.cache_dir.name, f"{name}.parquet")
+            with open(path, "wb") as file:
+                file.write(b"x" * 100)
+            os.utime(path, (position, position))
+
+        MODULE.evict_disk_cache(self.cache_dir.name, max_bytes=200)
+
+        self.assertEqual(
+            sorted(os.listdir(self.cache_dir.name)),
+            ["medio.parquet", "reciente.parquet"],
+        )
+
+
+class InstrumentationTests(unittest.TestCase):
+    def test_records_rows_and_propagates_nested_memory_peak(self) -> None:
+        instrumentation = MODULE.PipelineInstrumentation(trace_memory=True)
+
+        with instrumentation.activate():
+            with MODULE.instrument_stage("externa", rows_in=10) as outer:
+                with MODULE.instrument_stage("interna"):
+                    buffer = bytearray(8 * 1024**2)
+                del buffer
+                outer["filas_salida"] = 4
+
+        stages = instrumentation.to_frame().set_index("etapa")
+        self.assertEqual(stages.loc["externa", "filas_entrada"], 10)
+        self.assertEqual(stages.loc["externa", "filas_salida"], 4)
+        self.assertGreaterEqual(stages.loc["interna", "memoria_pico_mb"], 8)
+        self.assertGreaterEqual(stages.loc["externa", "memoria_pico_mb"], 8)
+
+    def test_writes_profile_and_records_only_while_active(self) -> None:
+        with tempfile.TemporaryDirectory() as profile_dir:
+            with mock.patch.dict(
+                MODULE.os.environ, {MODULE.PROFILE_DIR_ENV_VAR: profile_dir}
+            ):
+                instrumentation = MODULE.PipelineInstrumentation()
+                with instrumentation.activate():
+                    with MODULE.instrument_stage("activa", rows_in=3):
+                        pass
+
+            self.assertTrue(os.path.isfile(instrumentation.profile_path))
+
+        with MODULE.instrument_stage("inactiva"):
+            pass
+        self.assertEqual([stage["etapa"] for stage in instrumentation.stages], ["activa"])
+        self.assertIsNone(instrumentation.stages[0]["memoria_pico_mb"])
+
+    def test_concurrent_runs_keep_tracing_and_each_other_s_peak(self) -> None:
+        allocated, other_stage_done = threading.Event(), threading.Event()
+        first = MODULE.PipelineInstrumentation(trace_memory=True)
+        second = MODULE.PipelineInstrumentation(trace_memory=True)
+
+        def measure_first() -> None:
+            with first.activate(), MODULE.instrument_stage("primera"):
+                buffer = bytearray(8 * 1024**2)
+                del buffer
+                allocated.set()
+                other_stage_done.wait(10)
+
+        worker = threading.Thread(target=measure_first)
+        worker.start()
+        allocated.wait(10)
+        with second.activate():
+            with MODULE.instrument_stage("segunda"):
+                pass
+        other_stage_done.set()
+        worker.join()
+
+        self.assertGreaterEqual(first.stages[0]["memoria_pico_mb"], 8)
+        self.assertFalse(MODULE.tracemalloc.is_tracing())
+
+    def test_memory_report_is_measured_only_with_memory_instrumentation(self) -> None:
+        df = pd.DataFrame({"referencia": ["F-1", "F-2"]})
+
+        with self.assertNoLogs(MODULE.LOGGER, "INFO"):
+            MODULE.log_memory_report("sin rastreo", df)
+        with MODULE.PipelineInstrumentation(trace_memory=True).activate():
+            with self.assertLogs(MODULE.LOGGER, "INFO") as logs:
+                MODULE.log_memory_report("con rastreo", df)
+
+        self.assertIn("[memoria] con rastreo: filas=2", logs.output[0])
+
+
+class BatchCliTests(unittest.TestCase):
+    def setUp(self) -> None:
+        self.work_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.work_dir.cleanup)
+        # Cachés, instantánea y registro de pagos van al directorio temporal,
+        # no a la carpeta desde la que se corren las pruebas.
+        state_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(state_dir.cleanup)
+        patcher = mock.patch.dict(
+            MODULE.os.environ,
+            {
+                MODULE.DISK_CACHE_DIR_ENV_VAR: os.path.join(state_dir.name, "cache"),
+                MODULE.SNAPSHOT_DIR_ENV_VAR: os.path.join(state_dir.name, "snapshot"),
+                MODULE.PAID_LEDGER_ENV_VAR: os.path.join(state_dir.name, "pagos.sqlite"),
+            },
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.lista_pi_path = os.path.join(self.work_dir.name, "lista_pi.xlsx")
+        pd.DataFrame(
+            {
+                "Cuenta": [1001, 1001, 1001, 1002],
+                "Nombre 1": ["Bosch", "Bosch", "Bosch", "Menor"],
+                "Clase de documento": ["KR", "KR", "AB", "KR"],
+                "Nº documento": [20, 21, 10, 30],
+                "Vencimiento neto": pd.to_datetime(
+                    ["2026-07-10", "2026-07-17", "2026-08-30", "2026-07-24"]
+                ),
+                "Importe en moneda doc.": [-12_000_000, -5_000, 5_000, -1_000],
+                "Bloqueo de pago": ["", "", "", ""],
+                "Vía de pago": ["T", "T", "T", "T"],
+            }
+        ).to_excel(self.lista_pi_path, index=False)
+        self.tesoreria_path = os.path.join(self.work_dir.name, "tesoreria.xlsx")
+        pd.DataFrame(
+            {
+                "Proveedor": [1001, 1002],
+                "Nº documento de pago": [1, 2],
+                "Importe pagado en ML": [-12_000_000, -1_000],
+            }
+        ).to_excel(self.tesoreria_path, index=False)
+
+    def test_writes_workbook_and_reports_for_each_payroll_date(self) -> None:
+        output_dir = os.path.join(self.work_dir.name, "salida")
+
+        exit_code = MODULE.run_batch_cli(
+            [
+                "--lista-pi", self.lista_pi_path,
+                "--tesoreria", self.tesoreria_path,
+                "--fecha", "2026-07-17",
+                "--run", "2026-07-24", self.tesoreria_path,
+                "--salida", output_dir,
+            ]
+        )
+
+        self.assertEqual(exit_code, 0)
+        self.assertEqual(sorted(os.listdir(output_dir)), ["2026-07-17", "2026-07-24"])
+        blocked = pd.read_excel(
+            os.path.join(output_dir, "2026-07-17", MODULE.BLOCKED_REPORT_FILENAME)
+        )
+        self.assertEqual(blocked["n_documento"].tolist(), [21])
+        self.assertEqual(
+            pd.ExcelFile(
+                os.path.join(output_dir, "2026-07-17", MODULE.EXCEL_FILENAME)
+            ).sheet_names,
+            ["Bosch"],
+        )
+
+    def test_reports_empty_payroll_without_writing_files(self) -> None:
+        output_dir = os.path.join(self.work_dir.name, "salida")
+
+        exit_code = MODULE.run_batch_cli(
+            [
+                "--lista-pi", self.lista_pi_path,
+                "--run", "2026-07-01", self.tesoreria_path,
+                "--salida", output_dir,
+            ]
+        )
+
+        self.assertEqual(exit_code, 1)
+        self.assertFalse(os.path.exists(output_dir))
+
+    def test_memory_budget_stops_before_reading_lista_pi(self) -> None:
+        output_dir = os.path.join(self.work_dir.name, "salida")
+
+        with mock.patch.dict(MODULE.os.environ, {MODULE.MEMORY_BUDGET_ENV_VAR: "1"}):
+            with self.assertLogs(MODULE.LOGGER, "ERROR") as logs, mock.patch.object(
+                MODULE, "EXCEL_READERS", {}
+            ):
+                exit_code = MODULE.run_batch_cli(
+                    [
+                        "--lista-pi", self.lista_pi_path,
+                        "--tesoreria", self.tesoreria_path,
+                        "--fecha", "2026-07-17",
+                        "--salida", output_dir,
+                    ]
+                )
+
+        self.assertEqual(exit_code, 2)
+        self.assertIn("presupuesto de memoria", logs.output[0])
+        self.assertFalse(os.path.exists(output_dir))
+
+    def test_validates_several_companies_as_one_payroll(self) -> None:
+        source = pd.read_excel(self.lista_pi_path)
+        company_paths = []
+        # El anticipo AB está en una sociedad y la factura que compensa, en otra.
+        for company, rows in (("1000", [2]), ("2000", [0, 1, 3])):
+            company_paths.append(os.path.join(self.work_dir.name, f"{company}.xlsx"))
+            source.iloc[rows].to_excel(company_paths[-1], index=False)
+        output_dir = os.path.join(self.work_dir.name, "salida")
+
+        exit_code = MODULE.run_batch_cli(
+            [
+                "--lista-pi", company_paths[0],
+                "--lista-pi", company_paths[1],
+                "--tesoreria", self.tesoreria_path,
+                "--fecha", "2026-07-17",
+                "--salida", output_dir,
+            ]
+        )
+
+        self.assertEqual(exit_code, 0)
+        blocked = pd.read_excel(
+            os.path.join(output_dir, "2026-07-17", MODULE.BLOCKED_REPORT_FILENAME)
+        )
+        self.assertEqual(blocked["n_documento"].tolist(), [21])
+        self.assertEqual(blocked["sociedad"].tolist(), [2000])
+        with mock.patch("sys.stderr", io.StringIO()), self.assertRaises(SystemExit):
+            MODULE.parse_cli_args(
+                [*sum((["--lista-pi", path] for path in company_paths), []),
+                 "--tesoreria", self.tesoreria_path, "--fecha", "2026-07-17",
+                 "--por-particiones"]
+            )
+
+    def test_registered_payroll_blocks_the_same_documents_next_week(self) -> None:
+        # La exportación de la semana siguiente llega con otro nombre de archivo.
+        next_week_path = os.path.join(self.work_dir.name, "ListaPI_2026-07-24.xlsx")
+        shutil.copyfile(self.lista_pi_path, next_week_path)
+        for first_mode, next_mode in (([], ["--por-particiones"]), (["--por-particiones"], [])):
+            with self.subTest(primera=first_mode, siguiente=next_mode):
+                run_dir = tempfile.mkdtemp(dir=self.work_dir.name)
+                output_dir = os.path.join(run_dir, "salida")
+                with mock.patch.dict(
+                    MODULE.os.environ,
+                    {MODULE.PAID_LEDGER_ENV_VAR: os.path.join(run_dir, "pagos.sqlite")},
+                ):
+                    MODULE.run_batch_cli(
+                        [
+                            "--lista-pi", self.lista_pi_path,
+                            "--run", "2026-07-17", self.tesoreria_path,
+                            "--salida", output_dir,
+                            "--registrar-pagos",
+                            *first_mode,
+                        ]
+                    )
+                    MODULE.run_batch_cli(
+                        [
+                            "--lista-pi", next_week_path,
+                            "--run", "2026-07-24", self.tesoreria_path,
+                            "--salida", output_dir,
+                            *next_mode,
+                        ]
+                    )
+
+                blocked = pd.read_excel(
+                    os.path.join(output_dir, "2026-07-24", MODULE.BLOCKED_REPORT_FILENAME)
+                )
+                # La 21 sigue bloqueada por el anticipo; la 20 ya se pagó el 17-07.
+                self.assertEqual(blocked["n_documento"].tolist(), [20, 21])
+                self.assertEqual(
+                    blocked["estado_validacion"].tolist(),
+                    [MODULE.PAID_LEDGER_STATUS, "BLOQUEADO_POR_ANTICIPO"],
+                )
+
+    def test_renamed_company_files_match_the_ledger_next_week(self) -> None:
+        source = pd.read_excel(self.lista_pi_path)
+        ledger_path = os.path.join(self.work_dir.name, "pagos.sqlite")
+        output_dir = os.path.join(self.work_dir.name, "salida")
+        weeks = {}
+        for fecha, suffix in (("2026-07-17", ""), ("2026-07-24", "_2026-07-24")):
+            weeks[fecha] = []
+            for company, rows in (("1000", [0, 2]), ("2000", [1, 3])):
+                weeks[fecha].append(
+                    os.path.join(self.work_dir.name, f"{company}{suffix}.xlsx")
+                )
+                source.iloc[rows].to_excel(weeks[fecha][-1], index=False)
+
+        with mock.patch.dict(MODULE.os.environ, {MODULE.PAID_LEDGER_ENV_VAR: ledger_path}):
+            for fecha, paths in weeks.items():
+                MODULE.run_batch_cli(
+                    [
+                        *sum((["--lista-pi", path] for path in paths), []),
+                        "--run", fecha, self.tesoreria_path,
+                        "--salida", output_dir,
+                        *(["--registrar-pagos"] if fecha == "2026-07-17" else []),
+                    ]
+                )
+
+        blocked = pd.read_excel(
+            os.path.join(output_dir, "2026-07-24", MODULE.BLOCKED_REPORT_FILENAME)
+        )
+        self.assertEqual(blocked["n_documento"].tolist(), [20, 21])
+        self.assertEqual(blocked["estado_validacion"].iloc[0], MODULE.PAID_LEDGER_STATUS)
+        self.assertEqual(blocked["sociedad"].tolist(), ["1000_2026-07-24", "2000_2026-07-24"])
+
+    def test_partitioned_mode_matches_in_memory_outputs(self) -> None:
+        in_memory_dir = os.path.join(self.work_dir.name, "memoria")
+        partitioned_dir = os.path.join(self.work_dir.name, "particiones")
+        arguments = [
+            "--lista-pi", self.lista_pi_path,
+            "--tesoreria", self.tesoreria_path,
+            "--fecha", "2026-07-17",
+            "--zip-por-acreedor",
+            "--csv",
+            "--parquet",
+        ]
+
+        MODULE.run_batch_cli([*arguments, "--salida", in_memory_dir])
+        exit_code = MODULE.run_batch_cli(
+            [
+                *arguments,
+                "--por-particiones",
+                "--bloque-filas", "2",
+                "--particiones", "2",
+                "--salida", partitioned_dir,
+            ]
+        )
+
+        self.assertEqual(exit_code, 0)
+        for file_name in (
+            MODULE.EXCEL_FILENAME,
+            MODULE.BLOCKED_REPORT_FILENAME,
+            MODULE.RETAINED_REPORT_FILENAME,
+            MODULE.DUPLICATE_REPORT_FILENAME,
+        ):
+            expected = pd.read_excel(
+                os.path.join(in_memory_dir, "2026-07-17", file_name), sheet_name=None
+            )
+            actual = pd.read_excel(
+                os.path.join(partitioned_dir, "2026-07-17", file_name), sheet_name=None
+            )
+            self.assertEqual(list(actual), list(expected))
+            for sheet_name, df_sheet in expected.items():
+                pd.testing.assert_frame_equal(actual[sheet_name], df_sheet)
+        with zipfile.ZipFile(
+            os.path.join(partitioned_dir, "2026-07-17", MODULE.ZIP_FILENAME)
+        ) as archive:
+            self.assertEqual(archive.namelist(), ["1001_Bosch.xlsx"])
+        csv_files = [
+            os.path.join(directory, "2026-07-17", MODULE.CSV_FILENAME)
+            for directory in (in_memory_dir, partitioned_dir)
+        ]
+        expected_csv, actual_csv = (pd.read_csv(path) for path in csv_files)
+        pd.testing.assert_frame_equal(actual_csv, expected_csv)
+        self.assertEqual(expected_csv["n_documento"].tolist(), [20])
+        pd.testing.assert_frame_equal(
+            pd.read_parquet(
+                os.path.join(partitioned_dir, "2026-07-17", MODULE.PARQUET_DATASET_DIRNAME)
+            ),
+            pd.read_parquet(
+                os.path.join(in_memory_dir, "2026-07-17", MODULE.PARQUET_DATASET_DIRNAME)
+            ),
+        )
+
+
 if __name__ == "__main__":
     unittest.main()